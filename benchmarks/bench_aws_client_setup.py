@@ -0,0 +1,81 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Per-turn AWS setup time benchmark
+
+Measures what a chat turn spends before the first Bedrock request is sent:
+
+  per-turn  - a new boto3.Session and bedrock-runtime client every turn
+              (the previous behaviour of StrandsAgentClient._get_model, which
+              is what BedrockModel.__init__ does with a fresh session)
+  registry  - the shared session/client from aws_clients.AWSClientRegistry
+
+No network access is needed; static dummy credentials are used so the
+credential chain is not probed.
+
+Usage:
+    python benchmarks/bench_aws_client_setup.py --turns 200
+"""
+import os
+import sys
+import time
+import argparse
+import logging
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import boto3
+from botocore.config import Config
+from aws_clients import AWSClientRegistry
+
+logging.disable(logging.INFO)
+
+REGION = 'us-east-1'
+KEY_ID = 'AKIDEXAMPLE'
+SECRET = 'local'
+
+
+def per_turn_setup():
+    session = boto3.Session(aws_access_key_id=KEY_ID, aws_secret_access_key=SECRET, region_name=REGION)
+    return session.client('bedrock-runtime', config=Config(read_timeout=900, connect_timeout=30,
+                                                           retries=dict(max_attempts=3, mode="adaptive")))
+
+
+def registry_setup(registry: AWSClientRegistry):
+    return registry.get_client('bedrock-runtime', region_name=REGION, aws_access_key_id=KEY_ID,
+                               aws_secret_access_key=SECRET, read_timeout=900, connect_timeout=30,
+                               retries=dict(max_attempts=3, mode="adaptive"))
+
+
+def measure(fn, turns: int):
+    samples = []
+    for _ in range(turns):
+        start = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - start) * 1000)
+    return samples
+
+
+def report(mode: str, samples: list):
+    ordered = sorted(samples)
+    p99 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.99))]
+    print(f"{mode:<9} mean={statistics.mean(samples):8.3f}ms p50={statistics.median(samples):8.3f}ms "
+          f"p99={p99:8.3f}ms total={sum(samples):9.1f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--turns', type=int, default=200, help="simulated chat turns")
+    args = parser.parse_args()
+
+    print(f"turns={args.turns}")
+    report('per-turn', measure(per_turn_setup, args.turns))
+    registry = AWSClientRegistry()
+    report('registry', measure(lambda: registry_setup(registry), args.turns))
+
+
+if __name__ == '__main__':
+    main()
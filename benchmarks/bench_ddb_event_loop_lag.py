@@ -0,0 +1,242 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Event-loop lag benchmark for the DynamoDB helpers in utils.py
+
+Simulates N concurrent SSE streams. Every stream performs the storage calls of a
+real chat request (register stream, load history, poll the stream record, save
+history, unregister stream) while a ticker task measures how late the event loop
+wakes it up. Two modes are compared:
+
+  blocking  - the synchronous boto3 Table API is called directly on the loop
+              (the previous behaviour of utils.py)
+  offload   - the utils.py helpers backed by AsyncDDBStorage
+
+By default the table is an in-process stand-in with a configurable round trip
+latency. Pass --endpoint-url to run against DynamoDB Local instead, e.g.
+    docker run -p 8000:8000 amazon/dynamodb-local
+    python benchmarks/bench_ddb_event_loop_lag.py --endpoint-url http://localhost:8000
+
+Usage:
+    python benchmarks/bench_ddb_event_loop_lag.py --streams 200 --latency-ms 5
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import logging
+import statistics
+import threading
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import boto3
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+import utils
+from ddb_storage import AsyncDDBStorage
+
+logging.disable(logging.INFO)
+
+TABLE_NAME = "bench_mcp_user_config_table"
+
+
+class LocalDynamoDBTable:
+    """In-process stand-in for a DynamoDB Table with a fixed round trip latency"""
+
+    def __init__(self, latency: float):
+        self.latency = latency
+        self.items = {}
+        self.lock = threading.Lock()
+        # BatchGetItem goes through the low-level client, as in AsyncDDBStorage
+        self.meta = SimpleNamespace(client=SimpleNamespace(batch_get_item=self._batch_get_item))
+
+    def put_item(self, Item, **kwargs):
+        time.sleep(self.latency)
+        with self.lock:
+            self.items[Item['userId']] = dict(Item)
+        return {}
+
+    def get_item(self, Key, **kwargs):
+        time.sleep(self.latency)
+        with self.lock:
+            item = self.items.get(Key['userId'])
+        return {'Item': dict(item)} if item else {}
+
+    def delete_item(self, Key, **kwargs):
+        time.sleep(self.latency)
+        with self.lock:
+            self.items.pop(Key['userId'], None)
+        return {}
+
+    def scan(self, **kwargs):
+        time.sleep(self.latency)
+        with self.lock:
+            return {'Items': [dict(item) for item in self.items.values()]}
+
+    def batch_writer(self):
+        return LocalBatchWriter(self)
+
+    def _batch_get_item(self, RequestItems, **kwargs):
+        time.sleep(self.latency)
+        serializer, deserializer = TypeSerializer(), TypeDeserializer()
+        responses = {}
+        with self.lock:
+            for table_name, request in RequestItems.items():
+                keys = [deserializer.deserialize(key['userId']) for key in request['Keys']]
+                responses[table_name] = [{k: serializer.serialize(v) for k, v in self.items[key].items()}
+                                         for key in keys if key in self.items]
+        return {'Responses': responses, 'UnprocessedKeys': {}}
+
+
+class LocalBatchWriter:
+    """batch_writer() of the stand-in table, one round trip per 25 buffered writes like BatchWriteItem"""
+
+    def __init__(self, table: LocalDynamoDBTable):
+        self.table = table
+        self.pending = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.flush()
+
+    def put_item(self, Item):
+        self.pending.append(('put', dict(Item)))
+        if len(self.pending) >= 25:
+            self.flush()
+
+    def delete_item(self, Key):
+        self.pending.append(('delete', Key))
+        if len(self.pending) >= 25:
+            self.flush()
+
+    def flush(self):
+        if not self.pending:
+            return
+        time.sleep(self.table.latency)
+        with self.table.lock:
+            for action, value in self.pending:
+                if action == 'put':
+                    self.table.items[value['userId']] = value
+                else:
+                    self.table.items.pop(value['userId'], None)
+        self.pending = []
+
+
+def create_local_table(endpoint_url: str):
+    """Create the benchmark table in DynamoDB Local if it does not exist"""
+    resource = boto3.resource('dynamodb', region_name='us-east-1', endpoint_url=endpoint_url,
+                              aws_access_key_id='local', aws_secret_access_key='local')
+    try:
+        table = resource.create_table(
+            TableName=TABLE_NAME,
+            KeySchema=[{'AttributeName': 'userId', 'KeyType': 'HASH'}],
+            AttributeDefinitions=[{'AttributeName': 'userId', 'AttributeType': 'S'}],
+            BillingMode='PAY_PER_REQUEST',
+        )
+        table.wait_until_exists()
+    except resource.meta.client.exceptions.ResourceInUseException:
+        pass
+
+
+async def measure_loop_lag(stop: asyncio.Event, interval: float, lags: list):
+    """Record how late the loop resumes a task that sleeps for `interval`"""
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        start = loop.time()
+        await asyncio.sleep(interval)
+        lags.append(max(0.0, loop.time() - start - interval))
+
+
+async def blocking_stream(table, stream_idx: int, polls: int):
+    """One chat request using the synchronous Table API on the loop"""
+    user_id = f"user_{stream_idx}"
+    stream_id = f"stream_{user_id}_{stream_idx}"
+    table.put_item(Item={'userId': stream_id, 'data': json.dumps({'user_id': user_id})})
+    table.get_item(Key={'userId': f"{user_id}_messages"})
+    for _ in range(polls):
+        table.get_item(Key={'userId': stream_id})
+        await asyncio.sleep(0)
+    table.put_item(Item={'userId': f"{user_id}_messages", 'data': json.dumps([{"role": "user", "content": []}])})
+    table.delete_item(Key={'userId': stream_id})
+
+
+async def offload_stream(stream_idx: int, polls: int):
+    """One chat request using the async helpers from utils.py"""
+    user_id = f"user_{stream_idx}"
+    stream_id = f"stream_{user_id}_{stream_idx}"
+    await utils.save_stream_id(stream_id, user_id)
+    await utils.get_user_message(user_id)
+    for _ in range(polls):
+        await utils.get_stream_id(stream_id)
+    await utils.save_user_message(user_id, [{"role": "user", "content": []}])
+    await utils.delete_stream_id(stream_id)
+
+
+async def run(mode: str, streams: int, polls: int, table_factory, max_concurrency: int):
+    lags = []
+    stop = asyncio.Event()
+    ticker = asyncio.create_task(measure_loop_lag(stop, 0.01, lags))
+    started = time.perf_counter()
+    if mode == 'blocking':
+        table = table_factory()
+        await asyncio.gather(*[blocking_stream(table, i, polls) for i in range(streams)])
+    else:
+        utils.ddb_storage = AsyncDDBStorage(TABLE_NAME, table_factory=table_factory, max_concurrency=max_concurrency)
+        await asyncio.gather(*[offload_stream(i, polls) for i in range(streams)])
+        utils.ddb_storage.shutdown()
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await ticker
+    return elapsed, lags
+
+
+def report(mode: str, elapsed: float, lags: list):
+    lags_ms = sorted(lag * 1000 for lag in lags) or [0.0]
+    p99 = lags_ms[min(len(lags_ms) - 1, int(len(lags_ms) * 0.99))]
+    print(f"{mode:<9} wall={elapsed:7.2f}s  loop lag: mean={statistics.mean(lags_ms):8.2f}ms "
+          f"p99={p99:8.2f}ms max={lags_ms[-1]:8.2f}ms samples={len(lags_ms)}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--streams', type=int, default=200, help="concurrent streams")
+    parser.add_argument('--polls', type=int, default=5, help="stream status reads per stream")
+    parser.add_argument('--latency-ms', type=float, default=5.0, help="round trip latency of the stand-in table")
+    parser.add_argument('--max-concurrency', type=int, default=32, help="AsyncDDBStorage worker threads")
+    parser.add_argument('--endpoint-url', default='', help="use DynamoDB Local instead of the in-process stand-in")
+    parser.add_argument('--modes', default='blocking,offload')
+    args = parser.parse_args()
+
+    if args.endpoint_url:
+        create_local_table(args.endpoint_url)
+
+        def table_factory():
+            session = boto3.session.Session(aws_access_key_id='local', aws_secret_access_key='local')
+            return session.resource('dynamodb', region_name='us-east-1',
+                                    endpoint_url=args.endpoint_url).Table(TABLE_NAME)
+    else:
+        shared_table = LocalDynamoDBTable(args.latency_ms / 1000)
+
+        def table_factory():
+            return shared_table
+
+    # route the utils.py helpers to the benchmark table
+    utils.DDB_TABLE = TABLE_NAME
+    utils.dynamodb_client = object()
+
+    print(f"streams={args.streams} polls={args.polls} "
+          f"backend={'dynamodb-local' if args.endpoint_url else f'stand-in {args.latency_ms}ms'}")
+    for mode in args.modes.split(','):
+        elapsed, lags = asyncio.run(run(mode, args.streams, args.polls, table_factory, args.max_concurrency))
+        report(mode, elapsed, lags)
+
+
+if __name__ == '__main__':
+    main()
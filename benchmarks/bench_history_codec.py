@@ -0,0 +1,179 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Storage size and read latency of conversation histories per history codec
+
+Builds synthetic 100-turn research conversations (question, tool call, large
+tool result, answer) and stores them through the utils.py history helpers into
+an in-process table stand-in that charges a round trip latency per request and
+a transfer time per byte. Compared layouts:
+
+  blob   - the whole history as one JSON string item (the original format)
+  plain  - one item per message, uncompressed
+  zlib   - one item per message, deflate above the threshold
+  zstd   - one item per message, zstd above the threshold (needs zstandard)
+
+Reported per layout: bytes stored, items, largest item, write/read capacity
+units, and the time of a full history load (requests + transfer + decode).
+
+Usage:
+    python benchmarks/bench_history_codec.py --turns 100 --histories 5 --latency-ms 5 --mbps 50
+"""
+import os
+import sys
+import math
+import json
+import time
+import random
+import asyncio
+import argparse
+import logging
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import utils
+import history_codec
+
+logging.disable(logging.WARNING)
+
+DDB_ITEM_LIMIT = 400 * 1024
+WORDS = ("revenue market growth customer analysis report quarter region product demand supply cost "
+         "forecast model data source table risk trend price segment share strategy channel").split()
+
+
+def synthetic_history(turns: int, rng: random.Random) -> list:
+    messages = []
+    for turn in range(turns):
+        tool_id = f"tooluse_{turn}_{rng.randrange(10**9)}"
+        rows = [{"title": " ".join(rng.choices(WORDS, k=8)), "url": f"https://example.com/{rng.randrange(10**6)}",
+                 "snippet": " ".join(rng.choices(WORDS, k=rng.randint(40, 120))), "score": rng.random()}
+                for _ in range(rng.randint(10, 60))]
+        messages += [
+            {"role": "user", "content": [{"text": " ".join(rng.choices(WORDS, k=rng.randint(10, 40)))}]},
+            {"role": "assistant", "content": [{"toolUse": {"toolUseId": tool_id, "name": "web_search",
+                                                           "input": {"query": " ".join(rng.choices(WORDS, k=6))}}}]},
+            {"role": "user", "content": [{"toolResult": {"toolUseId": tool_id, "status": "success",
+                                                         "content": [{"text": json.dumps(rows)}]}}]},
+            {"role": "assistant", "content": [{"text": " ".join(rng.choices(WORDS, k=rng.randint(100, 400)))}]},
+        ]
+    return messages
+
+
+def item_size(item: dict) -> int:
+    size = 0
+    for name, value in item.items():
+        value = getattr(value, 'value', value)
+        size += len(name.encode()) + (len(value) if isinstance(value, bytes) else len(str(value).encode()))
+    return size
+
+
+class LocalStorage:
+    """AsyncDDBStorage stand-in: every request costs a round trip, every byte a transfer time"""
+
+    def __init__(self, latency: float, bytes_per_second: float):
+        self.items = {}
+        self.latency = latency
+        self.bytes_per_second = bytes_per_second
+
+    async def _request(self, size: int):
+        await asyncio.sleep(self.latency + size / self.bytes_per_second)
+
+    async def put_item(self, item, **kwargs):
+        self.items[item['userId']] = dict(item)
+        await self._request(item_size(item))
+
+    async def get_item(self, key, **kwargs):
+        item = self.items.get(key['userId'])
+        await self._request(item_size(item) if item else 0)
+        return {'Item': dict(item)} if item else {}
+
+    async def update_item(self, key, ExpressionAttributeValues=None, **kwargs):
+        self.items[key['userId']]['historyEnd'] = ExpressionAttributeValues[':end']
+        await self._request(0)
+
+    async def delete_item(self, key, **kwargs):
+        self.items.pop(key['userId'], None)
+
+    async def batch_put_items(self, items):
+        for i in range(0, len(items), 25):
+            batch = items[i:i + 25]
+            for item in batch:
+                self.items[item['userId']] = dict(item)
+            await self._request(sum(item_size(item) for item in batch))
+
+    async def batch_delete_items(self, keys):
+        for key in keys:
+            self.items.pop(key['userId'], None)
+
+    async def batch_get_items(self, keys, **kwargs):
+        # AsyncDDBStorage sends the 100-key BatchGetItem requests concurrently
+        found = [dict(self.items[key['userId']]) for key in keys if key['userId'] in self.items]
+        await self._request(sum(map(item_size, found)))
+        return found
+
+
+def capacity(items) -> tuple:
+    sizes = [item_size(item) for item in items]
+    return sum(math.ceil(size / 1024) for size in sizes), sum(math.ceil(size / 4096) for size in sizes), sizes
+
+
+async def run_layout(name: str, histories: list, args) -> dict:
+    storage = LocalStorage(args.latency_ms / 1000, args.mbps * 1024 * 1024)
+    utils.ddb_storage = storage
+    if name != 'blob':
+        history_codec.HISTORY_CODEC = 'none' if name == 'plain' else name
+        history_codec.HISTORY_COMPRESS_THRESHOLD = math.inf if name == 'plain' else args.threshold
+    write_times, read_times = [], []
+    for index, history in enumerate(histories):
+        user_id = f"bench_user_{index}"
+        start = time.perf_counter()
+        if name == 'blob':
+            await utils.save_to_ddb(f"{user_id}_messages", history)
+        else:
+            await utils.save_user_message(user_id, history)
+        write_times.append(time.perf_counter() - start)
+        utils.user_message_cache.invalidate(user_id)
+        start = time.perf_counter()
+        loaded = await utils.get_user_message(user_id, tail=0)
+        read_times.append(time.perf_counter() - start)
+        assert loaded == history, name
+    wcu, rcu, sizes = capacity(storage.items.values())
+    return {
+        "bytes": sum(sizes) / len(histories),
+        "items": len(storage.items) / len(histories),
+        "max_item": max(sizes),
+        "wcu": wcu / len(histories),
+        "rcu": rcu / len(histories),
+        "write_ms": statistics.median(write_times) * 1000,
+        "read_ms": statistics.median(read_times) * 1000,
+    }
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--turns', type=int, default=100)
+    parser.add_argument('--histories', type=int, default=5)
+    parser.add_argument('--latency-ms', type=float, default=5, help="round trip latency per request")
+    parser.add_argument('--mbps', type=float, default=50, help="transfer bandwidth in MB/s")
+    parser.add_argument('--threshold', type=int, default=history_codec.HISTORY_COMPRESS_THRESHOLD)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    histories = [synthetic_history(args.turns, rng) for _ in range(args.histories)]
+    layouts = ['blob', 'plain', 'zlib'] + (['zstd'] if history_codec._zstd is not None else [])
+    print(f"turns={args.turns} messages={len(histories[0])} histories={args.histories} "
+          f"latency={args.latency_ms}ms bandwidth={args.mbps}MB/s threshold={args.threshold}B")
+    print(f"{'layout':<6} {'bytes':>12} {'items':>7} {'max item':>10} {'WCU':>7} {'RCU':>7} "
+          f"{'write ms':>9} {'load ms':>8}")
+    for name in layouts:
+        result = await run_layout(name, histories, args)
+        note = "  exceeds 400 KB item limit" if result["max_item"] > DDB_ITEM_LIMIT else ""
+        print(f"{name:<6} {result['bytes']:12,.0f} {result['items']:7.0f} {result['max_item']:10,} "
+              f"{result['wcu']:7.0f} {result['rcu']:7.0f} {result['write_ms']:9.1f} {result['read_ms']:8.1f}{note}")
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -0,0 +1,122 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+CPU cost of merging the agent stream with the SSE heartbeat stream
+
+  legacy - the previous main._merge_streams: asyncio.wait(timeout=0.1) in a
+           loop and a new task for every item pulled from every source
+  queue  - stream_merge.merge_streams: one pump task per source into a queue
+
+The agent stream emits `--events` block_delta events (yielding to the loop
+between events, like a model stream does) followed by an end_turn message_stop;
+the heartbeat stream is idle like in production. CPU time is process time.
+
+Usage:
+    python benchmarks/bench_merge_streams.py --events 10000 --rounds 5
+"""
+import os
+import sys
+import time
+import asyncio
+import argparse
+import logging
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from stream_merge import merge_streams
+
+logging.disable(logging.INFO)
+
+
+async def legacy_merge_streams(*streams):
+    """The previous implementation, kept here for comparison"""
+    stream_tasks = []
+    for stream in streams:
+        stream_iter = aiter(stream)
+        task = asyncio.create_task(anext(stream_iter, StopAsyncIteration))
+        stream_tasks.append((task, stream_iter))
+    try:
+        while stream_tasks:
+            done, pending = await asyncio.wait(
+                [task for task, _ in stream_tasks],
+                return_when=asyncio.FIRST_COMPLETED,
+                timeout=0.1
+            )
+            new_stream_tasks = []
+            main_stream_ended = False
+            for task, stream_iter in stream_tasks:
+                if task in done:
+                    result = await task
+                    if result is not StopAsyncIteration:
+                        yield result
+                        if isinstance(result, dict):
+                            result_type = result.get("type")
+                            if result_type == "stopped":
+                                main_stream_ended = True
+                            elif result_type == "message_stop":
+                                if result.get("data", {}).get("stopReason") in ['end_turn', 'max_tokens']:
+                                    main_stream_ended = True
+                            elif result_type == "error":
+                                main_stream_ended = True
+                        new_task = asyncio.create_task(anext(stream_iter, StopAsyncIteration))
+                        new_stream_tasks.append((new_task, stream_iter))
+                else:
+                    new_stream_tasks.append((task, stream_iter))
+            stream_tasks = new_stream_tasks
+            if main_stream_ended:
+                break
+    finally:
+        for task, _ in stream_tasks:
+            if not task.done():
+                task.cancel()
+                try:
+                    await task
+                except asyncio.CancelledError:
+                    pass
+
+
+async def agent_stream(events: int):
+    for i in range(events):
+        await asyncio.sleep(0)
+        yield {"type": "block_delta", "data": {"delta": {"text": "tok"}, "contentBlockIndex": 0}}
+    yield {"type": "message_stop", "data": {"stopReason": "end_turn"}}
+
+
+async def heartbeat_stream():
+    while True:
+        await asyncio.sleep(10)
+        yield ": heartbeat\n\n"
+
+
+async def run(merge, events: int):
+    count = 0
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+    async for _ in merge(agent_stream(events), heartbeat_stream()):
+        count += 1
+    return time.process_time() - cpu_start, time.perf_counter() - wall_start, count
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--events', type=int, default=10000, help="events per merged stream")
+    parser.add_argument('--rounds', type=int, default=5)
+    args = parser.parse_args()
+
+    print(f"events={args.events} rounds={args.rounds}")
+    for name, merge in (('legacy', legacy_merge_streams), ('queue', merge_streams)):
+        cpu, wall = [], []
+        for _ in range(args.rounds):
+            c, w, count = asyncio.run(run(merge, args.events))
+            assert count == args.events + 1, count
+            cpu.append(c)
+            wall.append(w)
+        per_10k = statistics.median(cpu) * 10000 / args.events * 1000
+        print(f"{name:<7} cpu per 10k events={per_10k:8.1f}ms  wall median={statistics.median(wall) * 1000:8.1f}ms")
+
+
+if __name__ == '__main__':
+    main()
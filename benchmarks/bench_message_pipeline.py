@@ -0,0 +1,101 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Message preprocessing: chained utils.py functions vs utils.MessagePipeline
+
+Synthetic histories mix user texts, assistant texts with reasoning, tool uses,
+tool results with long texts and screenshots, and cache points. For every
+combination of transformations the chained functions and the one-pass pipeline
+run on identical copies of the history; the results are checked to be equal
+and the median time per call is reported.
+
+Usage:
+    python benchmarks/bench_message_pipeline.py --sizes 200 1000 5000 --repeat 20
+"""
+import os
+import sys
+import copy
+import time
+import random
+import argparse
+import logging
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from utils import (MessagePipeline, filter_tool_use_result, maybe_redact_old_text_content,
+                   maybe_filter_to_n_most_recent_images, remove_cache_checkpoint)
+
+logging.disable(logging.INFO)
+
+IMAGE = {"image": {"format": "png", "source": {"bytes": b"\x89PNG" + b"\x00" * 64}}}
+
+
+def synthetic_history(size: int, rng: random.Random) -> list:
+    messages = []
+    while len(messages) < size:
+        tool_id = f"tooluse_{len(messages)}"
+        result_content = [{"text": "r" * rng.choice([200, 800, 3000, 12000])}]
+        if rng.random() < 0.3:
+            result_content.append(copy.deepcopy(IMAGE))
+        messages += [
+            {"role": "user", "content": [{"text": "question " * rng.randint(5, 50)}, {"cachePoint": {"type": "default"}}]},
+            {"role": "assistant", "content": [{"reasoningContent": {"reasoningText": {"text": "thinking " * 30}}},
+                                              {"toolUse": {"toolUseId": tool_id, "name": "browser", "input": {"q": "x"}}}]},
+            {"role": "user", "content": [{"toolResult": {"toolUseId": tool_id, "status": "success",
+                                                         "content": result_content}}]},
+            {"role": "assistant", "content": [{"text": "answer " * rng.randint(20, 200)}]},
+        ]
+    return messages[:size]
+
+
+SCENARIOS = {
+    "redact+images+cache": (
+        lambda m: remove_cache_checkpoint(maybe_filter_to_n_most_recent_images(
+            maybe_redact_old_text_content(m, window_size=10), images_to_keep=5, min_removal_threshold=2)),
+        MessagePipeline().redact_old_text(window_size=10).keep_recent_images(5, 2).remove_cache_points(),
+    ),
+    "filter_tool_use+cache": (
+        lambda m: remove_cache_checkpoint(filter_tool_use_result(m)),
+        MessagePipeline().filter_tool_use().remove_cache_points(),
+    ),
+    "all four": (
+        lambda m: remove_cache_checkpoint(filter_tool_use_result(maybe_filter_to_n_most_recent_images(
+            maybe_redact_old_text_content(m, window_size=10), images_to_keep=5, min_removal_threshold=2))),
+        MessagePipeline().redact_old_text(window_size=10).keep_recent_images(5, 2)
+        .filter_tool_use().remove_cache_points(),
+    ),
+}
+
+
+def measure(fn, history: list, repeat: int) -> float:
+    times = []
+    for _ in range(repeat):
+        messages = copy.deepcopy(history)
+        start = time.perf_counter()
+        fn(messages)
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--sizes', type=int, nargs='+', default=[200, 1000, 5000])
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    print(f"{'messages':>8} {'scenario':<22} {'chained ms':>11} {'pipeline ms':>12} {'speedup':>8}")
+    for size in args.sizes:
+        history = synthetic_history(size, rng)
+        for name, (chained, pipeline) in SCENARIOS.items():
+            assert chained(copy.deepcopy(history)) == pipeline(copy.deepcopy(history)), name
+            old = measure(chained, history, args.repeat)
+            new = measure(pipeline, history, args.repeat)
+            print(f"{size:>8} {name:<22} {old * 1000:11.3f} {new * 1000:12.3f} {old / new:7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
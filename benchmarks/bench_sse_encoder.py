@@ -0,0 +1,85 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+SSE chunk encoding benchmark for the block_delta hot path of stream_chat_response
+
+  dict    - the previous path: build the nested event_data dict, call
+            time.time_ns() and time.time(), json.dumps the whole envelope
+  encoder - sse_encoder.ChatChunkEncoder.delta(): escape only the delta text
+
+Each mode encodes `--chunks` deltas of realistic token sizes (ASCII and CJK)
+and reports throughput and the share of one core needed to sustain the target
+rate. Run with SSE_JSON_BACKEND=orjson to measure the orjson backend.
+
+Usage:
+    python benchmarks/bench_sse_encoder.py --chunks 500000 --target-rate 50000
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import sse_encoder
+from sse_encoder import ChatChunkEncoder
+
+MODEL = "us.anthropic.claude-sonnet-4-20250514-v1:0"
+TOKENS = ["Hello", " world", ",", " the", " quick\n", " \"quoted\"", " 你好", "世界", " café", "\t{json}"]
+
+
+def dict_path(texts):
+    out = []
+    for text in texts:
+        event_data = {
+            "id": f"chat{time.time_ns()}",
+            "object": "chat.completion.chunk",
+            "created": int(time.time()),
+            "model": MODEL,
+            "choices": [{
+                "index": 0,
+                "delta": {},
+                "finish_reason": None
+            }]
+        }
+        event_data["choices"][0]["delta"] = {"content": text}
+        out.append(f"data: {json.dumps(event_data)}\n\n")
+    return out
+
+
+def encoder_path(texts):
+    encoder = ChatChunkEncoder(MODEL)
+    return [encoder.delta("content", text) for text in texts]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--chunks', type=int, default=500000)
+    parser.add_argument('--target-rate', type=int, default=50000, help="chunks per second to sustain")
+    args = parser.parse_args()
+
+    rng = random.Random(0)
+    texts = [rng.choice(TOKENS) for _ in range(args.chunks)]
+
+    # both paths must produce the same JSON content apart from the id
+    for old, new in zip(dict_path(texts[:len(TOKENS)]), encoder_path(texts[:len(TOKENS)])):
+        old_obj, new_obj = json.loads(old[6:]), json.loads(new[6:])
+        old_obj.pop("id"), new_obj.pop("id"), old_obj.pop("created"), new_obj.pop("created")
+        assert old_obj == new_obj, (old, new)
+
+    print(f"chunks={args.chunks} target={args.target_rate}/s backend={sse_encoder.SSE_JSON_BACKEND}")
+    for name, fn in (('dict', dict_path), ('encoder', encoder_path)):
+        start = time.process_time()
+        fn(texts)
+        cpu = time.process_time() - start
+        rate = args.chunks / cpu
+        print(f"{name:<8} {rate:12,.0f} chunks/s  {cpu / args.chunks * 1e6:6.2f}us/chunk  "
+              f"core share at target={args.target_rate / rate * 100:6.1f}%")
+
+
+if __name__ == '__main__':
+    main()
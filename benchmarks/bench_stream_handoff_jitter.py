@@ -0,0 +1,132 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Token inter-arrival jitter across concurrent streams
+
+Every stream has a producer thread (standing in for the agent thread) that emits
+one token every `--interval-ms` after a random start offset, pausing once for up
+to `--pause-ms` mid-stream like a tool call would, and an async consumer on the shared event loop
+(standing in for the SSE generator in process_query_stream). Two handoffs are
+compared:
+
+  blocking  - queue.Queue.get(timeout=1) called from the async consumer
+              (the previous behaviour, blocks the whole loop while empty)
+  channel   - stream_channel.StreamChannel, the consumer awaits the next item
+
+Reported per mode: delivery latency (token produced -> token consumed) and
+inter-arrival jitter as in RFC 3550, i.e. the difference in delivery latency of
+consecutive tokens of a stream, across all tokens of all streams.
+
+Usage:
+    python benchmarks/bench_stream_handoff_jitter.py --streams 100 --tokens 50 --interval-ms 20
+"""
+import os
+import sys
+import time
+import queue
+import random
+import asyncio
+import argparse
+import threading
+import statistics
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from stream_channel import StreamChannel
+
+END = object()
+
+
+def produce(put, tokens: int, interval: float, pause: float, seed: int):
+    rng = random.Random(seed)
+    time.sleep(rng.uniform(0, interval))
+    pause_at = rng.randrange(tokens)
+    for i in range(tokens):
+        time.sleep(interval)
+        if i == pause_at:
+            time.sleep(rng.uniform(0, pause))
+        put(time.perf_counter())
+    put(END)
+
+
+async def consume_blocking(stream_queue: queue.Queue, transits: list, latencies: list):
+    while True:
+        try:
+            item = stream_queue.get(timeout=1)
+        except queue.Empty:
+            await asyncio.sleep(0.01)
+            continue
+        if item is END:
+            return
+        transit = time.perf_counter() - item
+        transits.append(transit)
+        latencies.append(transit)
+        await asyncio.sleep(0)
+
+
+async def consume_channel(channel: StreamChannel, transits: list, latencies: list):
+    while True:
+        item = await channel.get()
+        if item is END:
+            return
+        transit = time.perf_counter() - item
+        transits.append(transit)
+        latencies.append(transit)
+
+
+async def run(mode: str, streams: int, tokens: int, interval: float, pause: float):
+    consumers, threads, all_transits, latencies = [], [], [], []
+    for index in range(streams):
+        transits = []
+        all_transits.append(transits)
+        if mode == 'blocking':
+            stream_queue = queue.Queue()
+            put = stream_queue.put
+            consumers.append(consume_blocking(stream_queue, transits, latencies))
+        else:
+            channel = StreamChannel()
+            put = channel.put
+            consumers.append(consume_channel(channel, transits, latencies))
+        threads.append(threading.Thread(target=produce, args=(put, tokens, interval, pause, index), daemon=True))
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    await asyncio.gather(*consumers)
+    elapsed = time.perf_counter() - started
+    jitter = [abs(b - a) for transits in all_transits for a, b in zip(transits, transits[1:])]
+    return elapsed, latencies, jitter
+
+
+def percentile(values: list, pct: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * pct))]
+
+
+def report(mode: str, elapsed: float, latencies: list, jitter: list):
+    lat_ms = [v * 1000 for v in latencies]
+    jit_ms = [v * 1000 for v in jitter]
+    print(f"{mode:<9} wall={elapsed:6.2f}s  latency mean={statistics.mean(lat_ms):8.2f}ms "
+          f"p99={percentile(lat_ms, 0.99):8.2f}ms  jitter mean={statistics.mean(jit_ms):8.2f}ms "
+          f"p99={percentile(jit_ms, 0.99):8.2f}ms max={max(jit_ms):8.2f}ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--streams', type=int, default=100, help="concurrent streams")
+    parser.add_argument('--tokens', type=int, default=50, help="tokens per stream")
+    parser.add_argument('--interval-ms', type=float, default=20.0, help="producer token interval")
+    parser.add_argument('--pause-ms', type=float, default=500.0, help="longest mid-stream pause, e.g. a tool call")
+    parser.add_argument('--modes', default='blocking,channel')
+    args = parser.parse_args()
+
+    print(f"streams={args.streams} tokens={args.tokens} interval={args.interval_ms}ms pause<={args.pause_ms}ms")
+    for mode in args.modes.split(','):
+        elapsed, latencies, jitter = asyncio.run(run(mode, args.streams, args.tokens, args.interval_ms / 1000,
+                                                        args.pause_ms / 1000))
+        report(mode, elapsed, latencies, jitter)
+
+
+if __name__ == '__main__':
+    main()
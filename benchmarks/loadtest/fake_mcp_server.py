@@ -0,0 +1,49 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Fake MCP server with tunable tool latency
+
+Serves one tool, `fake_search(query)`, which sleeps --latency-ms (plus up to
+--jitter-ms of seeded random jitter) and returns --result-bytes of text. It is
+the tool the fake model provider (STRANDS_MODEL_PROVIDER=fake) calls.
+
+Usage:
+    python benchmarks/loadtest/fake_mcp_server.py --latency-ms 200                           # stdio
+    python benchmarks/loadtest/fake_mcp_server.py --transport streamable-http --port 8765  # http://127.0.0.1:8765/mcp
+"""
+import random
+import asyncio
+import argparse
+from mcp.server.fastmcp import FastMCP
+
+TEXT = ("Result row with a title, a link and a snippet of the page that matched the query. ") * 8
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--transport', choices=['stdio', 'sse', 'streamable-http'], default='stdio')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency-ms', type=float, default=200, help="time spent in each tool call")
+    parser.add_argument('--jitter-ms', type=float, default=0, help="maximum extra latency per call")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--result-bytes', type=int, default=4096, help="size of the tool result text")
+    args = parser.parse_args()
+
+    server = FastMCP("fake_tools", host=args.host, port=args.port, log_level="WARNING")
+    rng = random.Random(args.seed)
+    result = (TEXT * (args.result_bytes // len(TEXT) + 1))[:args.result_bytes]
+
+    @server.tool()
+    async def fake_search(query: str) -> str:
+        """Search the web for `query` (fake, for load tests)"""
+        await asyncio.sleep((args.latency_ms + rng.random() * args.jitter_ms) / 1000)
+        return result
+
+    server.run(transport=args.transport)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,302 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Offline load test of /v1/chat/completions
+
+Drives the streaming chat endpoint with N concurrent users, each sending
+--requests chats one after the other, and reports per-stream time to first
+token, duration and tokens/s (p50/p99), the overall throughput, and the CPU
+and peak RSS of the server process tree (server, workers and MCP servers,
+read from /proc).
+
+With --spawn-server the server is started locally with the fake model provider
+(STRANDS_MODEL_PROVIDER=fake, see src/fake_model.py) and the fake MCP server
+(fake_mcp_server.py) as a global MCP server, so no network access and no AWS
+credentials are needed. Without it, point --url at a running server and pass
+its pid with --server-pid to get CPU and RSS.
+
+Usage:
+    python benchmarks/loadtest/load_generator.py --spawn-server --users 50 --requests 5
+    python benchmarks/loadtest/load_generator.py --spawn-server --workers 4 --users 200 \\
+        --tokens-per-second 0 --tool-latency-ms 50
+    python benchmarks/loadtest/load_generator.py --url http://127.0.0.1:7002 --server-pid 12345 --users 20
+"""
+import os
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import statistics
+import subprocess
+import aiohttp
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(HERE, '..', '..')
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+
+def percentile(values: list, p: float) -> float:
+    if not values:
+        return float('nan')
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def process_tree(root_pid: int) -> list:
+    """root_pid and all its descendants"""
+    children = {}
+    for entry in os.listdir('/proc'):
+        if not entry.isdigit():
+            continue
+        try:
+            with open(f'/proc/{entry}/stat') as f:
+                ppid = int(f.read().rsplit(')', 1)[1].split()[1])
+        except (OSError, IndexError, ValueError):
+            continue
+        children.setdefault(ppid, []).append(int(entry))
+    pids, stack = [], [root_pid]
+    while stack:
+        pid = stack.pop()
+        pids.append(pid)
+        stack.extend(children.get(pid, []))
+    return pids
+
+
+def tree_usage(root_pid: int) -> tuple:
+    """(CPU seconds, RSS bytes) of the process tree"""
+    cpu, rss = 0.0, 0
+    for pid in process_tree(root_pid):
+        try:
+            with open(f'/proc/{pid}/stat') as f:
+                fields = f.read().rsplit(')', 1)[1].split()
+            with open(f'/proc/{pid}/statm') as f:
+                rss += int(f.read().split()[1]) * PAGE_SIZE
+        except (OSError, IndexError, ValueError):
+            continue
+        # utime and stime, fields 14 and 15 of /proc/<pid>/stat
+        cpu += (int(fields[11]) + int(fields[12])) / CLK_TCK
+    return cpu, rss
+
+
+class ResourceSampler:
+    """Samples the CPU time and RSS of a process tree in the background"""
+
+    def __init__(self, pid: int, interval: float = 0.5):
+        self.pid = pid
+        self.interval = interval
+        self.peak_rss = 0
+        self._task = None
+
+    async def _run(self):
+        while True:
+            _, rss = tree_usage(self.pid)
+            self.peak_rss = max(self.peak_rss, rss)
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self.start_cpu, _ = tree_usage(self.pid)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> dict:
+        self._task.cancel()
+        cpu, rss = tree_usage(self.pid)
+        elapsed = time.perf_counter() - self.start_time
+        return {"cpu_seconds": cpu - self.start_cpu,
+                "cpu_percent": (cpu - self.start_cpu) / elapsed * 100,
+                "peak_rss_mb": max(self.peak_rss, rss) / 1024 / 1024}
+
+
+async def chat(session: aiohttp.ClientSession, args, user_id: str, index: int) -> dict:
+    """Send one streaming chat and time its SSE events"""
+    payload = {
+        "model": args.model,
+        "messages": [{"role": "user", "content": f"{args.prompt} (request {index})"}],
+        "stream": True,
+        "max_tokens": 1024,
+        "temperature": 0.5,
+        "mcp_server_ids": args.mcp_server_ids,
+        "extra_params": {"stage_timings": args.stage_timings},
+    }
+    headers = {"Authorization": f"Bearer {args.api_key}", "X-User-ID": user_id}
+    result = {"status": None, "ttft": None, "duration": None, "tokens": 0, "error": None, "stages": None}
+    start = time.perf_counter()
+    first = last = None
+    try:
+        async with session.post(f"{args.url}/v1/chat/completions", json=payload, headers=headers) as response:
+            result["status"] = response.status
+            if response.status != 200:
+                result["error"] = f"HTTP {response.status}"
+                await response.read()
+                return result
+            async for raw_line in response.content:
+                line = raw_line.decode('utf-8', 'replace').strip()
+                if line.startswith(': stage_timings '):
+                    result["stages"] = json.loads(line[len(': stage_timings '):])["stages"]
+                if not line.startswith('data: ') or line == 'data: [DONE]':
+                    continue
+                choice = json.loads(line[6:])["choices"][0]
+                if choice.get("finish_reason") == "error":
+                    result["error"] = choice.get("delta", {}).get("content", "error")
+                if choice.get("delta", {}).get("content"):
+                    last = time.perf_counter()
+                    first = first or last
+                    result["tokens"] += 1
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        result["error"] = f"{type(e).__name__}: {e}"
+    result["duration"] = time.perf_counter() - start
+    if first is not None:
+        result["ttft"] = first - start
+        if last > first and result["tokens"] > 1:
+            result["tokens_per_second"] = (result["tokens"] - 1) / (last - first)
+    return result
+
+
+async def user_loop(session: aiohttp.ClientSession, args, user_index: int, results: list):
+    user_id = f"{args.user_prefix}{user_index}"
+    for index in range(args.requests):
+        results.append(await chat(session, args, user_id, index))
+
+
+def start_server(args) -> subprocess.Popen:
+    """Start src/main.py with the fake model and the fake MCP server as a global server"""
+    conf = {
+        "models": [{"model_id": args.model, "model_name": "Fake model"}],
+        "mcpServers": {"fake_tools": {"command": sys.executable, "args": [
+            os.path.join(HERE, 'fake_mcp_server.py'), "--latency-ms", str(args.tool_latency_ms),
+            "--jitter-ms", str(args.tool_jitter_ms), "--result-bytes", str(args.tool_result_bytes)]}},
+    }
+    conf_file = tempfile.NamedTemporaryFile('w', suffix='.json', prefix='loadtest-', delete=False)
+    json.dump(conf, conf_file)
+    conf_file.close()
+    args.conf_path = conf_file.name
+    env = {
+        **os.environ,
+        "API_KEY": args.api_key,
+        "STRANDS_MODEL_PROVIDER": "fake",
+        "FAKE_MODEL_FIRST_TOKEN_MS": str(args.first_token_ms),
+        "FAKE_MODEL_TOKENS_PER_SECOND": str(args.tokens_per_second),
+        "FAKE_MODEL_OUTPUT_TOKENS": str(args.output_tokens),
+        "FAKE_MODEL_TOOL_CALLS": str(args.tool_calls),
+        "SERVER_LIMIT_MAX_REQUESTS": "0",
+        "CHAT_MAX_CONCURRENT_STREAMS": str(max(args.users, 1)),
+        "CHAT_MAX_STREAMS_PER_USER": "1",
+        "ENABLE_STRANDS_BUILTIN_TOOLS": "false",
+        "ddb_table": "",
+        "STAGE_TIMING_SAMPLE_RATE": "0",
+    }
+    log = open(args.server_log, 'w')
+    port = args.url.rsplit(':', 1)[1].split('/')[0]
+    return subprocess.Popen([sys.executable, 'src/main.py', '--mcp-conf', conf_file.name, '--port', port,
+                             '--workers', str(args.workers)],
+                            cwd=ROOT, env=env, stdout=log, stderr=subprocess.STDOUT)
+
+
+async def wait_ready(url: str, process: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    async with aiohttp.ClientSession() as session:
+        while time.monotonic() < deadline:
+            if process.poll() is not None:
+                raise RuntimeError(f"server exited with status {process.returncode}")
+            try:
+                async with session.get(f"{url}/health") as response:
+                    if response.status == 200:
+                        return
+            except aiohttp.ClientError:
+                pass
+            await asyncio.sleep(0.5)
+    raise RuntimeError(f"server not ready after {timeout}s")
+
+
+def report(args, results: list, elapsed: float, resources: dict):
+    ok = [r for r in results if r["error"] is None and r["ttft"] is not None]
+    rejected = sum(1 for r in results if r["status"] == 429)
+    errors = len(results) - len(ok) - rejected
+    ttft = [r["ttft"] * 1000 for r in ok]
+    durations = [r["duration"] * 1000 for r in ok]
+    rates = [r["tokens_per_second"] for r in ok if "tokens_per_second" in r]
+    tokens = sum(r["tokens"] for r in ok)
+
+    print(f"users={args.users} requests/user={args.requests} workers={args.workers} model={args.model} "
+          f"elapsed={elapsed:.1f}s")
+    print(f"completed={len(ok)} rejected(429)={rejected} errors={errors} "
+          f"throughput={len(ok) / elapsed:.2f} req/s, {tokens / elapsed:.0f} tokens/s")
+    print(f"{'metric':<20} {'p50':>10} {'p99':>10} {'mean':>10} {'max':>10}")
+    for name, values in (("ttft ms", ttft), ("duration ms", durations), ("stream tokens/s", rates)):
+        if values:
+            print(f"{name:<20} {percentile(values, 50):10.1f} {percentile(values, 99):10.1f} "
+                  f"{statistics.mean(values):10.1f} {max(values):10.1f}")
+    stages = [r["stages"] for r in ok if r["stages"]]
+    if stages:
+        print(f"{'stage (p50 ms)':<28} " + " ".join(f"{name}={percentile([s.get(name, 0) for s in stages], 50):.1f}"
+                                                    for name in stages[0]))
+    if resources:
+        print(f"server cpu={resources['cpu_seconds']:.1f}s ({resources['cpu_percent']:.0f}% of one core) "
+              f"peak rss={resources['peak_rss_mb']:.0f} MB")
+    for error in sorted({r["error"] for r in results if r["error"]})[:5]:
+        print(f"error: {error[:200]}")
+
+
+async def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', default='http://127.0.0.1:7102')
+    parser.add_argument('--api-key', default=os.environ.get('API_KEY', 'loadtest'))
+    parser.add_argument('--users', type=int, default=20, help="concurrent users")
+    parser.add_argument('--requests', type=int, default=5, help="chats per user, sent sequentially")
+    parser.add_argument('--user-prefix', default='loadtest-user-')
+    parser.add_argument('--model', default='fake-model')
+    parser.add_argument('--prompt', default='Summarize the latest market news')
+    parser.add_argument('--mcp-server-ids', nargs='*', default=['fake_tools'])
+    parser.add_argument('--stage-timings', action='store_true', help="request and report the per-stage latency")
+    parser.add_argument('--timeout', type=float, default=300, help="timeout of one chat in seconds")
+    parser.add_argument('--server-pid', type=int, help="pid of an already running server, for CPU and RSS")
+    parser.add_argument('--spawn-server', action='store_true', help="start the server with the fake model")
+    parser.add_argument('--workers', type=int, default=1)
+    parser.add_argument('--server-log', default=os.path.join(tempfile.gettempdir(), 'loadtest-server.log'))
+    # fake model and tool behaviour, only used with --spawn-server
+    parser.add_argument('--first-token-ms', type=float, default=300)
+    parser.add_argument('--tokens-per-second', type=float, default=80, help="0 = as fast as possible")
+    parser.add_argument('--output-tokens', type=int, default=200)
+    parser.add_argument('--tool-calls', type=int, default=1)
+    parser.add_argument('--tool-latency-ms', type=float, default=200)
+    parser.add_argument('--tool-jitter-ms', type=float, default=0)
+    parser.add_argument('--tool-result-bytes', type=int, default=4096)
+    args = parser.parse_args()
+
+    process = None
+    if args.spawn_server:
+        process = start_server(args)
+        await wait_ready(args.url, process)
+        args.server_pid = process.pid
+    try:
+        sampler = ResourceSampler(args.server_pid) if args.server_pid else None
+        timeout = aiohttp.ClientTimeout(total=args.timeout)
+        connector = aiohttp.TCPConnector(limit=0)
+        async with aiohttp.ClientSession(timeout=timeout, connector=connector) as session:
+            # one warm-up chat per user, so session and MCP server setup is not measured
+            await asyncio.gather(*(chat(session, args, f"{args.user_prefix}{i}", -1) for i in range(args.users)))
+            results = []
+            if sampler:
+                sampler.start()
+            start = time.perf_counter()
+            await asyncio.gather(*(user_loop(session, args, i, results) for i in range(args.users)))
+            elapsed = time.perf_counter() - start
+            resources = await sampler.stop() if sampler else None
+        report(args, results, elapsed, resources)
+    finally:
+        if process:
+            process.terminate()
+            try:
+                process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+            os.unlink(args.conf_path)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())
@@ -82,6 +82,8 @@ export class EcsFargateStack extends cdk.Stack {
       },
       // 添加 server_id 作为属性而非排序键，除非您的应用真的需要复合主键
       billingMode: dynamodb.BillingMode.PAY_PER_REQUEST,
+      // 过期的流取消标记由TTL删除
+      timeToLiveAttribute: 'expireAt',
       pointInTimeRecovery: true,
       removalPolicy: cdk.RemovalPolicy.DESTROY, // For demo purposes
     });
@@ -0,0 +1,175 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Admission control for chat streams
+
+A chat stream is admitted only if the user is below the per-user stream cap and
+the instance is below the global stream cap. When the instance is full, requests
+wait in a bounded FIFO queue for at most a deadline. Requests that cannot be
+served are rejected immediately with 429 (user over its cap) or 503 (instance
+saturated) and a Retry-After header, so an overloaded instance sheds load
+predictably instead of letting every request time out. Only the chat endpoint
+goes through the controller; stop, list and health requests are never queued.
+"""
+import os
+import asyncio
+import logging
+from collections import deque
+from typing import Any, Deque, Dict, Tuple
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
+)
+logger = logging.getLogger(__name__)
+
+# 本实例同时运行的对话流上限
+CHAT_MAX_CONCURRENT_STREAMS = int(os.environ.get("CHAT_MAX_CONCURRENT_STREAMS", 64))
+# 每个用户同时运行(含排队)的对话流上限
+CHAT_MAX_STREAMS_PER_USER = int(os.environ.get("CHAT_MAX_STREAMS_PER_USER", 2))
+# 等待队列长度及最长等待时间(秒)
+CHAT_ADMISSION_QUEUE_SIZE = int(os.environ.get("CHAT_ADMISSION_QUEUE_SIZE", 128))
+CHAT_ADMISSION_TIMEOUT = float(os.environ.get("CHAT_ADMISSION_TIMEOUT", 10))
+# 拒绝时建议客户端的重试间隔(秒)
+CHAT_RETRY_AFTER = int(os.environ.get("CHAT_RETRY_AFTER", 5))
+
+
+class AdmissionRejected(Exception):
+    """Raised when a request is not admitted"""
+
+    def __init__(self, status_code: int, reason: str, retry_after: int = CHAT_RETRY_AFTER):
+        super().__init__(reason)
+        self.status_code = status_code
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionTicket:
+    """A granted slot, release() is idempotent"""
+
+    def __init__(self, controller: "AdmissionController", user_id: str):
+        self._controller = controller
+        self.user_id = user_id
+        self._released = False
+
+    def release(self):
+        if not self._released:
+            self._released = True
+            self._controller._release(self.user_id)
+
+
+class AdmissionController:
+    """
+    Per-user and global concurrency caps with a bounded, deadline-limited wait queue
+
+    All methods must be called from the server event loop.
+    """
+
+    def __init__(self, max_concurrent: int = CHAT_MAX_CONCURRENT_STREAMS,
+                 max_per_user: int = CHAT_MAX_STREAMS_PER_USER,
+                 queue_size: int = CHAT_ADMISSION_QUEUE_SIZE,
+                 timeout: float = CHAT_ADMISSION_TIMEOUT,
+                 retry_after: int = CHAT_RETRY_AFTER):
+        self.max_concurrent = max_concurrent
+        self.max_per_user = max_per_user
+        self.queue_size = queue_size
+        self.timeout = timeout
+        self.retry_after = retry_after
+        self.active = 0
+        self._per_user: Dict[str, int] = {}
+        self._waiters: Deque[Tuple[str, asyncio.Future]] = deque()
+        self.admitted = 0
+        self.rejected_user = 0
+        self.rejected_busy = 0
+        self.timed_out = 0
+
+    async def acquire(self, user_id: str) -> AdmissionTicket:
+        """
+        Admit a chat stream of `user_id`
+
+        Returns:
+            AdmissionTicket, release it when the stream ends
+
+        Raises:
+            AdmissionRejected: 429 if the user is over its cap, 503 if the instance
+                is saturated or the queue deadline passed
+        """
+        if self._per_user.get(user_id, 0) >= self.max_per_user:
+            self.rejected_user += 1
+            raise AdmissionRejected(429, f"Too many concurrent streams for user, limit {self.max_per_user}",
+                                    self.retry_after)
+        if self.active < self.max_concurrent and not self._waiters:
+            return self._grant(user_id)
+        if len(self._waiters) >= self.queue_size:
+            self.rejected_busy += 1
+            raise AdmissionRejected(503, "Server is busy, please retry later", self.retry_after)
+
+        # 排队期间也占用用户的名额，避免单个用户占满队列
+        self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append((user_id, waiter))
+        try:
+            await asyncio.wait_for(waiter, timeout=self.timeout)
+        except asyncio.TimeoutError:
+            if not (waiter.done() and not waiter.cancelled()):
+                self.timed_out += 1
+                self._drop_waiter(user_id, waiter)
+                raise AdmissionRejected(503, "Server is busy, admission queue timed out", self.retry_after)
+            # 超时的同时名额已经分配，按准入处理
+        except asyncio.CancelledError:
+            # 客户端断开: 若名额已经分配则交还
+            if waiter.done() and not waiter.cancelled():
+                self._release(user_id)
+            else:
+                self._drop_waiter(user_id, waiter)
+            raise
+        self.admitted += 1
+        return AdmissionTicket(self, user_id)
+
+    def _grant(self, user_id: str) -> AdmissionTicket:
+        self.active += 1
+        self._per_user[user_id] = self._per_user.get(user_id, 0) + 1
+        self.admitted += 1
+        return AdmissionTicket(self, user_id)
+
+    def _decrement_user(self, user_id: str):
+        count = self._per_user.get(user_id, 0) - 1
+        if count > 0:
+            self._per_user[user_id] = count
+        else:
+            self._per_user.pop(user_id, None)
+
+    def _drop_waiter(self, user_id: str, waiter: asyncio.Future):
+        try:
+            self._waiters.remove((user_id, waiter))
+        except ValueError:
+            pass
+        self._decrement_user(user_id)
+
+    def _release(self, user_id: str):
+        self._decrement_user(user_id)
+        self.active -= 1
+        # 把空出的名额直接交给队首仍在等待的请求
+        while self._waiters and self.active < self.max_concurrent:
+            waiter_user, waiter = self._waiters.popleft()
+            if waiter.done():
+                continue
+            self.active += 1
+            waiter.set_result(None)
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "active": self.active,
+            "queued": len(self._waiters),
+            "max_concurrent": self.max_concurrent,
+            "max_per_user": self.max_per_user,
+            "admitted": self.admitted,
+            "rejected_user_limit": self.rejected_user,
+            "rejected_busy": self.rejected_busy,
+            "timed_out": self.timed_out,
+        }
+
+
+chat_admission = AdmissionController()
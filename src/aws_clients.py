@@ -0,0 +1,171 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Process-wide registry of boto3 sessions, clients and client-backed objects
+
+Creating a boto3 Session resolves credentials, and every client it creates
+loads service models and owns its own connection pool. Building them per
+request means repeated credential resolution and new TLS handshakes, so all
+call sites share the instances kept here. Sessions are keyed by region and
+credentials, clients additionally by service and client config.
+"""
+import os
+import hashlib
+import logging
+import threading
+from typing import Any, Callable, Dict, Hashable, Optional, Tuple
+import boto3
+from botocore.config import Config
+from ttl_cache import TTLCache
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
+)
+logger = logging.getLogger(__name__)
+
+# 每个botocore client的HTTP连接池大小(botocore默认只有10)
+AWS_MAX_POOL_CONNECTIONS = int(os.environ.get("AWS_MAX_POOL_CONNECTIONS", 50))
+# 缓存的client对象(如BedrockModel)的过期时间(秒)
+AWS_CLIENT_CACHE_TTL = float(os.environ.get("AWS_CLIENT_CACHE_TTL", 3600))
+
+
+def _credentials_key(aws_access_key_id: Optional[str], aws_secret_access_key: Optional[str]) -> Tuple:
+    # 不在key中保留明文secret
+    if not aws_access_key_id:
+        return ()
+    digest = hashlib.sha256((aws_secret_access_key or '').encode()).hexdigest()
+    return (aws_access_key_id, digest)
+
+
+class AWSClientRegistry:
+    """
+    Shared boto3 sessions and clients
+
+    boto3 sessions are not thread safe, so creation is serialized by a lock;
+    the created clients are thread safe and are shared by every request.
+    """
+
+    def __init__(self, max_pool_connections: int = AWS_MAX_POOL_CONNECTIONS, object_ttl: float = AWS_CLIENT_CACHE_TTL):
+        self.max_pool_connections = max_pool_connections
+        self._sessions: Dict[Tuple, boto3.Session] = {}
+        self._clients: Dict[Tuple, Any] = {}
+        self._objects = TTLCache(ttl=object_ttl, max_size=256, name="aws_objects")
+        self._lock = threading.RLock()
+
+    def get_session(self, region_name: Optional[str] = None, aws_access_key_id: Optional[str] = None,
+                    aws_secret_access_key: Optional[str] = None) -> boto3.Session:
+        """
+        Return the shared session for a region and credentials
+
+        Without an access key the default credential chain is used, which
+        refreshes temporary credentials by itself.
+        """
+        key = (region_name, _credentials_key(aws_access_key_id, aws_secret_access_key))
+        session = self._sessions.get(key)
+        if session is not None:
+            return session
+        with self._lock:
+            session = self._sessions.get(key)
+            if session is None:
+                if aws_access_key_id:
+                    session = boto3.Session(
+                        aws_access_key_id=aws_access_key_id,
+                        aws_secret_access_key=aws_secret_access_key,
+                        region_name=region_name
+                    )
+                else:
+                    session = boto3.Session(region_name=region_name)
+                self._sessions[key] = session
+                logger.info(f"Created boto3 session for region {region_name}")
+            return session
+
+    def client_config(self, **kwargs) -> Config:
+        """botocore Config with the shared connection pool size applied"""
+        kwargs.setdefault('max_pool_connections', self.max_pool_connections)
+        return Config(**kwargs)
+
+    def get_client(self, service_name: str, region_name: Optional[str] = None,
+                   aws_access_key_id: Optional[str] = None, aws_secret_access_key: Optional[str] = None,
+                   **config_kwargs) -> Any:
+        """
+        Return the shared botocore client of a service
+
+        Args:
+            service_name: e.g. 'secretsmanager'
+            region_name: AWS region
+            aws_access_key_id: Optional static credentials
+            aws_secret_access_key: Optional static credentials
+            **config_kwargs: botocore Config options, part of the cache key
+
+        Returns:
+            botocore client
+        """
+        key = (service_name, region_name, _credentials_key(aws_access_key_id, aws_secret_access_key),
+               tuple(sorted((k, repr(v)) for k, v in config_kwargs.items())))
+        client = self._clients.get(key)
+        if client is not None:
+            return client
+        session = self.get_session(region_name, aws_access_key_id, aws_secret_access_key)
+        with self._lock:
+            client = self._clients.get(key)
+            if client is None:
+                client = session.client(service_name, region_name=region_name,
+                                        config=self.client_config(**config_kwargs))
+                self._clients[key] = client
+            return client
+
+    def create_resource(self, service_name: str, region_name: Optional[str] = None,
+                        endpoint_url: Optional[str] = None, **config_kwargs) -> Any:
+        """
+        Create a boto3 resource on the shared session of the region
+
+        Resources are not thread safe and are not cached here, callers that
+        use them from several threads keep one per thread.
+
+        Args:
+            service_name: e.g. 'dynamodb'
+            region_name: AWS region
+            endpoint_url: Optional endpoint, e.g. DynamoDB Local
+            **config_kwargs: botocore Config options
+
+        Returns:
+            boto3 resource
+        """
+        session = self.get_session(region_name)
+        with self._lock:
+            return session.resource(service_name, region_name=region_name, endpoint_url=endpoint_url,
+                                    config=self.client_config(**config_kwargs))
+
+    def get_or_create(self, key: Hashable, factory: Callable[[], Any]) -> Any:
+        """
+        Return a cached object built on top of the shared clients, e.g. a BedrockModel
+
+        Args:
+            key: Cache key, must cover every argument passed to the factory
+            factory: Builds the object on a miss
+
+        Returns:
+            The cached or newly created object
+        """
+        obj = self._objects.get(key)
+        if obj is not None:
+            return obj
+        with self._lock:
+            obj = self._objects.get(key)
+            if obj is None:
+                obj = factory()
+                self._objects.set(key, obj)
+            return obj
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "sessions": len(self._sessions),
+            "clients": len(self._clients),
+            "objects": self._objects.stats(),
+        }
+
+
+aws_client_registry = AWSClientRegistry()
@@ -0,0 +1,313 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Content-addressed store for chat attachments
+
+Attachment bytes (images, documents) are stored once under their SHA-256 digest
+and messages only carry a reference:
+
+    {"image": {"format": "png", "source": {"blobRef": "sha256:<hex>"}}}
+
+Identical uploads map to the same blob. `materialize_attachments` swaps the
+references of a message list (tool results included) for the bytes right
+before the agent is built, and `externalize_attachments` swaps them back
+before the history is saved, so the stored history never contains attachment
+bytes.
+
+BLOB_STORE=local keeps blobs under BLOB_STORE_DIR; BLOB_STORE=s3 keeps them in
+BLOB_STORE_BUCKET (any S3 compatible endpoint via BLOB_STORE_ENDPOINT_URL).
+"""
+import os
+import abc
+import asyncio
+import hashlib
+import logging
+import tempfile
+from typing import AsyncIterator, List, Optional, Tuple
+from botocore.exceptions import ClientError
+from aws_clients import aws_client_registry
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
+)
+logger = logging.getLogger(__name__)
+
+BLOB_STORE = os.environ.get("BLOB_STORE", "local").lower()
+BLOB_STORE_DIR = os.environ.get("BLOB_STORE_DIR", "blobs")
+BLOB_STORE_BUCKET = os.environ.get("BLOB_STORE_BUCKET", "")
+BLOB_STORE_PREFIX = os.environ.get("BLOB_STORE_PREFIX", "blobs/")
+BLOB_STORE_ENDPOINT_URL = os.environ.get("BLOB_STORE_ENDPOINT_URL")
+
+BLOB_REF_PREFIX = "sha256:"
+
+
+class BlobTooLarge(ValueError):
+    """Raised by put_stream when the stream exceeds max_bytes"""
+
+
+def blob_ref(data: bytes) -> str:
+    return BLOB_REF_PREFIX + hashlib.sha256(data).hexdigest()
+
+
+def _digest(ref: str) -> str:
+    digest = ref[len(BLOB_REF_PREFIX):] if ref.startswith(BLOB_REF_PREFIX) else ref
+    if len(digest) != 64 or any(c not in "0123456789abcdef" for c in digest):
+        raise ValueError(f"invalid blob reference: {ref}")
+    return digest
+
+
+class BlobStore(abc.ABC):
+    """Interface of the blob stores, all methods are safe to await from any event loop"""
+
+    @abc.abstractmethod
+    async def put(self, data: bytes) -> str:
+        """Store `data` (no-op if already stored) and return its reference"""
+
+    @abc.abstractmethod
+    async def get(self, ref: str) -> bytes:
+        ...
+
+    @abc.abstractmethod
+    async def exists(self, ref: str) -> bool:
+        ...
+
+    def _staging_dir(self) -> Optional[str]:
+        return None
+
+    @abc.abstractmethod
+    def _store_file(self, ref: str, path: str):
+        """Move the staged file `path` to the blob `ref`"""
+
+    async def put_stream(self, chunks: AsyncIterator[bytes], max_bytes: Optional[int] = None) -> Tuple[str, int]:
+        """
+        Store a stream of chunks without holding it in memory
+
+        The chunks are hashed while they are spooled to a staging file, which is
+        then moved to its content address.
+
+        Returns:
+            (reference, size in bytes)
+
+        Raises:
+            BlobTooLarge: the stream is longer than max_bytes
+        """
+        staging_dir = self._staging_dir()
+        if staging_dir:
+            os.makedirs(staging_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=staging_dir, prefix=".upload-")
+        digest = hashlib.sha256()
+        size = 0
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                async for chunk in chunks:
+                    size += len(chunk)
+                    if max_bytes is not None and size > max_bytes:
+                        raise BlobTooLarge(f"upload exceeds {max_bytes} bytes")
+                    digest.update(chunk)
+                    await asyncio.to_thread(f.write, chunk)
+            ref = BLOB_REF_PREFIX + digest.hexdigest()
+            await asyncio.to_thread(self._store_file, ref, tmp_path)
+            return ref, size
+        finally:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+
+
+class LocalBlobStore(BlobStore):
+    """Blobs as files `<root>/<2 hex>/<64 hex>`, written atomically"""
+
+    def __init__(self, root: str = BLOB_STORE_DIR):
+        self.root = root
+
+    def _path(self, ref: str) -> str:
+        digest = _digest(ref)
+        return os.path.join(self.root, digest[:2], digest)
+
+    def _write(self, ref: str, data: bytes):
+        path = self._path(ref)
+        if os.path.exists(path):
+            return
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".tmp-")
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.unlink(tmp_path)
+            raise
+
+    def _read(self, ref: str) -> bytes:
+        with open(self._path(ref), 'rb') as f:
+            return f.read()
+
+    def _staging_dir(self) -> Optional[str]:
+        # 与blob在同一个文件系统上, 才能用os.replace原子地移动
+        return os.path.join(self.root, ".staging")
+
+    def _store_file(self, ref: str, path: str):
+        target = self._path(ref)
+        if os.path.exists(target):
+            return
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        os.replace(path, target)
+
+    async def put(self, data: bytes) -> str:
+        ref = blob_ref(data)
+        await asyncio.to_thread(self._write, ref, data)
+        return ref
+
+    async def get(self, ref: str) -> bytes:
+        return await asyncio.to_thread(self._read, ref)
+
+    async def exists(self, ref: str) -> bool:
+        return os.path.exists(self._path(ref))
+
+
+class S3BlobStore(BlobStore):
+    """Blobs as objects `<prefix><64 hex>` of an S3 (compatible) bucket"""
+
+    def __init__(self, bucket: str = BLOB_STORE_BUCKET, prefix: str = BLOB_STORE_PREFIX,
+                 endpoint_url: Optional[str] = BLOB_STORE_ENDPOINT_URL):
+        self.bucket = bucket
+        self.prefix = prefix
+        self.region_name = os.environ.get('AWS_REGION', 'us-east-1')
+        self.endpoint_url = endpoint_url
+
+    @property
+    def _client(self):
+        return aws_client_registry.get_or_create(
+            ('blob_store_s3', self.region_name, self.endpoint_url),
+            lambda: aws_client_registry.get_session(self.region_name).client(
+                's3', region_name=self.region_name, endpoint_url=self.endpoint_url,
+                config=aws_client_registry.client_config()))
+
+    def _key(self, ref: str) -> str:
+        return self.prefix + _digest(ref)
+
+    def _exists(self, ref: str) -> bool:
+        try:
+            self._client.head_object(Bucket=self.bucket, Key=self._key(ref))
+            return True
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return False
+            raise
+
+    def _write(self, ref: str, data: bytes):
+        if not self._exists(ref):
+            self._client.put_object(Bucket=self.bucket, Key=self._key(ref), Body=data)
+
+    def _read(self, ref: str) -> bytes:
+        return self._client.get_object(Bucket=self.bucket, Key=self._key(ref))['Body'].read()
+
+    def _store_file(self, ref: str, path: str):
+        # upload_file switches to multipart upload for large files
+        if not self._exists(ref):
+            self._client.upload_file(path, self.bucket, self._key(ref))
+
+    async def put(self, data: bytes) -> str:
+        ref = blob_ref(data)
+        await asyncio.to_thread(self._write, ref, data)
+        return ref
+
+    async def get(self, ref: str) -> bytes:
+        return await asyncio.to_thread(self._read, ref)
+
+    async def exists(self, ref: str) -> bool:
+        return await asyncio.to_thread(self._exists, ref)
+
+
+def create_blob_store(backend: str = BLOB_STORE) -> BlobStore:
+    if backend == 's3':
+        if BLOB_STORE_BUCKET:
+            return S3BlobStore()
+        logger.warning("BLOB_STORE_BUCKET is not set, storing attachments on the local filesystem")
+    return LocalBlobStore()
+
+
+blob_store = create_blob_store()
+
+
+class BlobBytes(bytes):
+    """Attachment bytes loaded from the blob `ref`, so saving them again needs neither a hash nor a put"""
+
+    def __new__(cls, data: bytes, ref: str):
+        blob = super().__new__(cls, data)
+        blob.ref = ref
+        return blob
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+def _content_attachment_blocks(content, blocks: list):
+    if not isinstance(content, list):
+        return
+    for block in content:
+        if not isinstance(block, dict):
+            continue
+        for kind in ('image', 'document', 'video'):
+            attachment = block.get(kind)
+            if isinstance(attachment, dict) and isinstance(attachment.get('source'), dict):
+                blocks.append((block, kind, attachment['source']))
+        # 工具返回的截图等附件在toolResult.content中
+        tool_result = block.get('toolResult')
+        if isinstance(tool_result, dict):
+            _content_attachment_blocks(tool_result.get('content'), blocks)
+
+
+def _attachment_blocks(messages: list) -> List[Tuple[dict, str, dict]]:
+    """(block, kind, source) of the image/document/video blocks of `messages`, including tool results"""
+    blocks = []
+    for message in messages:
+        _content_attachment_blocks(message.get('content'), blocks)
+    return blocks
+
+
+async def externalize_attachments(messages: list, store: Optional[BlobStore] = None) -> list:
+    """Replace attachment bytes in `messages` by blob references, in place"""
+    store = store or blob_store
+    for _, _, source in _attachment_blocks(messages):
+        data = source.get('bytes')
+        if isinstance(data, BlobBytes):
+            # 从blob store加载的附件已经存储过
+            ref = data.ref
+        elif isinstance(data, (bytes, bytearray)):
+            ref = await store.put(bytes(data))
+        else:
+            continue
+        source.pop('bytes')
+        source['blobRef'] = ref
+    return messages
+
+
+async def materialize_attachments(messages: list, store: Optional[BlobStore] = None) -> list:
+    """
+    Replace blob references in `messages` by the attachment bytes, in place
+
+    The bytes are `BlobBytes` carrying their reference, since the model request
+    cannot carry extra keys. A block whose blob cannot be loaded is replaced by a
+    text placeholder, so the model request stays valid.
+    """
+    store = store or blob_store
+    blocks = [(block, kind, source) for block, kind, source in _attachment_blocks(messages) if 'blobRef' in source]
+    if not blocks:
+        return messages
+    contents = await asyncio.gather(*(store.get(source['blobRef']) for _, _, source in blocks),
+                                    return_exceptions=True)
+    for (block, kind, source), data in zip(blocks, contents):
+        if isinstance(data, BaseException):
+            logger.error(f"Failed to load attachment {source['blobRef']}: {data}")
+            block.clear()
+            block['text'] = f"[{kind} attachment is no longer available]"
+            continue
+        source['bytes'] = BlobBytes(data, source.pop('blobRef'))
+    return messages
@@ -0,0 +1,207 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Stream cancellation bus
+
+Streams subscribe with a callback when they start and the stop endpoint
+publishes the stream id. The in-process bus delivers directly; the Redis bus
+additionally fans the stop out to every instance over Redis pub/sub, so a stop
+request handled by any instance reaches the stream within milliseconds and no
+stream has to poll the stream record.
+
+Without Redis, the DynamoDB bus carries stops across instances: a stop for a
+stream that is not running locally is written to the DynamoDB table as a cancel
+marker, and one task per process reads the markers of all its running streams
+with a single batch read every STREAM_CANCEL_POLL_INTERVAL seconds.
+
+Select the backend with STREAM_CANCEL_BUS=local|ddb|redis. The default is ddb
+when the DynamoDB table (ddb_table) is configured, local otherwise. For a local
+Redis stand-in run `docker compose --profile redis up redis` and set
+REDIS_URL=redis://localhost:6379/0.
+"""
+import os
+import asyncio
+import logging
+import threading
+from typing import Callable, Dict, Optional
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
+)
+logger = logging.getLogger(__name__)
+
+# 未配置时: 有DynamoDB表则用ddb跨实例传递停止请求, 否则local
+STREAM_CANCEL_BUS = os.environ.get("STREAM_CANCEL_BUS", "ddb" if os.environ.get("ddb_table") else "local").lower()
+# ddb总线检查取消标记的间隔(秒)
+STREAM_CANCEL_POLL_INTERVAL = float(os.environ.get("STREAM_CANCEL_POLL_INTERVAL", 3))
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+STREAM_CANCEL_CHANNEL = os.environ.get("STREAM_CANCEL_CHANNEL", "mcp:stream:cancel")
+
+
+class CancellationBus:
+    """In-process cancellation bus, also the base of the cross-instance backends"""
+
+    def __init__(self):
+        self._subscribers: Dict[str, Callable[[str], None]] = {}
+        self._lock = threading.Lock()
+
+    async def start(self):
+        """Start listening, a no-op for the in-process bus"""
+
+    async def close(self):
+        """Stop listening"""
+
+    def subscribe(self, stream_id: str, callback: Callable[[str], None]):
+        """
+        Call `callback(stream_id)` when a stop for this stream is published
+
+        The callback is invoked on the server event loop and must not block.
+        """
+        with self._lock:
+            self._subscribers[stream_id] = callback
+
+    def unsubscribe(self, stream_id: str):
+        with self._lock:
+            self._subscribers.pop(stream_id, None)
+
+    def _dispatch(self, stream_id: str) -> bool:
+        with self._lock:
+            callback = self._subscribers.get(stream_id)
+        if callback is None:
+            return False
+        try:
+            callback(stream_id)
+        except Exception as e:
+            logger.error(f"Error cancelling stream {stream_id}: {e}")
+        return True
+
+    async def publish(self, stream_id: str) -> bool:
+        """
+        Request a stream to stop
+
+        Returns:
+            True if the stream is running in this instance
+        """
+        return self._dispatch(stream_id)
+
+    def subscriber_count(self) -> int:
+        return len(self._subscribers)
+
+
+class RedisCancellationBus(CancellationBus):
+    """Cancellation bus shared by all instances through Redis pub/sub"""
+
+    def __init__(self, url: str = REDIS_URL, channel: str = STREAM_CANCEL_CHANNEL):
+        super().__init__()
+        import redis.asyncio as aioredis
+        self.url = url
+        self.channel = channel
+        self._redis = aioredis.from_url(url, decode_responses=True)
+        self._listener: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self._listener is None:
+            self._listener = asyncio.create_task(self._listen())
+            logger.info(f"Listening for stream cancellations on {self.url} channel {self.channel}")
+
+    async def _listen(self):
+        while True:
+            pubsub = self._redis.pubsub()
+            try:
+                await pubsub.subscribe(self.channel)
+                async for message in pubsub.listen():
+                    if message.get('type') == 'message':
+                        self._dispatch(message['data'])
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.error(f"Redis cancellation listener failed, reconnecting: {e}")
+                await asyncio.sleep(1)
+            finally:
+                await pubsub.aclose()
+
+    async def close(self):
+        if self._listener:
+            self._listener.cancel()
+            try:
+                await self._listener
+            except asyncio.CancelledError:
+                pass
+            self._listener = None
+        await self._redis.aclose()
+
+    async def publish(self, stream_id: str) -> bool:
+        local = self._dispatch(stream_id)
+        if not local:
+            # the instance running the stream receives it through its listener
+            await self._redis.publish(self.channel, stream_id)
+        return local
+
+
+class DynamoDBCancellationBus(CancellationBus):
+    """Cancellation bus shared by all instances through cancel markers in the DynamoDB table"""
+
+    def __init__(self, interval: float = STREAM_CANCEL_POLL_INTERVAL):
+        super().__init__()
+        self.interval = interval
+        self._poller: Optional[asyncio.Task] = None
+
+    async def start(self):
+        if self._poller is None:
+            self._poller = asyncio.create_task(self._poll())
+            logger.info(f"Polling DynamoDB for stream cancellations every {self.interval}s")
+
+    async def _poll(self):
+        import utils
+        while True:
+            await asyncio.sleep(self.interval)
+            with self._lock:
+                stream_ids = list(self._subscribers)
+            if not stream_ids:
+                continue
+            try:
+                # 一次批量读取本进程所有运行中流的取消标记
+                cancelled = await utils.get_stream_cancellations(stream_ids)
+                for stream_id in cancelled:
+                    logger.info(f"Stream {stream_id} cancelled by another instance")
+                    self._dispatch(stream_id)
+                if cancelled:
+                    await utils.delete_stream_cancellations(cancelled)
+            except Exception as e:
+                logger.error(f"Error polling stream cancellations: {e}")
+
+    async def close(self):
+        if self._poller:
+            self._poller.cancel()
+            try:
+                await self._poller
+            except asyncio.CancelledError:
+                pass
+            self._poller = None
+
+    async def publish(self, stream_id: str) -> bool:
+        local = self._dispatch(stream_id)
+        if not local:
+            # the instance running the stream picks the marker up on its next poll
+            import utils
+            await utils.save_stream_cancellation(stream_id)
+        return local
+
+
+def create_cancellation_bus(backend: str = STREAM_CANCEL_BUS) -> CancellationBus:
+    """Create the configured bus, falling back to the DynamoDB or in-process bus if Redis is unavailable"""
+    if backend == 'redis':
+        try:
+            return RedisCancellationBus()
+        except ImportError:
+            backend = 'ddb' if os.environ.get("ddb_table") else 'local'
+            logger.warning(f"redis package is not installed, using the {backend} cancellation bus")
+    if backend == 'ddb':
+        return DynamoDBCancellationBus()
+    return CancellationBus()
+
+
+cancellation_bus = create_cancellation_bus()
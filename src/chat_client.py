@@ -4,7 +4,8 @@ SPDX-License-Identifier: MIT-0
 """
 import os
 from dotenv import load_dotenv
-from utils import get_user_message,save_user_message,delete_user_message,DDB_TABLE
+from utils import get_user_history,append_user_history,save_user_message,delete_user_message,DDB_TABLE,HISTORY_TAIL_WINDOW
+from blob_store import externalize_attachments
 import pandas as pd
 from constant import *
 load_dotenv()  # load environment variables from .env
@@ -23,25 +24,63 @@ class ChatClient:
         self.system = None
         self.agent = None
         self.user_id = user_id
+        self._history_end = None # 存储中下一条消息的序号, None表示需要整体写入(尚未加载或旧格式)
+        self._persisted_last = None # 最后一条已写入存储的消息对象
+        self._persisted = [] # 已写入存储的消息对象, 最后一条被裁剪掉时用于确定新消息
     
     async def clear_history(self):
         """clear session message of this client"""
         self.messages = []
         self.system = None
+        self._history_end = None
+        self._persisted_last = None
+        self._persisted = []
         if DDB_TABLE:
             await delete_user_message(self.user_id)
+
+    def _unsaved_messages(self):
+        """agent.messages中最后一条已持久化消息之后的消息, 无法确定时返回None"""
+        messages = self.agent.messages
+        if self._history_end is None:
+            return None
+        if self._persisted_last is None:
+            # 尾部窗口内没有可用的消息时, 存储中的历史仍然存在, 只能追加
+            return messages if self._history_end == 0 or HISTORY_TAIL_WINDOW else None
+        for i in range(len(messages) - 1, -1, -1):
+            if messages[i] is self._persisted_last:
+                return messages[i + 1:]
+        if not HISTORY_TAIL_WINDOW:
+            return None
+        # 只加载了最近的消息时整体改写会删除存储中更早的历史, 改为追加最后一条仍在的已持久化消息之后的消息
+        persisted = {id(message) for message in self._persisted}
+        for i in range(len(messages) - 1, -1, -1):
+            if id(messages[i]) in persisted:
+                return messages[i + 1:]
+        return messages
     
     async def save_history(self):
         if self.agent:
             self.messages = self.agent.messages
+            # history中的附件只保留blobRef
+            await externalize_attachments(self.messages)
             if DDB_TABLE:
-                await save_user_message(self.user_id,self.messages)
+                new_messages = self._unsaved_messages()
+                if new_messages == []:
+                    return
+                if new_messages is None or self._history_end == 0:
+                    # 首次写入、旧格式或历史被改写时整体写入
+                    end = await save_user_message(self.user_id, self.messages)
+                else:
+                    end = await append_user_history(self.user_id, new_messages, self._history_end, self.messages)
+                self._history_end = end
+                self._persisted_last = self.messages[-1] if end is not None and self.messages else None
+                self._persisted = list(self.messages) if end is not None else []
             
     async def load_history(self):
         if DDB_TABLE:
-            return await get_user_message(self.user_id)
+            self._history_end, messages = await get_user_history(self.user_id)
+            self._persisted_last = messages[-1] if messages else None
+            self._persisted = list(messages)
+            return messages
         else:
             return self.messages 
-
-            
-    
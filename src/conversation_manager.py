@@ -0,0 +1,162 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Token budget aware conversation manager
+
+The sliding window manager only counts messages, so a few huge tool results can
+overflow the model context while short chats are cut for no reason. This
+manager estimates the tokens of the conversation and, only when it exceeds the
+budget of the model (`max_context_tokens` in conf/config.json minus the output
+and system prompt reservation), reduces it in order of increasing loss:
+
+1. keep only the most recent tool result images
+2. redact the text of old, long tool results
+3. with `summarize` (CONTEXT_SUMMARIZE), replace the oldest messages with a
+   summary written by the model (strands SummarizingConversationManager)
+4. drop the oldest messages (sliding window reduction, tool use/result pairs
+   are kept together)
+"""
+import os
+import json
+import logging
+from typing import Any, Dict, List, Optional
+from strands.agent.conversation_manager import SlidingWindowConversationManager, SummarizingConversationManager
+from strands.types.exceptions import ContextWindowOverflowException
+from utils import maybe_filter_to_n_most_recent_images, maybe_redact_old_text_content
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
+)
+logger = logging.getLogger(__name__)
+
+# 未在conf/config.json中配置max_context_tokens的模型使用的上下文长度
+DEFAULT_MAX_CONTEXT_TOKENS = int(os.environ.get("DEFAULT_MAX_CONTEXT_TOKENS", 128000))
+# 估算有误差，只使用上下文的这一比例
+CONTEXT_BUDGET_RATIO = float(os.environ.get("CONTEXT_BUDGET_RATIO", 0.9))
+# 超出预算时保留的最近tool result图片数，以及完整保留的最近长文本tool result数
+CONTEXT_KEEP_IMAGES = int(os.environ.get("CONTEXT_KEEP_IMAGES", 4))
+CONTEXT_KEEP_TOOL_TEXTS = int(os.environ.get("CONTEXT_KEEP_TOOL_TEXTS", 5))
+# 被截断的tool result保留的字符数
+CONTEXT_REDACT_TEXT_LENGTH = int(os.environ.get("CONTEXT_REDACT_TEXT_LENGTH", 2000))
+# 超出预算时先用模型总结最早的消息再丢弃, 总结是一次同步的模型调用
+CONTEXT_SUMMARIZE = os.environ.get("CONTEXT_SUMMARIZE", "false").lower() == "true"
+
+CHARS_PER_TOKEN = 4
+IMAGE_TOKENS = 1600
+MESSAGE_OVERHEAD_TOKENS = 4
+
+
+def estimate_text_tokens(text: str) -> int:
+    return len(text) // CHARS_PER_TOKEN + 1
+
+
+def _estimate_block_tokens(block: Any) -> int:
+    if not isinstance(block, dict):
+        return estimate_text_tokens(str(block))
+    if "text" in block:
+        return estimate_text_tokens(block["text"])
+    if "image" in block:
+        return IMAGE_TOKENS
+    if "document" in block:
+        data = block["document"].get("source", {}).get("bytes", b"")
+        return len(data) // CHARS_PER_TOKEN + 1
+    if "toolUse" in block:
+        return estimate_text_tokens(json.dumps(block["toolUse"].get("input", {}))) + 10
+    if "toolResult" in block:
+        return sum(_estimate_block_tokens(item) for item in block["toolResult"].get("content", [])) + 10
+    if "json" in block:
+        return estimate_text_tokens(json.dumps(block["json"]))
+    if "reasoningContent" in block:
+        return estimate_text_tokens(block["reasoningContent"].get("reasoningText", {}).get("text", ""))
+    return 0
+
+
+def estimate_message_tokens(message: Dict[str, Any]) -> int:
+    content = message.get("content")
+    if isinstance(content, str):
+        return estimate_text_tokens(content) + MESSAGE_OVERHEAD_TOKENS
+    return sum(_estimate_block_tokens(block) for block in content or []) + MESSAGE_OVERHEAD_TOKENS
+
+
+def estimate_messages_tokens(messages: List[Dict[str, Any]]) -> int:
+    return sum(estimate_message_tokens(message) for message in messages)
+
+
+def context_budget(max_context_tokens: Optional[int], max_tokens: int, system_prompt: str = "") -> int:
+    """Tokens available to the messages of a model request"""
+    context = int((max_context_tokens or DEFAULT_MAX_CONTEXT_TOKENS) * CONTEXT_BUDGET_RATIO)
+    return max(context - max_tokens - estimate_text_tokens(system_prompt or ""), 1024)
+
+
+class TokenBudgetConversationManager(SlidingWindowConversationManager):
+    """Keeps the estimated token count of agent.messages under `budget`"""
+
+    def __init__(self, budget: int, window_size: int = 100, keep_images: int = CONTEXT_KEEP_IMAGES,
+                 keep_tool_texts: int = CONTEXT_KEEP_TOOL_TEXTS,
+                 redact_text_length: int = CONTEXT_REDACT_TEXT_LENGTH,
+                 summarize: bool = CONTEXT_SUMMARIZE):
+        """
+        Args:
+            budget: Maximum estimated tokens of the messages
+            window_size: Maximum number of messages, as for the sliding window manager
+            keep_images: Number of most recent tool result images kept when over budget
+            keep_tool_texts: Number of most recent long tool result texts kept in full when over budget
+            redact_text_length: Characters kept of a redacted tool result text
+            summarize: Summarize the oldest messages with the agent's model before dropping them
+        """
+        super().__init__(window_size=window_size)
+        self.budget = budget
+        self.keep_images = keep_images
+        self.keep_tool_texts = keep_tool_texts
+        self.redact_text_length = redact_text_length
+        self.summarizer = SummarizingConversationManager() if summarize else None
+        self._summarizing = False
+
+    def apply_management(self, agent: Any, *args, summarize: bool = True, **kwargs) -> None:
+        """
+        Args:
+            summarize: False skips the summarization step, e.g. where a blocking model call is not allowed
+        """
+        super().apply_management(agent, *args, **kwargs)
+        messages = agent.messages
+        tokens = estimate_messages_tokens(messages)
+        if tokens <= self.budget:
+            return
+        before = tokens
+
+        maybe_filter_to_n_most_recent_images(messages, images_to_keep=self.keep_images, min_removal_threshold=1)
+        tokens = estimate_messages_tokens(messages)
+        if tokens > self.budget:
+            maybe_redact_old_text_content(messages, window_size=self.keep_tool_texts,
+                                          text_length_threshold=self.redact_text_length)
+            tokens = estimate_messages_tokens(messages)
+
+        # the summary is written by the same agent, whose invocation applies this manager again
+        if tokens > self.budget and summarize and self.summarizer and not self._summarizing:
+            self._summarizing = True
+            try:
+                self.summarizer.reduce_context(agent)
+                tokens = estimate_messages_tokens(agent.messages)
+            except Exception as e:
+                logger.warning(f"Summarizing the conversation failed, dropping the oldest messages instead: {e}")
+            finally:
+                self._summarizing = False
+                # the summarizer restores agent.messages as a new list
+                messages = agent.messages
+
+        # reduce_context truncates the latest tool results or drops the oldest messages
+        while tokens > self.budget and len(messages) > 1:
+            try:
+                self.reduce_context(agent)
+            except ContextWindowOverflowException:
+                break
+            reduced = estimate_messages_tokens(messages)
+            if reduced >= tokens:
+                break
+            tokens = reduced
+
+        logger.info(f"Conversation reduced from ~{before} to ~{tokens} tokens (budget {self.budget}), "
+                    f"{len(messages)} messages left")
@@ -70,7 +70,7 @@ import logging
 import os
 from typing import Any, Dict, List, Optional
 
-import boto3
+from aws_clients import aws_client_registry
 from mem0 import Memory as Mem0Memory
 from mem0 import MemoryClient
 from opensearchpy import AWSV4SignerAuth, RequestsHttpConnection
@@ -309,7 +309,7 @@ class Mem0ServiceClient:
             os.environ["AWS_REGION"] = self.region
 
         # Set up AWS credentials
-        session = boto3.Session()
+        session = aws_client_registry.get_session(region_name=self.region)
         credentials = session.get_credentials()
         auth = AWSV4SignerAuth(credentials, self.region, "aoss")
 
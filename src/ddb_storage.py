@@ -0,0 +1,170 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Non-blocking DynamoDB storage layer
+
+boto3 only offers a synchronous API, so every table operation is offloaded to a
+dedicated, bounded thread pool and awaited from the calling event loop. The pool
+size is the concurrency cap: at most `max_concurrency` requests are in flight,
+extra callers simply wait in the executor queue without blocking the loop.
+"""
+import os
+import math
+import asyncio
+import logging
+import threading
+import functools
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional
+import time
+from boto3.dynamodb.types import TypeDeserializer, TypeSerializer
+from aws_clients import aws_client_registry
+from stage_timer import count_round_trip
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
+)
+logger = logging.getLogger(__name__)
+
+DDB_MAX_CONCURRENCY = int(os.environ.get("DDB_MAX_CONCURRENCY", 32))
+# BatchGetItem每次最多100个key
+DDB_BATCH_GET_SIZE = 100
+# BatchWriteItem每次最多25个item
+DDB_BATCH_WRITE_SIZE = 25
+
+
+class AsyncDDBStorage:
+    """
+    Async facade over a single DynamoDB table
+
+    The coroutine methods mirror the boto3 `Table` API but never run network I/O
+    on the event loop. They can be awaited from any loop (the FastAPI server loop
+    or the per-stream agent loops), since no asyncio primitive is shared.
+    """
+
+    def __init__(self, table_name: str, region_name: Optional[str] = None, endpoint_url: Optional[str] = None,
+                 max_concurrency: int = DDB_MAX_CONCURRENCY, table_factory: Optional[Callable[[], Any]] = None):
+        """
+        Args:
+            table_name: DynamoDB table name
+            region_name: AWS region of the table
+            endpoint_url: Optional endpoint, e.g. DynamoDB Local at http://localhost:8000
+            max_concurrency: Maximum number of concurrent DynamoDB requests
+            table_factory: Optional callable returning a Table-like object, used by
+                benchmarks to plug in a local stand-in
+        """
+        self.table_name = table_name
+        self.region_name = region_name
+        self.endpoint_url = endpoint_url
+        self.max_concurrency = max_concurrency
+        self._table_factory = table_factory or self._create_table
+        self._local = threading.local()
+        self._executor = ThreadPoolExecutor(max_workers=max_concurrency, thread_name_prefix="ddb-io")
+
+    def _create_table(self):
+        # boto3 resources are not thread safe, every worker thread owns its own on the shared session
+        resource = aws_client_registry.create_resource('dynamodb', region_name=self.region_name,
+                                                       endpoint_url=self.endpoint_url)
+        return resource.Table(self.table_name)
+
+    def _get_table(self):
+        table = getattr(self._local, 'table', None)
+        if table is None:
+            table = self._table_factory()
+            self._local.table = table
+        return table
+
+    def _call(self, method_name: str, kwargs: Dict[str, Any]):
+        return getattr(self._get_table(), method_name)(**kwargs)
+
+    async def _run(self, method_name: str, **kwargs) -> Any:
+        count_round_trip()
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(self._call, method_name, kwargs))
+
+    def _batch_write(self, put_items: List[Dict[str, Any]], delete_keys: List[Dict[str, Any]]):
+        # batch_writer splits the requests in BatchWriteItem calls and resends unprocessed items
+        with self._get_table().batch_writer() as batch:
+            for item in put_items:
+                batch.put_item(Item=item)
+            for key in delete_keys:
+                batch.delete_item(Key=key)
+
+    def _batch_get(self, keys: List[Dict[str, Any]], options: Dict[str, Any]) -> List[Dict[str, Any]]:
+        client = self._get_table().meta.client
+        serializer, deserializer = TypeSerializer(), TypeDeserializer()
+        request = {self.table_name: {'Keys': [{k: serializer.serialize(v) for k, v in key.items()} for key in keys],
+                                     **options}}
+        items = []
+        delay = 0.05
+        while request:
+            response = client.batch_get_item(RequestItems=request)
+            for item in response.get('Responses', {}).get(self.table_name, []):
+                items.append({k: deserializer.deserialize(v) for k, v in item.items()})
+            request = response.get('UnprocessedKeys')
+            if request:
+                time.sleep(delay)
+                delay = min(delay * 2, 1.0)
+        return items
+
+    async def put_item(self, item: Dict[str, Any], **kwargs) -> Dict[str, Any]:
+        return await self._run('put_item', Item=item, **kwargs)
+
+    async def get_item(self, key: Dict[str, Any], **kwargs) -> Dict[str, Any]:
+        return await self._run('get_item', Key=key, **kwargs)
+
+    async def update_item(self, key: Dict[str, Any], **kwargs) -> Dict[str, Any]:
+        return await self._run('update_item', Key=key, **kwargs)
+
+    async def delete_item(self, key: Dict[str, Any], **kwargs) -> Dict[str, Any]:
+        return await self._run('delete_item', Key=key, **kwargs)
+
+    async def batch_put_items(self, items: List[Dict[str, Any]]):
+        """Write several items with BatchWriteItem (25 items per request)"""
+        if items:
+            count_round_trip(math.ceil(len(items) / DDB_BATCH_WRITE_SIZE))
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self._executor, self._batch_write, items, [])
+
+    async def batch_delete_items(self, keys: List[Dict[str, Any]]):
+        """Delete several items with BatchWriteItem (25 items per request)"""
+        if keys:
+            count_round_trip(math.ceil(len(keys) / DDB_BATCH_WRITE_SIZE))
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(self._executor, self._batch_write, [], keys)
+
+    async def batch_get_items(self, keys: List[Dict[str, Any]], **kwargs) -> List[Dict[str, Any]]:
+        """
+        Read several items with BatchGetItem, in no particular order; missing items are skipped
+
+        kwargs (e.g. ProjectionExpression) are added to the per-table request
+        """
+        loop = asyncio.get_running_loop()
+        chunks = [keys[i:i + DDB_BATCH_GET_SIZE] for i in range(0, len(keys), DDB_BATCH_GET_SIZE)]
+        count_round_trip(len(chunks))
+        results = await asyncio.gather(*(loop.run_in_executor(self._executor, self._batch_get, chunk, kwargs)
+                                         for chunk in chunks))
+        return [item for items in results for item in items]
+
+    async def scan(self, **kwargs) -> Dict[str, Any]:
+        return await self._run('scan', **kwargs)
+
+    async def scan_all(self, **kwargs) -> List[Dict[str, Any]]:
+        """Scan the whole table, following LastEvaluatedKey pagination"""
+        items = []
+        start_key = None
+        while True:
+            if start_key:
+                kwargs['ExclusiveStartKey'] = start_key
+            response = await self.scan(**kwargs)
+            items.extend(response.get('Items', []))
+            start_key = response.get('LastEvaluatedKey')
+            if start_key is None:
+                return items
+
+    def shutdown(self, wait: bool = False):
+        """Release the worker threads"""
+        self._executor.shutdown(wait=wait)
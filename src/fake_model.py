@@ -0,0 +1,140 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Deterministic fake model provider for offline load tests
+
+Selected with STRANDS_MODEL_PROVIDER=fake. It streams the same event sequence
+as BedrockModel without any network access:
+
+- for a user question, FAKE_MODEL_TOOL_CALLS rounds of a call to the tool
+  FAKE_MODEL_TOOL (skipped when the agent does not have that tool), then
+- an answer of FAKE_MODEL_OUTPUT_TOKENS words,
+- each response ending with a metadata event with usage and latencyMs.
+
+Structured output returns the same answer text in the string fields of the
+requested model.
+
+The first event is delayed by FAKE_MODEL_FIRST_TOKEN_MS and the words are paced
+at FAKE_MODEL_TOKENS_PER_SECOND (0 streams them as fast as possible), so the
+server can be measured under model-like timing on a box without Bedrock.
+"""
+import os
+import json
+import time
+import asyncio
+from typing import Any, AsyncGenerator, AsyncIterable, Dict, List, Optional
+from strands.models import Model
+from strands.types.content import Messages
+from strands.types.streaming import StreamEvent
+from strands.types.tools import ToolSpec
+
+# 首个事件的延迟(毫秒)
+FAKE_MODEL_FIRST_TOKEN_MS = float(os.environ.get("FAKE_MODEL_FIRST_TOKEN_MS", 300))
+# 输出速度, 0表示不限速
+FAKE_MODEL_TOKENS_PER_SECOND = float(os.environ.get("FAKE_MODEL_TOKENS_PER_SECOND", 80))
+# 最终回答的token数
+FAKE_MODEL_OUTPUT_TOKENS = int(os.environ.get("FAKE_MODEL_OUTPUT_TOKENS", 200))
+# 每个问题先调用几次工具, 以及调用的工具名和参数
+FAKE_MODEL_TOOL_CALLS = int(os.environ.get("FAKE_MODEL_TOOL_CALLS", 1))
+FAKE_MODEL_TOOL = os.environ.get("FAKE_MODEL_TOOL", "fake_search")
+FAKE_MODEL_TOOL_INPUT = os.environ.get("FAKE_MODEL_TOOL_INPUT", '{"query": "load test"}')
+
+WORDS = ("the quick brown fox jumps over the lazy dog while a steady stream of tokens "
+         "measures how fast the server relays every delta to the client").split()
+CHARS_PER_TOKEN = 4
+
+
+def _estimate_tokens(messages: Messages, system_prompt: Optional[str]) -> int:
+    return len(json.dumps(messages, default=str)) // CHARS_PER_TOKEN + len(system_prompt or "") // CHARS_PER_TOKEN
+
+
+def _tool_rounds(messages: Messages) -> int:
+    """Tool results since the last user question"""
+    rounds = 0
+    for message in reversed(messages):
+        if message.get("role") != "user":
+            continue
+        content = message.get("content") or []
+        if not any("toolResult" in block for block in content):
+            break
+        rounds += 1
+    return rounds
+
+
+class FakeModel(Model):
+    """Model streaming deterministic text, tool calls and metadata at a configurable rate"""
+
+    def __init__(self, model_id: str = "fake", **model_config: Any):
+        self.config: Dict[str, Any] = {
+            "model_id": model_id,
+            "first_token_ms": FAKE_MODEL_FIRST_TOKEN_MS,
+            "tokens_per_second": FAKE_MODEL_TOKENS_PER_SECOND,
+            "output_tokens": FAKE_MODEL_OUTPUT_TOKENS,
+            "tool_calls": FAKE_MODEL_TOOL_CALLS,
+            "tool_name": FAKE_MODEL_TOOL,
+            "tool_input": json.loads(FAKE_MODEL_TOOL_INPUT),
+        }
+        self.update_config(**model_config)
+
+    def update_config(self, **model_config: Any) -> None:
+        self.config.update(model_config)
+
+    def get_config(self) -> Dict[str, Any]:
+        return self.config
+
+    async def structured_output(self, output_model, prompt: Messages, **kwargs: Any) -> AsyncGenerator[Dict, None]:
+        """Yield an `output_model` whose string fields hold the scripted answer, other fields are left unset"""
+        await asyncio.sleep(self.config["first_token_ms"] / 1000)
+        text = " ".join(WORDS[i % len(WORDS)] for i in range(self.config["output_tokens"]))
+        fields = {name: text for name, field in output_model.model_fields.items() if field.annotation is str}
+        yield {"output": output_model.model_construct(**fields)}
+
+    def _tool_to_call(self, messages: Messages, tool_specs: Optional[List[ToolSpec]]) -> Optional[str]:
+        name = self.config["tool_name"]
+        if not name or not any(spec.get("name") == name for spec in tool_specs or []):
+            return None
+        return name if _tool_rounds(messages) < self.config["tool_calls"] else None
+
+    async def stream(
+        self,
+        messages: Messages,
+        tool_specs: Optional[List[ToolSpec]] = None,
+        system_prompt: Optional[str] = None,
+        **kwargs: Any,
+    ) -> AsyncIterable[StreamEvent]:
+        start = time.perf_counter()
+        await asyncio.sleep(self.config["first_token_ms"] / 1000)
+        yield {"messageStart": {"role": "assistant"}}
+
+        tool_name = self._tool_to_call(messages, tool_specs)
+        rate = self.config["tokens_per_second"]
+        if tool_name:
+            tool_input = json.dumps(self.config["tool_input"])
+            output_tokens = len(tool_input) // CHARS_PER_TOKEN + 1
+            yield {"contentBlockStart": {"start": {"toolUse": {
+                "name": tool_name, "toolUseId": f"tooluse_fake_{time.time_ns()}"}}}}
+            yield {"contentBlockDelta": {"delta": {"toolUse": {"input": tool_input}}}}
+            yield {"contentBlockStop": {}}
+            stop_reason = "tool_use"
+        else:
+            output_tokens = self.config["output_tokens"]
+            words_start = time.perf_counter()
+            for i in range(output_tokens):
+                if rate > 0:
+                    # 按目标时间而不是每个token固定sleep, 避免误差累积
+                    delay = words_start + i / rate - time.perf_counter()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                yield {"contentBlockDelta": {"delta": {"text": WORDS[i % len(WORDS)] + " "}}}
+            yield {"contentBlockStop": {}}
+            stop_reason = "end_turn"
+
+        yield {"messageStop": {"stopReason": stop_reason}}
+        input_tokens = _estimate_tokens(messages, system_prompt)
+        yield {"metadata": {
+            "usage": {"inputTokens": input_tokens, "outputTokens": output_tokens,
+                      "totalTokens": input_tokens + output_tokens},
+            "metrics": {"latencyMs": int((time.perf_counter() - start) * 1000)},
+        }}
@@ -0,0 +1,119 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Codec of the conversation history items stored in DynamoDB
+
+A payload is JSON text. Payloads below HISTORY_COMPRESS_THRESHOLD bytes are
+stored as before, in the string attribute `data`, so small messages stay
+readable in the console. Larger payloads are compressed (zstd if the zstandard
+package is installed, deflate otherwise) into the binary attribute `blob`, with
+the codec in `codec`. A payload that is still larger than HISTORY_CHUNK_BYTES is
+split: the item holds the first chunk and the number of chunks in `chunks`, and
+chunk i (i >= 1) is stored in its own item under `part_key(key, i)`, which keeps
+every item under the 400 KB DynamoDB limit.
+
+Items without `codec` are decoded from `data`, so existing records stay readable.
+"""
+import os
+import json
+import zlib
+import logging
+from typing import Any, Dict, List, Optional, Tuple
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
+)
+logger = logging.getLogger(__name__)
+
+# 压缩算法 zstd|zlib|none, 未安装zstandard时zstd退回zlib
+HISTORY_CODEC = os.environ.get("HISTORY_CODEC", "zstd").lower()
+# 超过该字节数的消息才压缩
+HISTORY_COMPRESS_THRESHOLD = int(os.environ.get("HISTORY_COMPRESS_THRESHOLD", 4096))
+# 单个item保存的最大字节数, 超过时拆分到多个item
+HISTORY_CHUNK_BYTES = int(os.environ.get("HISTORY_CHUNK_BYTES", 350 * 1024))
+
+_zstd = None
+try:
+    import zstandard as _zstd
+except ImportError:
+    if HISTORY_CODEC == "zstd":
+        logger.warning("zstandard is not installed, compressing history with zlib")
+
+
+def _compress(codec: str, raw: bytes) -> bytes:
+    if codec == "zstd":
+        return _zstd.ZstdCompressor(level=3).compress(raw)
+    if codec == "zlib":
+        return zlib.compress(raw, 6)
+    return raw
+
+
+def _decompress(codec: str, blob: bytes) -> bytes:
+    if codec == "zstd":
+        if _zstd is None:
+            raise RuntimeError("zstandard is required to read zstd compressed history")
+        return _zstd.ZstdDecompressor().decompress(blob)
+    if codec == "zlib":
+        return zlib.decompress(blob)
+    return blob
+
+
+def default_codec() -> str:
+    if HISTORY_CODEC == "zstd" and _zstd is None:
+        return "zlib"
+    return HISTORY_CODEC
+
+
+def part_key(key: str, index: int) -> str:
+    """Key of the index-th extra chunk of the item `key`"""
+    return f"{key}#part{index}"
+
+
+def encode_payload(data: Any, codec: Optional[str] = None, threshold: Optional[int] = None,
+                   chunk_bytes: Optional[int] = None) -> Tuple[Dict[str, Any], List[bytes]]:
+    """
+    Encode `data` for storage
+
+    Returns:
+        (attributes, extra_chunks): attributes to set on the main item, and the
+        chunks to store under part_key(key, 1..n-1)
+    """
+    codec = codec or default_codec()
+    threshold = HISTORY_COMPRESS_THRESHOLD if threshold is None else threshold
+    chunk_bytes = chunk_bytes or HISTORY_CHUNK_BYTES
+    text = json.dumps(data)
+    raw = text.encode('utf-8')
+    if len(raw) < threshold and len(raw) <= chunk_bytes:
+        return {'data': text}, []
+    if len(raw) < threshold:
+        codec = "none"
+    blob = _compress(codec, raw)
+    chunks = [blob[i:i + chunk_bytes] for i in range(0, len(blob), chunk_bytes)]
+    attributes = {'codec': codec, 'blob': chunks[0]}
+    if len(chunks) > 1:
+        attributes['chunks'] = len(chunks)
+    return attributes, chunks[1:]
+
+
+def chunk_count(item: Dict[str, Any]) -> int:
+    """Number of chunks of a stored item, including the main item"""
+    return int(item.get('chunks', 1))
+
+
+def _bytes(value: Any) -> bytes:
+    # boto3 returns binary attributes as boto3.dynamodb.types.Binary
+    return getattr(value, 'value', value)
+
+
+def decode_payload(item: Dict[str, Any], extra_chunks: Optional[List[Any]] = None) -> Any:
+    """Decode an item written by encode_payload (or a legacy item holding JSON in `data`)"""
+    codec = item.get('codec')
+    if codec is None:
+        return json.loads(item.get('data', 'null'))
+    blob = _bytes(item['blob'])
+    if extra_chunks:
+        blob = blob + b"".join(_bytes(chunk) for chunk in extra_chunks)
+    return json.loads(_decompress(codec, blob))
@@ -0,0 +1,115 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Fixed pool of worker event loops for agent streams
+
+Each worker is one daemon thread running an event loop forever. Coroutines are
+submitted to the least loaded loop, so the number of threads stays at
+`AGENT_LOOP_WORKERS` no matter how many streams are active, and no stream pays
+the cost of creating its own loop.
+"""
+import os
+import asyncio
+import logging
+import threading
+import concurrent.futures
+from typing import Any, Coroutine, Dict, List, Optional
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
+)
+logger = logging.getLogger(__name__)
+
+# pool模式下的worker loop数量
+AGENT_LOOP_WORKERS = int(os.environ.get("AGENT_LOOP_WORKERS", 4))
+
+
+class WorkerLoopPool:
+    """A fixed number of event loops, each running in its own thread"""
+
+    def __init__(self, workers: int = AGENT_LOOP_WORKERS, name: str = "agent-loop"):
+        self.workers = max(1, workers)
+        self._loops: List[asyncio.AbstractEventLoop] = []
+        self._threads: List[threading.Thread] = []
+        self._load: List[int] = [0] * self.workers
+        self._lock = threading.Lock()
+        for index in range(self.workers):
+            loop = asyncio.new_event_loop()
+            thread = threading.Thread(target=self._run_loop, args=(loop,), daemon=True, name=f"{name}-{index}")
+            self._loops.append(loop)
+            self._threads.append(thread)
+            thread.start()
+        logger.info(f"Started {self.workers} worker event loops")
+
+    @staticmethod
+    def _run_loop(loop: asyncio.AbstractEventLoop):
+        asyncio.set_event_loop(loop)
+        try:
+            loop.run_forever()
+        finally:
+            pending = asyncio.all_tasks(loop)
+            for task in pending:
+                task.cancel()
+            if pending:
+                loop.run_until_complete(asyncio.gather(*pending, return_exceptions=True))
+            loop.close()
+
+    def _release(self, index: int):
+        with self._lock:
+            self._load[index] -= 1
+
+    def submit(self, coro: Coroutine) -> concurrent.futures.Future:
+        """
+        Schedule a coroutine on the least loaded worker loop
+
+        Args:
+            coro: Coroutine to run
+
+        Returns:
+            concurrent.futures.Future of the coroutine, cancelling it cancels the task
+        """
+        with self._lock:
+            index = min(range(self.workers), key=self._load.__getitem__)
+            self._load[index] += 1
+        future = asyncio.run_coroutine_threadsafe(coro, self._loops[index])
+        future.add_done_callback(lambda _: self._release(index))
+        return future
+
+    def shutdown(self, timeout: float = 5.0):
+        """Stop every worker loop, cancelling the tasks still running on it"""
+        for loop in self._loops:
+            if loop.is_running():
+                loop.call_soon_threadsafe(loop.stop)
+        for thread in self._threads:
+            thread.join(timeout=timeout)
+        logger.info("Worker event loops stopped")
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {"workers": self.workers, "active_tasks": list(self._load)}
+
+
+_worker_loop_pool: Optional[WorkerLoopPool] = None
+_worker_loop_pool_lock = threading.Lock()
+
+
+def get_worker_loop_pool() -> WorkerLoopPool:
+    """Return the process-wide worker loop pool, starting it on first use"""
+    global _worker_loop_pool
+    if _worker_loop_pool is None:
+        with _worker_loop_pool_lock:
+            if _worker_loop_pool is None:
+                _worker_loop_pool = WorkerLoopPool()
+    return _worker_loop_pool
+
+
+def shutdown_worker_loop_pool():
+    """Stop the process-wide worker loop pool if it was started"""
+    global _worker_loop_pool
+    with _worker_loop_pool_lock:
+        if _worker_loop_pool is not None:
+            _worker_loop_pool.shutdown()
+            _worker_loop_pool = None
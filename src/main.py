@@ -21,10 +21,13 @@ from fastapi import FastAPI, Request, HTTPException, BackgroundTasks, Security
 from utils import  (get_global_server_configs,
                     delete_user_message,
                     save_global_server_config,
+                    save_model_config,
                     delete_user_server_config,
-                    get_user_server_configs,
+                    get_user_server_configs_with_revision,
                     load_user_mcp_configs,
                     session_lock,
+                    session_cache,
+                    get_cache_stats,
                     DDB_TABLE,
                     save_user_server_config)
 from fastapi.responses import JSONResponse, StreamingResponse
@@ -32,12 +35,30 @@ from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
 from fastapi import Security
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.exceptions import RequestValidationError
-from mcp_client_strands import StrandsMCPClient
+from mcp_client_strands import StrandsMCPClient, get_tool_cache_stats
+from tool_result_cache import get_tool_result_cache_stats, tool_result_stats
+from aws_clients import aws_client_registry
+from loop_pool import shutdown_worker_loop_pool
+from cancellation import cancellation_bus
+from stream_merge import merge_streams
+from sse_encoder import ChatChunkEncoder
+from stream_coalescer import coalesce_deltas, COALESCE_MAX_BYTES, COALESCE_MAX_MS
+from state_backend import state_backend
+from workers import WorkerAffinityMiddleware, configure_worker, bind_socket, run_workers
+from admission import chat_admission, AdmissionRejected
+from blob_store import blob_store, BlobTooLarge, BLOB_REF_PREFIX
+from prompt_cache import prompt_cache_tracker
+from starlette.background import BackgroundTask
+from mcp_pool import GlobalMCPPool
 from strands_agent_client_stream import StrandsAgentClientStream
 from fastapi import APIRouter
-from utils import is_endpoint_sse,save_stream_id,get_stream_id,active_streams,delete_stream_id,delete_user_session,get_user_session,save_user_session
+from utils import is_endpoint_sse,register_stream_id,get_stream_id,active_streams,delete_stream_id,delete_user_session,get_user_session,save_user_session
 from data_types import *
 from health import router as health_router
+import metrics
+from metrics import router as metrics_router, StreamMetrics
+import stage_timer
+from stage_timer import stage
 
 logging.basicConfig(
     level=logging.INFO,
@@ -54,10 +75,31 @@ llm_model_list = {}
 shared_mcp_server_list = {}  # 共享的MCP服务器描述信息
 # 用户会话存储
 user_sessions = {}
+# 全局MCP服务器的共享连接池，所有用户会话共用
+global_mcp_pool = GlobalMCPPool()
+
+# /metrics中的gauge, 只在抓取时计算
+metrics.registry.gauge("chat_active_streams", "Chat streams in progress on this worker", lambda: len(active_streams))
+metrics.registry.gauge("chat_admission_queued", "Chat requests waiting for admission",
+                       lambda: chat_admission.stats()["queued"])
+metrics.registry.gauge("chat_active_sessions", "User sessions held by this worker", lambda: len(user_sessions))
+metrics.registry.gauge("mcp_session_clients", "MCP clients owned by user sessions",
+                       lambda: sum(len(session.mcp_clients) for session in list(user_sessions.values())))
+metrics.registry.gauge("mcp_global_processes", "Shared global MCP server connections",
+                       global_mcp_pool.process_count)
+metrics.registry.register(metrics.CallbackMetric(
+    "mcp_tool_result_cache_total", "Lookups of the MCP tool result cache by server, tool and result",
+    lambda: [((server_id, tool_name, result), count)
+             for (server_id, tool_name), counters in list(tool_result_stats.items())
+             for result, count in counters.items()],
+    ("server", "tool", "result"), metric_type="counter"))
 
 
 MAX_TURNS = int(os.environ.get("MAX_TURNS",200))
+UPLOAD_MAX_BYTES = int(os.environ.get("UPLOAD_MAX_BYTES", 50 * 1024 * 1024))  # /v1/files上传文件的大小上限
 INACTIVE_TIME = int(os.environ.get("INACTIVE_TIME",60*24))  #mins
+MCP_INIT_CONCURRENCY = int(os.environ.get("MCP_INIT_CONCURRENCY", 4))  # 每个会话并发初始化的MCP服务器数
+MCP_INIT_TIMEOUT = float(os.environ.get("MCP_INIT_TIMEOUT", 120))  # 单个MCP服务器初始化超时(秒)
 API_KEY = os.environ.get("API_KEY")
 
 security = HTTPBearer()
@@ -83,6 +125,9 @@ class UserSession:
         self.mcp_clients = {}  # 用户特定的MCP客户端
         self.last_active = datetime.now()
         self.session_id = str(uuid.uuid4())
+        self.config_revision = None  # 已初始化的用户配置版本号，版本号不变时跳过初始化
+        self.server_status = {}  # 每个MCP服务器的就绪状态 server_id -> ready/timeout/failed
+        self.init_lock = asyncio.Lock()  # 避免同一用户的并发请求重复初始化服务器
 
     async def cleanup(self):
         """清理用户会话资源"""
@@ -105,51 +150,69 @@ async def get_api_key(auth: HTTPAuthorizationCredentials = Security(security)):
     raise HTTPException(status_code=403, detail="Could not validate credentials")
 
             
-async def initialize_user_servers(session: UserSession):
-    """初始化用户特有的MCP服务器"""
-    user_id = session.user_id
-    
-    # 获取用户服务器配置（现在是异步方法）
-    server_configs = await get_user_server_configs(user_id)
-    
-    global_server_configs = get_global_server_configs()
-    # 合并全局和用户的servers
-    server_configs = {**server_configs, **global_server_configs}
-    
-    logger.info(f"server_configs:{server_configs}")
-    # 初始化服务器连接
-    for server_id, config in server_configs.items():
-        if server_id in session.mcp_clients:  # 跳过已存在的服务器
-            logger.info(f"skip {server_id} initialization ")
-            continue
-            
+async def _initialize_server(session: UserSession, server_id: str, config: dict, is_global: bool,
+                             semaphore: asyncio.Semaphore) -> str:
+    """初始化单个MCP服务器，返回就绪状态: ready / timeout / failed: <reason>"""
+    async with semaphore:
         try:
-            # 创建并连接MCP服务器
-            if session.client_type == 'strands':
-                mcp_client = StrandsMCPClient(name=f"{session.user_id}_{server_id}")
-            else:
+            if session.client_type != 'strands':
                 raise ValueError("only support client_type strands")
-            server_url = config.get('url',"")
-            
-            await mcp_client.connect_to_server(
-                server_id=server_id,
-                command=config.get('command'),
-                server_url=server_url,
-                http_type= "sse" if is_endpoint_sse(server_url) else "streamable_http" ,
-                token=config.get('token', None),
-                server_script_args=config.get("args", []),
-                server_script_envs=config.get("env", {})
-            )
-            
-            # 添加到用户的客户端列表
-            session.mcp_clients[server_id] = mcp_client
-            await save_user_server_config(user_id, server_id, config)
-            logger.info(f"User Id {session.user_id} initialize server {server_id}")
-            
+            if is_global:
+                # 全局服务器从共享连接池借用，不为每个用户单独启动进程
+                mcp_client = await asyncio.wait_for(
+                    global_mcp_pool.acquire(server_id, config, name=f"{session.user_id}_{server_id}"),
+                    timeout=MCP_INIT_TIMEOUT)
+            else:
+                # 创建并连接MCP服务器
+                mcp_client = StrandsMCPClient(name=f"{session.user_id}_{server_id}")
+                await asyncio.wait_for(mcp_client.connect_from_config(server_id, config), timeout=MCP_INIT_TIMEOUT)
+        except asyncio.TimeoutError:
+            logger.error(f"User Id  {session.user_id} initialize server {server_id} timeout after {MCP_INIT_TIMEOUT}s")
+            return "timeout"
         except Exception as e:
             logger.error(f"User Id  {session.user_id} initialize server {server_id} failed: {e}")
-    # 保存配置        
-    # await save_user_mcp_configs()
+            return f"failed: {e}"
+    
+    # 添加到用户的客户端列表
+    session.mcp_clients[server_id] = mcp_client
+    if not is_global:
+        await save_user_server_config(session.user_id, server_id, config)
+    logger.info(f"User Id {session.user_id} initialize server {server_id}")
+    return "ready"
+
+async def initialize_user_servers(session: UserSession) -> dict:
+    """并发初始化用户的MCP服务器，返回每个服务器的就绪状态 server_id -> status"""
+    user_id = session.user_id
+    
+    async with session.init_lock:
+        # 获取用户服务器配置及版本号，TTL内命中本地缓存
+        revision, server_configs = await get_user_server_configs_with_revision(user_id)
+        if session.config_revision == revision:
+            # 配置没有变化，且上次所有服务器都初始化成功
+            return session.server_status
+        
+        global_server_configs = get_global_server_configs()
+        # 合并全局和用户的servers
+        server_configs = {**server_configs, **global_server_configs}
+        
+        logger.info(f"server_configs:{server_configs}")
+        # 跳过已存在的服务器，其余的并发初始化，单个服务器失败或超时不影响其他服务器
+        pending = {server_id: config for server_id, config in server_configs.items()
+                   if server_id not in session.mcp_clients}
+        semaphore = asyncio.Semaphore(MCP_INIT_CONCURRENCY)
+        results = await asyncio.gather(*[
+            _initialize_server(session, server_id, config, server_id in global_server_configs, semaphore)
+            for server_id, config in pending.items()
+        ])
+        
+        session.server_status = {server_id: "ready" for server_id in session.mcp_clients}
+        session.server_status.update(zip(pending.keys(), results))
+        # 只有全部服务器都成功时才记录版本号，否则下次请求时重试失败的服务器
+        if all(status == "ready" for status in results):
+            session.config_revision, _ = await get_user_server_configs_with_revision(user_id)
+        else:
+            logger.warning(f"User Id {user_id} partially ready servers: {session.server_status}")
+        return session.server_status
 
 async def get_or_create_user_session(
     request: Request,
@@ -164,15 +227,22 @@ async def get_or_create_user_session(
     # 尝试从请求头获取用户ID，如果不存在则使用API密钥作为备用ID
     user_id = request.headers.get("X-User-ID", auth.credentials)
     
-    session_obj = await get_user_session(user_id)
+    is_in_local = True if user_id in user_sessions else False
+    
+    # 本地会话且缓存未过期时，跳过存储读取
+    if is_in_local and session_cache.get(user_id):
+        session_obj = True
+    else:
+        session_obj = await get_user_session(user_id)
+        if session_obj:
+            session_cache.set(user_id, True)
     if not session_obj and not create_new:
         return None
     
-    is_in_local = True if user_id in user_sessions else False
-    
     # 如果全局都没有
     if not session_obj:
         await save_user_session(user_id,dict(user_id=user_id))
+        session_cache.set(user_id, True)
         if user_id not in user_sessions:
             user_sessions[user_id] = UserSession(user_id)
             logger.info(f"为用户 {user_id} 创建新会话: {user_sessions[user_id].session_id}")
@@ -187,7 +257,8 @@ async def get_or_create_user_session(
     session = user_sessions[user_id]
     
     # 从ddb中取出配置，重新初始化，如果已经存在则跳过。
-    await initialize_user_servers(session)
+    with stage("initialize_user_servers"):
+        await initialize_user_servers(session)
     return session
 
 async def cleanup_inactive_sessions():
@@ -204,17 +275,22 @@ async def cleanup_inactive_sessions():
                     inactive_users.append(user_id)
         
         for user_id in inactive_users:
+            # 锁只保护字典操作，不能跨await持有
             with session_lock:
-                if user_id in user_sessions:
-                    session = user_sessions.pop(user_id)
-                    await delete_user_session(user_id)
-                    try:
-                        await session.cleanup()
-                    except Exception as e:
-                        logger.error(f"清理用户 {user_id} 会话失败: {e}")
+                session = user_sessions.pop(user_id, None)
+            session_cache.invalidate(user_id)
+            if session:
+                await delete_user_session(user_id)
+                try:
+                    await session.cleanup()
+                except Exception as e:
+                    logger.error(f"清理用户 {user_id} 会话失败: {e}")
         
         if inactive_users:
             logger.info(f"已清理 {len(inactive_users)} 个不活跃用户会话")
+        
+        # 关闭长时间没有会话借用的全局MCP服务器进程
+        await global_mcp_pool.reap_idle()
 
 
 
@@ -223,6 +299,8 @@ async def lifespan(app: FastAPI):
     """服务器启动时执行的任务"""
     # 加载持久化的用户MCP配置
     await load_user_mcp_configs()
+    # 开始接收其他实例发布的流取消消息
+    await cancellation_bus.start()
     # 启动其他初始化任务
     await startup_event()
     yield
@@ -245,6 +323,10 @@ async def shutdown_event():
     if cleanup_tasks:
         await asyncio.gather(*cleanup_tasks)
         logger.info(f"已清理所有 {len(cleanup_tasks)} 个用户会话")
+    await global_mcp_pool.shutdown()
+    shutdown_worker_loop_pool()
+    await cancellation_bus.close()
+    await state_backend.close()
 
 
 app = FastAPI(lifespan=lifespan)
@@ -257,6 +339,8 @@ app.add_middleware(
     allow_methods=["*"],
     allow_headers=["*"],  # 允许所有头，包括自定义的X-User-ID
 )
+# 多worker模式下把请求转发到拥有该用户会话的worker(单worker时直接放行)
+app.add_middleware(WorkerAffinityMiddleware)
 
 # 配置单独的路由组，确保停止路由不受streaming路由的并发限制影响
 stop_router = APIRouter()
@@ -300,7 +384,48 @@ async def list_mcp_server(
     
     return JSONResponse(content={"servers": [{
         "server_id": sid, 
-        "server_name": name} for sid, name in server_list.items()]})
+        "server_name": name,
+        "status": session.server_status.get(sid, "ready" if sid in session.mcp_clients else "unavailable")
+        } for sid, name in server_list.items()]})
+
+@list_router.get("/v1/stats/cache")
+async def cache_stats(
+    request: Request,
+    auth: HTTPAuthorizationCredentials = Security(security)
+):
+    """返回本实例各类缓存的命中统计"""
+    await get_api_key(auth)
+    return JSONResponse(content={**get_cache_stats(), "mcp_tool_cache": get_tool_cache_stats(),
+                                 "mcp_tool_results": get_tool_result_cache_stats(),
+                                 "aws_clients": aws_client_registry.stats()})
+
+@list_router.get("/v1/stats/prompt_cache")
+async def prompt_cache_stats(
+    request: Request,
+    auth: HTTPAuthorizationCredentials = Security(security)
+):
+    """返回本实例各模型以及当前用户的prompt cache读写token和命中率"""
+    await get_api_key(auth)
+    user_id = request.headers.get("X-User-ID", auth.credentials)
+    return JSONResponse(content=prompt_cache_tracker.stats(user_id))
+
+@list_router.get("/v1/stats/mcp_pool")
+async def mcp_pool_stats(
+    request: Request,
+    auth: HTTPAuthorizationCredentials = Security(security)
+):
+    """返回全局MCP服务器共享连接池的状态"""
+    await get_api_key(auth)
+    return JSONResponse(content=global_mcp_pool.stats())
+
+@list_router.get("/v1/stats/admission")
+async def admission_stats(
+    request: Request,
+    auth: HTTPAuthorizationCredentials = Security(security)
+):
+    """返回对话流准入控制的状态"""
+    await get_api_key(auth)
+    return JSONResponse(content=chat_admission.stats())
 
 # 将stop_router包含在主应用中, 注意这个顺序必须在接口定义之后
 app.include_router(list_router)
@@ -370,7 +495,11 @@ async def stop_stream(
     user_id = request.headers.get("X-User-ID", auth.credentials)
     session = user_sessions.get(user_id)     
     if not stream_id in active_streams or not session:
-        # 如果不在当前的实例中，则直接remove ddb中的数据
+        # 如果不在当前的实例中，通过取消总线通知运行该流的实例，并remove ddb中的数据
+        try:
+            await cancellation_bus.publish(stream_id)
+        except Exception as e:
+            logger.error(f"Error publishing stream cancellation: {e}")
         try:
             await delete_stream_id(stream_id=stream_id)
             logger.info(f"Removed {stream_id} from remote record")
@@ -387,8 +516,8 @@ async def stop_stream(
         )
     elif session:
         user_id = session.user_id
-        # 检查流是否存在且属于当前用户
-        stream_id_result = await get_stream_id(stream_id)
+        # 检查流是否存在且属于当前用户, 本实例的流直接用active_streams中的归属(存储中的记录可能还在后台写入)
+        stream_id_result = active_streams.get(stream_id) or await get_stream_id(stream_id)
         if  stream_id_result != user_id:
             logger.warning(f"Stream {stream_id} not found in user_id:{user_id}, not authorized to stop this stream")
             return JSONResponse(content={"errno": -1, "msg": "Not authorized to stop this stream"})
@@ -396,8 +525,8 @@ async def stop_stream(
         # 使用BackgroundTasks处理停止流的操作，确保即使客户端断开连接，流也能被正确停止
         async def stop_stream_task(stream_id, session):
             try:
-                # 调用流停止功能，即使流可能已经结束
-                success = session.chat_client.stop_stream(stream_id)
+                # 通过取消总线停止流，即使流可能已经结束
+                success = await cancellation_bus.publish(stream_id)
                 if success:
                     logger.info(f"Successfully initiated stop for stream {stream_id}")
                     # 在异步任务中安全地更新共享状态
@@ -435,6 +564,7 @@ async def stop_stream(
 # 将stop_router包含在主应用中, 注意这个顺序必须在接口定义之后
 app.include_router(stop_router)
 app.include_router(health_router)
+app.include_router(metrics_router)
 
 @app.post("/v1/add/mcp_server")
 async def add_mcp_server(
@@ -460,6 +590,7 @@ async def add_mcp_server(
     server_script_args = data.args
     server_script_envs = data.env
     server_desc = data.server_desc if data.server_desc else data.server_id
+    result_cache = None
     
     # 处理配置JSON
     if data.config_json:
@@ -480,6 +611,8 @@ async def add_mcp_server(
         server_script_envs = config_json[server_id].get('env',{})
         http_type= "sse" if is_endpoint_sse(server_url) else "streamable_http"
         token=config_json[server_id].get('token', None)
+        # 幂等工具的结果缓存配置, 见tool_result_cache.py
+        result_cache = config_json[server_id].get('result_cache')
         
     # 连接MCP服务器
     tool_conf = {}
@@ -498,7 +631,8 @@ async def add_mcp_server(
             http_type=http_type,
             token=token,
             server_script_args=server_script_args,
-            server_script_envs=server_script_envs
+            server_script_envs=server_script_envs,
+            result_cache=result_cache
         )
         
         # 设置60秒超时
@@ -514,7 +648,8 @@ async def add_mcp_server(
             "args": server_script_args,
             "env": server_script_envs,
             "description": server_desc,
-            "token":token
+            "token":token,
+            "result_cache": result_cache
         }
         await save_user_server_config(user_id, server_id, server_config)
         
@@ -578,6 +713,7 @@ async def remove_mcp_server(
         await session.mcp_clients[server_id].disconnect_from_server(server_id)
         # 移除服务器
         del session.mcp_clients[server_id]
+        session.server_status.pop(server_id, None)
 
         # 从用户配置中删除
         await delete_user_server_config(user_id, server_id)
@@ -597,14 +733,32 @@ async def remove_mcp_server(
         ).model_dump())
 
 
-async def stream_chat_response(data: ChatCompletionRequest, session: UserSession, stream_id: str = None) -> AsyncGenerator[str, None]:
+async def stream_chat_response(data: ChatCompletionRequest, session: UserSession, stream_id: str = None,
+                               admission_ticket=None, request_start: float = None) -> AsyncGenerator[str, None]:
     """为特定用户生成流式聊天响应"""
+    # 首token延迟、token间隔和流时长的统计, 从请求到达(准入排队之前)开始计时;
+    # model label只取配置的模型, 其余记为other, 避免客户端传入的model产生无限多的series
+    metric_model = metrics.model_label(data.model, llm_model_list)
+    stream_metrics = StreamMetrics(metric_model, request_start or time.perf_counter())
+    outcome = "aborted"
+    # 采样请求的阶段耗时, 请求指定extra_params.stage_timings时同时作为SSE注释返回
+    timer = stage_timer.current()
+    if timer and stream_id:
+        timer.request_id = stream_id
+    send_stage_timings = bool((data.extra_params or {}).get('stage_timings'))
+
+    def done_event() -> str:
+        """流的结束标记, 需要返回阶段耗时时放在[DONE]之前(不能在finally中输出, 客户端可能已断开)"""
+        if timer and send_stage_timings:
+            return timer.sse_comment() + "data: [DONE]\n\n"
+        return "data: [DONE]\n\n"
+    prepare_start = time.perf_counter()
     
     # 注册流
     if stream_id:
         try:
-            # 先在ChatClientStream中注册流，然后再添加到active_streams
-            await save_stream_id(stream_id=stream_id,user_id=session.user_id)
+            # 同步登记到active_streams, 存储中的流记录在后台写入, 调用模型前没有存储往返
+            register_stream_id(stream_id=stream_id,user_id=session.user_id)
             # logger.info(f"Stream {stream_id} registered for user {session.user_id}")
             logger.info(f"active_streams:{active_streams}")
         except Exception as e:
@@ -658,7 +812,7 @@ async def stream_chat_response(data: ChatCompletionRequest, session: UserSession
                                     "image": {
                                         "format": img_format,
                                         "source": {
-                                            "bytes": img_bytes
+                                            "blobRef": await blob_store.put(img_bytes)
                                         }
                                     }
                                 })
@@ -676,52 +830,37 @@ async def stream_chat_response(data: ChatCompletionRequest, session: UserSession
                         try:
                             file_data = base64.b64decode(file_obj.file_data)
                             filename = file_obj.filename or "unnamed_file"
-                            # Determine file format from filename or mime type
-                            file_ext = os.path.splitext(filename)[1].lower().replace(".", "")
-                            if not file_ext:
-                                file_ext = "txt"  # Default to txt if no extension
-                                
-                            # Map to Bedrock document format
-                            doc_format_map = {
-                                "pdf": "pdf",
-                                "csv": "csv", 
-                                "doc": "doc",
-                                "docx": "docx",
-                                "xls": "xls", 
-                                "xlsx": "xlsx",
-                                "html": "html",
-                                "txt": "txt",
-                                "md": "md",
-                                "json": "txt",  # JSON treated as text
-                                "xml": "txt",   # XML treated as text
-                                "py": "txt",    # Python file treated as text
-                                "js": "txt",    # JS file treated as text
-                                "ts": "txt",    # TS file treated as text
-                            }
-                            
-                            doc_format = doc_format_map.get(file_ext, "txt")
-                            
                             message_content.append({
                                 "document": {
-                                    "format": doc_format,
+                                    "format": _document_format(filename),
                                     "name": f"files_{file_idx}",
                                     "source": {
-                                        "bytes": file_data
+                                        "blobRef": await blob_store.put(file_data)
                                     }
                                 }
                             })
                         except Exception as e:
                             logger.error(f"Error processing file data: {e}")
                     
-                    # Handle file_id (not implemented in this version)
+                    # Handle file_id of a file uploaded to /v1/files
                     elif file_obj.file_id:
-                        logger.warning(f"File ID references not implemented yet: {file_obj.file_id}")
+                        try:
+                            content_block = await _uploaded_file_block(file_obj, f"files_{file_idx}")
+                            if content_block:
+                                message_content.append(content_block)
+                            else:
+                                logger.warning(f"Uploaded file not found: {file_obj.file_id}")
+                        except Exception as e:
+                            logger.error(f"Error processing file id {file_obj.file_id}: {e}")
         
         messages.append({
             "role": msg.role,
             "content": message_content
         })
     
+    if timer:
+        timer.add("prepare_messages", time.perf_counter() - prepare_start)
+    
     system = []
     if messages and messages[0]['role'] == 'system':
         system = messages[0]['content'] if messages[0]['content'] else []
@@ -755,25 +894,52 @@ async def stream_chat_response(data: ChatCompletionRequest, session: UserSession
             use_swarm=data.use_swarm
         )
         
+        # 可选: 按字节/时间预算合并连续的文本delta，减少SSE帧数
+        extra_params = data.extra_params or {}
+        if extra_params.get('coalesce_deltas'):
+            response_stream = coalesce_deltas(
+                response_stream,
+                max_bytes=int(extra_params.get('coalesce_max_bytes', COALESCE_MAX_BYTES)),
+                max_ms=float(extra_params.get('coalesce_max_ms', COALESCE_MAX_MS)),
+            )
+        
         # 创建心跳生成器
         heartbeat_gen = heartbeat_sender()
+        # 每个流的chunk信封只序列化一次
+        chunk_encoder = ChatChunkEncoder(data.model)
         
         # 使用合并流来处理响应和心跳
-        async for item in _merge_streams(response_stream, heartbeat_gen):
+        async for item in merge_streams(response_stream, heartbeat_gen):
             if isinstance(item, dict):  # 来自 process_query_stream 的响应
                 response = item
                 # logger.info(f"{response}")
-                event_data = {
-                    "id": f"chat{time.time_ns()}",
-                    "object": "chat.completion.chunk",
-                    "created": int(time.time()),
-                    "model": data.model,
-                    "choices": [{
-                        "index": 0,
-                        "delta": {},
-                        "finish_reason": None
-                    }]
-                }
+                
+                # 热路径: delta只转义变化的文本，直接拼接预先序列化的信封
+                if response["type"] == "block_delta":
+                    if timer and stream_metrics.last is None:
+                        timer.mark("first_token")
+                    stream_metrics.delta(time.perf_counter())
+                    delta = response["data"]["delta"]
+                    chunk = None
+                    if "text" in delta:
+                        current_content += delta["text"]
+                        chunk = chunk_encoder.delta("content", delta["text"])
+                        thinking_text_index = 0
+                    if "toolUse" in delta:
+                        if not tooluse_start:
+                            tooluse_start = True
+                        chunk = chunk_encoder.delta("toolinput_content", delta["toolUse"]['input'])
+                    if "reasoningContent" in delta and 'text' in delta["reasoningContent"]:
+                        chunk = chunk_encoder.delta("reasoning_content", delta["reasoningContent"]["text"])
+                    yield chunk or chunk_encoder.encode(chunk_encoder.envelope())
+                    continue
+                
+                # 模型调用的usage和latencyMs
+                if response["type"] == "metadata":
+                    stream_metrics.usage(response["data"])
+                    continue
+                
+                event_data = chunk_encoder.envelope()
                 
                 # 处理不同的事件类型
                 if response["type"] == "message_start":
@@ -788,28 +954,6 @@ async def stream_chat_response(data: ChatCompletionRequest, session: UserSession
                             "tool_name": block_start["start"]["toolUse"]["name"]
                         }
                     
-                elif response["type"] == "block_delta":
-                    if "text" in response["data"]["delta"]:
-                        text = ""
-                        # if thinking_text_index >= 1 and thinking_start:    
-                        #     thinking_start = False
-                        #     text = "</thinking>"
-                        text += response["data"]["delta"]["text"]
-                        current_content += text
-                        event_data["choices"][0]["delta"] = {"content": text}
-                        thinking_text_index = 0
-                        
-                    if "toolUse" in response["data"]["delta"]:
-                        # text = ""
-                        if not tooluse_start:    
-                            tooluse_start = True
-                        event_data["choices"][0]["delta"] = {"toolinput_content": response["data"]["delta"]["toolUse"]['input']}
-                        
-                    if "reasoningContent" in response["data"]["delta"]:
-                        if 'text' in response["data"]["delta"]["reasoningContent"]:
-                            event_data["choices"][0]["delta"] = {"reasoning_content": response["data"]["delta"]["reasoningContent"]["text"]}
-                            
-
                 elif response["type"] == "block_stop":
                     if tooluse_start:
                         tooluse_start = False
@@ -833,12 +977,13 @@ async def stream_chat_response(data: ChatCompletionRequest, session: UserSession
                     raise Exception(response['data'])
 
                 # 发送事件
-                yield f"data: {json.dumps(event_data)}\n\n"
+                yield chunk_encoder.encode(event_data)
                     
                 # 手动停止流式响应
                 if response["type"] == "stopped":
                     # 立即停止心跳任务
                     heartbeat_stop_event.set()
+                    outcome = "stopped"
                     event_data = {
                         "id": f"stop{time.time_ns()}",
                         "object": "chat.completion.chunk",
@@ -851,13 +996,14 @@ async def stream_chat_response(data: ChatCompletionRequest, session: UserSession
                         }]
                     }
                     yield f"data: {json.dumps(event_data)}\n\n"
-                    yield "data: [DONE]\n\n"
+                    yield done_event()
                     break
                 
                 # 发送结束标记
                 if response["type"] == "message_stop" and response["data"]["stopReason"] in ['end_turn','max_tokens']:
                     # 停止心跳任务
                     heartbeat_stop_event.set()
+                    outcome = "completed"
                     if response["data"]["stopReason"] == 'max_tokens':
                         event_data = {
                             "id": f"stop{time.time_ns()}",
@@ -871,7 +1017,7 @@ async def stream_chat_response(data: ChatCompletionRequest, session: UserSession
                             }]
                         }
                         yield f"data: {json.dumps(event_data)}\n\n"
-                    yield "data: [DONE]\n\n"
+                    yield done_event()
                     break
                     
             elif isinstance(item, str):  # 来自心跳的消息
@@ -880,6 +1026,10 @@ async def stream_chat_response(data: ChatCompletionRequest, session: UserSession
 
     except Exception as e:
         logger.error(f"Stream error for user {session.user_id}: {e}",exc_info=True)
+        outcome = "error"
+        metrics.errors.inc(metric_model, type(e).__name__)
+        if metrics.is_throttle(e):
+            metrics.throttles.inc("model")
         error_message = f"Stream processing error: {type(e).__name__} - {str(e)}"
 
         error_data = {
@@ -894,9 +1044,13 @@ async def stream_chat_response(data: ChatCompletionRequest, session: UserSession
             }]
         }
         yield f"data: {json.dumps(error_data)}\n\n"
-        yield "data: [DONE]\n\n"
+        yield done_event()
         
     finally:
+        stream_metrics.finish(time.perf_counter(), outcome)
+        # 交还准入名额
+        if admission_ticket:
+            admission_ticket.release()
         # 停止心跳任务
         heartbeat_stop_event.set()
         # 清除活跃流列表中的请求
@@ -908,94 +1062,89 @@ async def stream_chat_response(data: ChatCompletionRequest, session: UserSession
                 logger.info(f"Stream {stream_id} unregistered")
         except Exception as e:
             logger.error(f"Error cleaning up stream {stream_id}: {e}")
+        if timer:
+            timer.log()
 
 
-async def _merge_streams(*streams):
-    """合并多个异步生成器流"""
-    import asyncio
-    from collections import deque
-    
-    # 创建队列来存储每个流的状态
-    stream_tasks = []
-    for stream in streams:
-        stream_iter = aiter(stream)
-        task = asyncio.create_task(anext(stream_iter, StopAsyncIteration))
-        stream_tasks.append((task, stream_iter))
-    
+# Map file extensions to Bedrock document formats
+DOC_FORMAT_MAP = {
+    "pdf": "pdf",
+    "csv": "csv", 
+    "doc": "doc",
+    "docx": "docx",
+    "xls": "xls", 
+    "xlsx": "xlsx",
+    "html": "html",
+    "txt": "txt",
+    "md": "md",
+    "json": "txt",  # JSON treated as text
+    "xml": "txt",   # XML treated as text
+    "py": "txt",    # Python file treated as text
+    "js": "txt",    # JS file treated as text
+    "ts": "txt",    # TS file treated as text
+}
+IMAGE_FORMATS = {"png", "jpeg", "gif", "webp"}
+FILE_ID_PREFIX = "file-"
+
+def _document_format(filename: str) -> str:
+    """Determine the document format from the file name, default to txt"""
+    file_ext = os.path.splitext(filename)[1].lower().replace(".", "")
+    return DOC_FORMAT_MAP.get(file_ext, "txt")
+
+async def _uploaded_file_block(file_obj: FileObject, name: str) -> Optional[dict]:
+    """Content block referencing a file uploaded to /v1/files, None if the file does not exist"""
+    if not file_obj.file_id.startswith(FILE_ID_PREFIX):
+        return None
+    ref = BLOB_REF_PREFIX + file_obj.file_id[len(FILE_ID_PREFIX):]
+    if not await blob_store.exists(ref):
+        return None
+    meta = await state_backend.get("files", file_obj.file_id) or {}
+    filename = file_obj.filename or meta.get("filename") or "unnamed_file"
+    content_type = meta.get("content_type", "")
+    if content_type.startswith("image/"):
+        img_format = content_type.split("/")[1].split(";")[0]
+    else:
+        img_format = os.path.splitext(filename)[1].lower().replace(".", "")
+    img_format = "jpeg" if img_format == "jpg" else img_format
+    if img_format in IMAGE_FORMATS:
+        return {"image": {"format": img_format, "source": {"blobRef": ref}}}
+    return {"document": {"format": _document_format(filename), "name": name, "source": {"blobRef": ref}}}
+
+@app.post("/v1/files")
+async def upload_file(
+    request: Request,
+    filename: str = "",
+    auth: HTTPAuthorizationCredentials = Security(security)
+):
+    """
+    上传聊天附件, 请求体为文件的原始内容(非base64/multipart), 文件名通过filename参数传入
+    请求体按块流式写入blob store, 返回的file_id可以在chat请求的file.file_id中引用
+    """
+    await get_api_key(auth)
+    user_id = request.headers.get("X-User-ID", auth.credentials)
+    content_length = request.headers.get("content-length")
+    if content_length and content_length.isdigit() and int(content_length) > UPLOAD_MAX_BYTES:
+        return JSONResponse(status_code=413, content={"errno": 413, "msg": f"File exceeds {UPLOAD_MAX_BYTES} bytes"})
     try:
-        while stream_tasks:
-            # 等待任何一个流产生结果，使用较短的超时时间以便更快响应停止信号
-            done, pending = await asyncio.wait(
-                [task for task, _ in stream_tasks],
-                return_when=asyncio.FIRST_COMPLETED,
-                timeout=0.1  # 添加超时以便更快响应停止信号
-            )
-            
-            # 处理完成的任务
-            new_stream_tasks = []
-            main_stream_ended = False
-            
-            for task, stream_iter in stream_tasks:
-                if task in done:
-                    try:
-                        result = await task
-                        if result is not StopAsyncIteration:
-                            yield result
-                            # 检查是否是主要流（agent stream）的真正结束信号
-                            # 只有在明确的结束条件下才停止所有流
-                            if isinstance(result, dict):
-                                result_type = result.get("type")
-                                if result_type == "stopped":
-                                    main_stream_ended = True
-                                elif result_type == "message_stop":
-                                    stop_reason = result.get("data", {}).get("stopReason")
-                                    if stop_reason in ['end_turn', 'max_tokens']:
-                                        main_stream_ended = True
-                                elif result_type == "error":
-                                    main_stream_ended = True
-                            # 创建新任务来获取下一个值
-                            new_task = asyncio.create_task(anext(stream_iter, StopAsyncIteration))
-                            new_stream_tasks.append((new_task, stream_iter))
-                        # 如果结果是 StopAsyncIteration，该流已结束，不重新添加
-                    except StopAsyncIteration:
-                        # 流已结束
-                        pass
-                    except Exception as e:
-                        logger.error(f"Error in merged stream task: {e}")
-                        # 取消所有正在运行和新添加的任务
-                        for t, _ in stream_tasks:
-                            if not t.done():
-                                t.cancel()
-                        for t, _ in new_stream_tasks:
-                            if not t.done():
-                                t.cancel()
-                        # 把异常继续向外抛出
-                        raise
-            
-                else:
-                    # 任务仍在运行
-                    new_stream_tasks.append((task, stream_iter))
-                    
-            stream_tasks = new_stream_tasks
-            
-            # 如果主要流已结束，立即退出循环
-            if main_stream_ended:
-                logger.info("Main stream ended, stopping all streams")
-                break
-            
-    except Exception as e:
-        logger.error(f"Error in _merge_streams: {e}")
-        # 把异常继续向外抛出
-        raise
-    finally:
-        # 清理所有剩余的任务
-        for task, _ in stream_tasks:
-            if not task.done():
-                task.cancel()
-                try:
-                    await task
-                except asyncio.CancelledError:
-                    pass
+        ref, size = await blob_store.put_stream(request.stream(), max_bytes=UPLOAD_MAX_BYTES)
+    except BlobTooLarge as e:
+        return JSONResponse(status_code=413, content={"errno": 413, "msg": str(e)})
+    file_id = FILE_ID_PREFIX + ref[len(BLOB_REF_PREFIX):]
+    content_type = request.headers.get("content-type", "application/octet-stream")
+    await state_backend.set("files", file_id, {
+        "filename": filename,
+        "content_type": content_type,
+        "bytes": size,
+        "user_id": user_id,
+        "created_at": int(time.time()),
+    })
+    logger.info(f"User {user_id} uploaded {filename or 'file'} ({size} bytes) as {file_id}")
+    return JSONResponse(content={"errno": 0, "msg": "ok", "data": {
+        "file_id": file_id,
+        "filename": filename,
+        "bytes": size,
+        "content_type": content_type,
+    }})
 
 @app.post("/v1/chat/completions")
 async def chat_completions(
@@ -1004,8 +1153,35 @@ async def chat_completions(
     background_tasks: BackgroundTasks,
     auth: HTTPAuthorizationCredentials = Security(security)
 ):
-    # 获取用户会话
-    session = await get_or_create_user_session(request, auth)
+    request_start = time.perf_counter()
+    await get_api_key(auth)
+    # 按STAGE_TIMING_SAMPLE_RATE采样记录各阶段耗时
+    stage_timer.start_request(f"chat{time.time_ns()}", data.model,
+                              force=bool((data.extra_params or {}).get('stage_timings')))
+    # 准入控制: 在初始化会话之前拒绝超出用户或实例上限的请求
+    admission_ticket = None
+    if data.stream and data.messages:
+        user_id = request.headers.get("X-User-ID", auth.credentials)
+        try:
+            with stage("admission"):
+                admission_ticket = await chat_admission.acquire(user_id)
+        except AdmissionRejected as e:
+            logger.warning(f"Chat request of user {user_id} rejected: {e.reason}")
+            metrics.throttles.inc("admission")
+            return JSONResponse(
+                status_code=e.status_code,
+                content={"errno": e.status_code, "msg": e.reason},
+                headers={"Retry-After": str(e.retry_after)}
+            )
+    
+    try:
+        # 获取用户会话
+        with stage("get_or_create_user_session"):
+            session = await get_or_create_user_session(request, auth)
+    except BaseException:
+        if admission_ticket:
+            admission_ticket.release()
+        raise
     # 记录会话活动
     session.last_active = datetime.now()
 
@@ -1028,10 +1204,18 @@ async def chat_completions(
     if data.stream:
         # 为流式请求生成唯一ID
         stream_id = f"stream_{session.user_id}_{time.time_ns()}"
+        headers = {"X-Stream-ID": stream_id}  # 添加流ID到响应头，便于前端跟踪
+        # 告知调用方本次请求中未就绪的MCP服务器
+        unavailable_servers = [sid for sid in (data.mcp_server_ids or []) if sid not in session.mcp_clients]
+        if unavailable_servers:
+            logger.warning(f"User {session.user_id} requested unavailable servers: {unavailable_servers}")
+            headers["X-MCP-Unavailable-Servers"] = ",".join(unavailable_servers)
+        # 流结束时在生成器中交还名额, 生成器未启动(客户端提前断开)时由background交还
         return StreamingResponse(
-            stream_chat_response(data, session, stream_id),
+            stream_chat_response(data, session, stream_id, admission_ticket, request_start),
             media_type="text/event-stream",
-            headers={"X-Stream-ID": stream_id}  # 添加流ID到响应头，便于前端跟踪
+            headers=headers,
+            background=BackgroundTask(admission_ticket.release)
         )
     else:
         logger.error(f"Only support stream")
@@ -1085,71 +1269,96 @@ if __name__ == '__main__':
     parser.add_argument('--cert-dir', default='certificates', help="证书目录")
     parser.add_argument('--ssl-keyfile', default='', help="SSL密钥文件路径")
     parser.add_argument('--ssl-certfile', default='', help="SSL证书文件路径")
+    parser.add_argument('--workers', type=int, default=int(os.environ.get('WORKERS', 1)),
+                       help="worker进程数, 每个用户的会话固定在其中一个worker上")
+    parser.add_argument('--worker-base-port', type=int, default=int(os.environ.get('WORKER_BASE_PORT', 0)),
+                       help="worker私有端口的起始值(仅监听127.0.0.1), 默认为port+100")
     args = parser.parse_args()
     
     # 设置用户配置文件路径环境变量
     os.environ['USER_MCP_CONFIG_FILE'] = args.user_conf
     
-    try:
+    def serve(ssl_keyfile, ssl_certfile, sockets=None):
+        """在当前进程中运行uvicorn, sockets为空时监听--host/--port"""
         loop = asyncio.new_event_loop()
+        try:
+            # 配置uvicorn
+            config_kwargs = {
+                "app": app,
+                "host": args.host,
+                "port": args.port,
+                "loop": loop,
+                "timeout_keep_alive": 3600,  # 设置为1小时或更长
+                # 对话流由准入控制限流, 这里只是连接数的最后一道保护, 需高于CHAT_MAX_CONCURRENT_STREAMS
+                "limit_concurrency": int(os.environ.get("SERVER_LIMIT_CONCURRENCY", 1000)),
+                "limit_max_requests": int(os.environ.get("SERVER_LIMIT_MAX_REQUESTS", 1000)) or None,  # 限制最大请求数, 0表示不限制
+                "timeout_graceful_shutdown": 30  # 优雅关闭超时
+            }
+            
+            # 如果启用HTTPS且有有效证书，添加SSL配置
+            if args.https and ssl_keyfile and ssl_certfile:
+                config_kwargs["ssl_keyfile"] = ssl_keyfile
+                config_kwargs["ssl_certfile"] = ssl_certfile
+            
+            config = uvicorn.Config(**config_kwargs)
+            server = uvicorn.Server(config)
+            loop.run_until_complete(server.serve(sockets=sockets))
+        finally:
+            # 确保退出时清理资源并保存用户配置
+            cleanup_tasks = []
+            for user_id, session in user_sessions.items():
+                cleanup_tasks.append(session.cleanup())
+            
+            if cleanup_tasks:
+                loop.run_until_complete(asyncio.gather(*cleanup_tasks))
+            loop.run_until_complete(global_mcp_pool.shutdown())
+            shutdown_worker_loop_pool()
+            loop.close()
+    
+    if args.mcp_conf:
+        with open(args.mcp_conf, 'r') as f:
+            conf = json.load(f)
+            # 加载全局MCP服务器配置
+            for server_id, server_conf in conf.get('mcpServers', {}).items():
+                if server_conf.get('status') == 0:
+                    continue
+                shared_mcp_server_list[server_id] = server_conf.get('description', server_id)
+                save_global_server_config(server_id, server_conf)
 
-        if args.mcp_conf:
-            with open(args.mcp_conf, 'r') as f:
-                conf = json.load(f)
-                # 加载全局MCP服务器配置
-                for server_id, server_conf in conf.get('mcpServers', {}).items():
-                    if server_conf.get('status') == 0:
-                        continue
-                    shared_mcp_server_list[server_id] = server_conf.get('description', server_id)
-                    save_global_server_config(server_id, server_conf)
-
-                # 加载模型配置
-                for model_conf in conf.get('models', []):
-                    llm_model_list[model_conf['model_id']] = model_conf['model_name']
-        
-        # 配置HTTPS
-        ssl_keyfile = None
-        ssl_certfile = None
-        
-        if args.https:
-            if args.ssl_keyfile and args.ssl_certfile:
-                ssl_keyfile = args.ssl_keyfile
-                ssl_certfile = args.ssl_certfile
-                logger.info(f"使用指定的SSL证书: {ssl_certfile} 和密钥: {ssl_keyfile}")
-            else:
-                ssl_keyfile, ssl_certfile = generate_self_signed_cert(args.cert_dir)
-                if not ssl_keyfile or not ssl_certfile:
-                    logger.warning("无法生成SSL证书，将使用HTTP而非HTTPS")
-        
-        # 配置uvicorn
-        config_kwargs = {
-            "app": app,
-            "host": args.host,
-            "port": args.port,
-            "loop": loop,
-            "timeout_keep_alive": 3600,  # 设置为1小时或更长
-            "limit_concurrency": 100,  # 限制并发连接数
-            "limit_max_requests": 1000,  # 限制最大请求数
-            "timeout_graceful_shutdown": 30  # 优雅关闭超时
-        }
-        
-        # 如果启用HTTPS且有有效证书，添加SSL配置
-        if args.https and ssl_keyfile and ssl_certfile:
-            config_kwargs["ssl_keyfile"] = ssl_keyfile
-            config_kwargs["ssl_certfile"] = ssl_certfile
-            logger.info(f"启用HTTPS，服务器将在 https://{args.host}:{args.port} 上运行")
+            # 加载模型配置
+            for model_conf in conf.get('models', []):
+                llm_model_list[model_conf['model_id']] = model_conf['model_name']
+                save_model_config(model_conf['model_id'], model_conf)
+    
+    # 配置HTTPS
+    ssl_keyfile = None
+    ssl_certfile = None
+    
+    if args.https:
+        if args.ssl_keyfile and args.ssl_certfile:
+            ssl_keyfile = args.ssl_keyfile
+            ssl_certfile = args.ssl_certfile
+            logger.info(f"使用指定的SSL证书: {ssl_certfile} 和密钥: {ssl_keyfile}")
         else:
-            logger.info(f"使用HTTP，服务器将在 http://{args.host}:{args.port} 上运行")
+            ssl_keyfile, ssl_certfile = generate_self_signed_cert(args.cert_dir)
+            if not ssl_keyfile or not ssl_certfile:
+                logger.warning("无法生成SSL证书，将使用HTTP而非HTTPS")
+    
+    scheme = "https" if args.https and ssl_keyfile and ssl_certfile else "http"
+    logger.info(f"{'启用HTTPS' if scheme == 'https' else '使用HTTP'}，服务器将在 {scheme}://{args.host}:{args.port} 上运行")
+    
+    if args.workers > 1:
+        # 多worker: 共享监听端口，每个worker另有一个私有端口用于按用户转发请求
+        base_port = args.worker_base_port or args.port + 100
+        shared_socket = bind_socket(args.host, args.port)
         
-        config = uvicorn.Config(**config_kwargs)
-        server = uvicorn.Server(config)
-        loop.run_until_complete(server.serve())
-    finally:
-        # 确保退出时清理资源并保存用户配置
-        cleanup_tasks = []
-        for user_id, session in user_sessions.items():
-            cleanup_tasks.append(session.cleanup())
+        def run_worker(index):
+            configure_worker(index, args.workers, base_port, scheme)
+            private_socket = bind_socket('127.0.0.1', base_port + index)
+            logger.info(f"Worker {index} 私有端口: {base_port + index}")
+            serve(ssl_keyfile, ssl_certfile, sockets=[shared_socket, private_socket])
         
-        if cleanup_tasks:
-            loop.run_until_complete(asyncio.gather(*cleanup_tasks))
-        loop.close()
+        logger.info(f"启动 {args.workers} 个worker进程")
+        run_workers(args.workers, run_worker)
+    else:
+        serve(ssl_keyfile, ssl_certfile)
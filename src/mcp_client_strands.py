@@ -8,15 +8,20 @@ This module provides MCP server management specifically for Strands agents.
 """
 import os
 import json
+import time
 import logging
 import asyncio
-from typing import Dict, List, Optional, Any
+import threading
+from contextlib import asynccontextmanager
+from typing import Callable, Dict, List, Optional, Any
+import anyio
 from mcp import StdioServerParameters, stdio_client
 from mcp.client.sse import sse_client
 from mcp.client.streamable_http import streamablehttp_client
 from strands.tools.mcp import MCPClient
 from strands.types.tools import AgentTool
 from dotenv import load_dotenv
+from utils import is_endpoint_sse
 
 load_dotenv()  # load environment variables from .env
 
@@ -26,6 +31,99 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# TTL in seconds of the cached tool list of a connection, 0 disables caching
+MCP_TOOL_CACHE_TTL = float(os.environ.get("MCP_TOOL_CACHE_TTL", 300))
+TOOLS_LIST_CHANGED = "notifications/tools/list_changed"
+
+# Counters aggregated over the tool caches of all connections
+tool_cache_stats = {"hits": 0, "misses": 0, "invalidations": 0}
+_tool_cache_stats_lock = threading.Lock()
+
+def _count_tool_cache(counter: str):
+    with _tool_cache_stats_lock:
+        tool_cache_stats[counter] += 1
+
+def get_tool_cache_stats() -> Dict[str, Any]:
+    """Aggregated hit/miss counters of the tool catalog caches of all connections"""
+    with _tool_cache_stats_lock:
+        stats = dict(tool_cache_stats)
+    total = stats["hits"] + stats["misses"]
+    stats["hit_rate"] = round(stats["hits"] / total, 4) if total else 0.0
+    return stats
+
+
+class ToolCatalogCache:
+    """
+    Cached tool list of one MCP server connection
+    
+    The cached list is dropped when the server sends notifications/tools/list_changed,
+    when the connection is re-established, or when the TTL expires.
+    """
+    
+    def __init__(self, server_id: str, ttl: float = MCP_TOOL_CACHE_TTL):
+        self.server_id = server_id
+        self.ttl = ttl
+        self._tools: Optional[List[AgentTool]] = None
+        self._fetched_at = 0.0
+        self._lock = threading.Lock()
+    
+    def get(self) -> Optional[List[AgentTool]]:
+        with self._lock:
+            if self._tools is not None and time.monotonic() - self._fetched_at < self.ttl:
+                _count_tool_cache("hits")
+                return self._tools
+        _count_tool_cache("misses")
+        return None
+    
+    def set(self, tools: List[AgentTool]):
+        if self.ttl <= 0:
+            return
+        with self._lock:
+            self._tools = tools
+            self._fetched_at = time.monotonic()
+    
+    def invalidate(self, reason: str = ""):
+        with self._lock:
+            had_tools = self._tools is not None
+            self._tools = None
+        if had_tools:
+            _count_tool_cache("invalidations")
+            logger.info(f"Tool cache of server {self.server_id} invalidated: {reason}")
+
+
+def _is_tools_list_changed(message: Any) -> bool:
+    # read streams carry SessionMessage (newer mcp) or JSONRPCMessage, or exceptions
+    root = getattr(getattr(message, 'message', message), 'root', None)
+    return getattr(root, 'method', None) == TOOLS_LIST_CHANGED
+
+@asynccontextmanager
+async def watch_tool_list_changes(transport, on_tools_changed: Callable[[], None]):
+    """
+    Wrap an MCP transport and call `on_tools_changed` whenever the server
+    sends notifications/tools/list_changed. All messages are forwarded unchanged.
+    """
+    async with transport as streams:
+        read_stream, write_stream = streams[0], streams[1]
+        send_stream, receive_stream = anyio.create_memory_object_stream(0)
+        
+        async def forward():
+            async with send_stream:
+                try:
+                    async for message in read_stream:
+                        if _is_tools_list_changed(message):
+                            on_tools_changed()
+                        await send_stream.send(message)
+                except (anyio.ClosedResourceError, anyio.BrokenResourceError):
+                    pass
+        
+        async with anyio.create_task_group() as tg:
+            tg.start_soon(forward)
+            try:
+                yield (receive_stream, write_stream, *streams[2:])
+            finally:
+                tg.cancel_scope.cancel()
+
+
 class StrandsMCPClient:
     """
     MCP Client manager for Strands Agents SDK
@@ -37,15 +135,20 @@ class StrandsMCPClient:
     - Converting tools to Strands format
     """
     
+    # 是否为--mcp-conf中的全局共享服务器(见mcp_pool.PooledMCPClient)
+    shared = False
+    
     def __init__(self, name: str = "strands_mcp_client"):
         """Initialize the Strands MCP client manager"""
         self.name = name
         self.servers: Dict[str, Dict[str, Any]] = {}
         self.active_clients: Dict[str, MCPClient] = {}
+        self.tool_caches: Dict[str, ToolCatalogCache] = {}
         
     async def connect_to_server(self, server_id: str, command: str = "", server_script_path: str = "", 
                                server_script_args: List[str] = [], server_script_envs: Dict = {}, 
-                               server_url: str = "", http_type: str = 'stdio', token: str = ""):
+                               server_url: str = "", http_type: str = 'stdio', token: str = "",
+                               result_cache: Optional[Dict[str, Any]] = None):
         """
         Connect to an MCP server using Strands MCP client
         
@@ -58,21 +161,27 @@ class StrandsMCPClient:
             server_url: URL for HTTP-based servers
             http_type: Type of HTTP transport ('sse' or 'streamable_http')
             token: Authentication token for HTTP servers
+            result_cache: Tool result cache config of the server, see tool_result_cache.py
         """
         if server_id in self.active_clients:
             logger.warning(f"Server {server_id} is already connected")
             return
             
         try:
+            # A fresh connection always starts with an empty tool cache
+            tool_cache = ToolCatalogCache(server_id)
+            on_tools_changed = lambda: tool_cache.invalidate(TOOLS_LIST_CHANGED)
             # Determine transport type and create appropriate client
             if server_url:
                 # HTTP-based server
                 if http_type == 'sse':
                     headers = {"Authorization": f"Bearer {token}"} if token else None
-                    mcp_client = MCPClient(lambda: sse_client(server_url, headers=headers))
+                    mcp_client = MCPClient(lambda: watch_tool_list_changes(
+                        sse_client(server_url, headers=headers), on_tools_changed))
                 elif http_type == 'streamable_http':
                     headers = {"Authorization": f"Bearer {token}"} if token else None
-                    mcp_client = MCPClient(lambda: streamablehttp_client(server_url, headers=headers))
+                    mcp_client = MCPClient(lambda: watch_tool_list_changes(
+                        streamablehttp_client(server_url, headers=headers), on_tools_changed))
                 else:
                     raise ValueError(f"Unsupported HTTP transport type: {http_type}")
             else:
@@ -117,7 +226,7 @@ class StrandsMCPClient:
                 )
                 
                 # Create MCP client with stdio transport
-                mcp_client = MCPClient(lambda: stdio_client(params))
+                mcp_client = MCPClient(lambda: watch_tool_list_changes(stdio_client(params), on_tools_changed))
             
             # Store server configuration
             self.servers[server_id] = {
@@ -127,21 +236,55 @@ class StrandsMCPClient:
                 'url': server_url,
                 'http_type': http_type,
                 'token': token,
+                'result_cache': result_cache,
                 'client': mcp_client
             }
             
+            # start server in a worker thread, MCPClient.start blocks until the session is initialized
+            loop = asyncio.get_running_loop()
+            start_future = loop.run_in_executor(None, mcp_client.start)
+            try:
+                await asyncio.shield(start_future)
+            except asyncio.CancelledError:
+                # The caller gave up (e.g. timeout), stop the connection once the start finishes
+                def stop_abandoned(future):
+                    if not future.cancelled() and future.exception() is None:
+                        loop.run_in_executor(None, mcp_client.stop, None, None, None)
+                start_future.add_done_callback(stop_abandoned)
+                self.servers.pop(server_id, None)
+                raise
+            
             # Store active client
             self.active_clients[server_id] = mcp_client
-            
-            # start server
-            mcp_client.start()
+            self.tool_caches[server_id] = tool_cache
             
             logger.info(f"Connected to MCP server: {server_id}")
             
         except Exception as e:
+            self.servers.pop(server_id, None)
             logger.error(f"Failed to connect to MCP server {server_id}: {e}")
             raise
     
+    async def connect_from_config(self, server_id: str, config: Dict[str, Any]):
+        """
+        Connect to an MCP server described by a user/global server config
+        
+        Args:
+            server_id: Unique identifier for the server
+            config: Server config with command/args/env or url/token
+        """
+        server_url = config.get('url', "")
+        await self.connect_to_server(
+            server_id=server_id,
+            command=config.get('command'),
+            server_url=server_url,
+            http_type="sse" if is_endpoint_sse(server_url) else "streamable_http",
+            token=config.get('token', None),
+            server_script_args=config.get("args", []),
+            server_script_envs=config.get("env", {}),
+            result_cache=config.get("result_cache")
+        )
+    
     async def disconnect_from_server(self, server_id: str):
         """
         Disconnect from an MCP server
@@ -156,8 +299,9 @@ class StrandsMCPClient:
         try:
             # The MCPClient context manager handles cleanup automatically
             # We just need to remove it from our tracking
-            self.active_clients[server_id].stop(None,None,None)
+            await asyncio.to_thread(self.active_clients[server_id].stop, None, None, None)
             del self.active_clients[server_id]
+            self.tool_caches.pop(server_id, None)
             if server_id in self.servers:
                 del self.servers[server_id]
                 
@@ -166,6 +310,10 @@ class StrandsMCPClient:
         except Exception as e:
             logger.error(f"Failed to disconnect from server {server_id}: {e}")
     
+    def get_result_cache_config(self, server_id: str) -> Optional[Dict[str, Any]]:
+        """Tool result cache config of a connected server, None if its results are not cached"""
+        return self.servers.get(server_id, {}).get('result_cache')
+    
     def get_tools(self, server_id: str) -> List[AgentTool]:
         """
         Get tools from a specific MCP server
@@ -181,10 +329,17 @@ class StrandsMCPClient:
             return []
             
         try:
+            tool_cache = self.tool_caches.get(server_id)
+            tools = tool_cache.get() if tool_cache else None
+            if tools is not None:
+                return tools
+            
             mcp_client = self.active_clients[server_id]
             
             tools = mcp_client.list_tools_sync()
             logger.info(f"Retrieved {len(tools)} tools from server: {server_id}")
+            if tool_cache:
+                tool_cache.set(tools)
             return tools
                 
         except Exception as e:
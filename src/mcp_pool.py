@@ -0,0 +1,259 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Shared connection pool for global MCP servers
+
+Global servers (loaded with --mcp-conf) are identical for every user, so instead
+of spawning one stdio process per user session, every session borrows a lease on
+one of a small number of shared replicas. A replica is a single MCP connection;
+concurrent tool calls from many sessions are multiplexed over it by the MCP
+client session (JSON-RPC request ids), so process count scales with the number
+of servers and replicas, not with the number of users.
+
+A replica is taken out of the pool when a tool call finds its session is no
+longer running; the lease that hit the failure moves to another replica and the
+call is retried there once.
+"""
+import os
+import time
+import asyncio
+import logging
+from typing import Dict, List, Any, Optional
+from strands.types.exceptions import MCPClientInitializationError
+from strands.types.tools import AgentTool, ToolGenerator, ToolSpec, ToolUse
+from mcp_client_strands import StrandsMCPClient
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
+)
+logger = logging.getLogger(__name__)
+
+# 每个全局服务器默认的副本数，可在server config中用"replicas"单独配置
+GLOBAL_MCP_REPLICAS = int(os.environ.get("GLOBAL_MCP_REPLICAS", 1))
+# 没有会话借用的副本在空闲多久后关闭(秒)
+GLOBAL_MCP_IDLE_TIMEOUT = int(os.environ.get("GLOBAL_MCP_IDLE_TIMEOUT", 600))
+
+
+class _Replica:
+    """One shared connection to a global MCP server"""
+
+    def __init__(self, server_id: str, index: int, client: StrandsMCPClient):
+        self.server_id = server_id
+        self.index = index
+        self.client = client
+        self.leases = 0
+        self.idle_since = time.monotonic()
+        # 由连接池维护: 停止副本或工具调用发现会话已退出时置为False
+        self.alive = True
+
+    def is_alive(self) -> bool:
+        return self.alive
+
+
+class _LeasedAgentTool(AgentTool):
+    """Tool of a pooled connection, a call hitting a replica that is down is retried on a new lease"""
+
+    def __init__(self, tool: AgentTool, lease: "PooledMCPClient", replica: _Replica):
+        super().__init__()
+        self._tool = tool
+        self._lease = lease
+        self._replica = replica
+
+    @property
+    def tool_name(self) -> str:
+        return self._tool.tool_name
+
+    @property
+    def tool_spec(self) -> ToolSpec:
+        return self._tool.tool_spec
+
+    @property
+    def tool_type(self) -> str:
+        return self._tool.tool_type
+
+    async def stream(self, tool_use: ToolUse, invocation_state: Dict[str, Any], **kwargs: Any) -> ToolGenerator:
+        try:
+            async for event in self._tool.stream(tool_use, invocation_state, **kwargs):
+                yield event
+            return
+        except MCPClientInitializationError as e:
+            # strands在会话未运行时抛出该异常, 其他失败都作为error结果返回
+            logger.warning(f"Global MCP server {self._replica.server_id} replica {self._replica.index} "
+                           f"is down: {e}")
+        tool = await self._lease.relet(self._replica, self.tool_name)
+        async for event in tool.stream(tool_use, invocation_state, **kwargs):
+            yield event
+
+
+class PooledMCPClient(StrandsMCPClient):
+    """
+    A user session's lease on a shared global MCP connection
+
+    It exposes the same interface as StrandsMCPClient, so it can be stored in
+    `UserSession.mcp_clients` as is. Disconnecting or cleaning it up returns the
+    lease to the pool instead of stopping the shared server process.
+    """
+
+    shared = True
+
+    def __init__(self, pool: "GlobalMCPPool", server_id: str, config: Dict[str, Any], replica: _Replica,
+                 name: str):
+        super().__init__(name=name)
+        self._pool = pool
+        self._server_id = server_id
+        self._config = config
+        self._relet_lock = asyncio.Lock()
+        self._bind(replica)
+
+    def _bind(self, replica: _Replica):
+        self._replica = replica
+        self.servers[self._server_id] = replica.client.servers[self._server_id]
+        self.active_clients[self._server_id] = replica.client.active_clients[self._server_id]
+        # the tool catalog belongs to the shared connection
+        self.tool_caches[self._server_id] = replica.client.tool_caches[self._server_id]
+
+    async def connect_to_server(self, server_id: str, *args, **kwargs):
+        raise ValueError(f"Pooled client for {server_id} cannot connect to other servers")
+
+    def get_tools(self, server_id: str) -> List[AgentTool]:
+        replica = self._replica
+        return [_LeasedAgentTool(tool, self, replica) for tool in super().get_tools(server_id)]
+
+    async def relet(self, failed: _Replica, tool_name: str) -> AgentTool:
+        """
+        Move the lease off the replica `failed` that is down
+
+        Returns:
+            The tool `tool_name` of the replica now leased
+        """
+        async with self._relet_lock:
+            # 并发的调用可能已经换过副本
+            if self._replica is failed:
+                await self._pool.remove_replica(failed)
+                self._bind(await self._pool.lease_replica(self._server_id, self._config))
+                logger.info(f"Moved lease on global MCP server {self._server_id} to replica {self._replica.index}")
+        for tool in super().get_tools(self._server_id):
+            if tool.tool_name == tool_name:
+                return tool
+        raise MCPClientInitializationError(f"tool {tool_name} is not available on global MCP server {self._server_id}")
+
+    async def disconnect_from_server(self, server_id: str):
+        """Return the lease to the pool"""
+        if server_id not in self.active_clients:
+            logger.warning(f"Server {server_id} not found or already released")
+            return
+        del self.active_clients[server_id]
+        self.servers.pop(server_id, None)
+        self.tool_caches.pop(server_id, None)
+        self._pool.release(self._replica)
+        logger.info(f"Released lease on global MCP server: {server_id}")
+
+
+class GlobalMCPPool:
+    """Reference-counted pool of shared global MCP server connections"""
+
+    def __init__(self, default_replicas: int = GLOBAL_MCP_REPLICAS, idle_timeout: int = GLOBAL_MCP_IDLE_TIMEOUT):
+        self.default_replicas = max(1, default_replicas)
+        self.idle_timeout = idle_timeout
+        self._replicas: Dict[str, List[_Replica]] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+
+    def _get_lock(self, server_id: str) -> asyncio.Lock:
+        if server_id not in self._locks:
+            self._locks[server_id] = asyncio.Lock()
+        return self._locks[server_id]
+
+    async def acquire(self, server_id: str, config: Dict[str, Any], name: str = "") -> PooledMCPClient:
+        """
+        Borrow a connection to a global MCP server
+
+        The least-leased live replica is chosen. A new replica is spawned only when
+        every existing one is already in use and the replica limit is not reached.
+
+        Args:
+            server_id: Global server identifier
+            config: Global server config, may contain "replicas"
+            name: Name of the returned client, for logging
+
+        Returns:
+            PooledMCPClient holding a lease on one replica
+        """
+        replica = await self.lease_replica(server_id, config)
+        return PooledMCPClient(self, server_id, config, replica, name or f"pooled_{server_id}")
+
+    async def lease_replica(self, server_id: str, config: Dict[str, Any]) -> _Replica:
+        """Add a lease to the least-leased replica, spawning one if needed"""
+        max_replicas = max(1, int(config.get('replicas', self.default_replicas)))
+        async with self._get_lock(server_id):
+            replicas = self._replicas.setdefault(server_id, [])
+            replica = min(replicas, key=lambda r: r.leases) if replicas else None
+            if replica is None or (replica.leases > 0 and len(replicas) < max_replicas):
+                index = max((r.index for r in replicas), default=-1) + 1
+                replica = await self._spawn(server_id, config, index)
+                replicas.append(replica)
+            replica.leases += 1
+            return replica
+
+    async def remove_replica(self, replica: _Replica):
+        """Take a replica that is down out of the pool, later leases go to other replicas"""
+        async with self._get_lock(replica.server_id):
+            replicas = self._replicas.get(replica.server_id, [])
+            if replica not in replicas:
+                return
+            replicas.remove(replica)
+        logger.warning(f"Global MCP server {replica.server_id} replica {replica.index} is down, removed from the pool")
+        await self._stop_replica(replica)
+
+    def release(self, replica: _Replica):
+        """Return a lease, the replica stays up until it has been idle for idle_timeout"""
+        replica.leases = max(0, replica.leases - 1)
+        if replica.leases == 0:
+            replica.idle_since = time.monotonic()
+
+    async def _spawn(self, server_id: str, config: Dict[str, Any], index: int) -> _Replica:
+        client = StrandsMCPClient(name=f"global_{server_id}_{index}")
+        await client.connect_from_config(server_id, config)
+        logger.info(f"Spawned global MCP server {server_id} replica {index}")
+        return _Replica(server_id, index, client)
+
+    async def _stop_replica(self, replica: _Replica):
+        replica.alive = False
+        try:
+            await replica.client.cleanup()
+        except Exception as e:
+            logger.error(f"Failed to stop global MCP server {replica.server_id} replica {replica.index}: {e}")
+
+    async def reap_idle(self):
+        """Stop replicas that no session has borrowed for longer than idle_timeout"""
+        now = time.monotonic()
+        for server_id, replicas in list(self._replicas.items()):
+            async with self._get_lock(server_id):
+                idle = [r for r in replicas if r.leases == 0 and now - r.idle_since > self.idle_timeout]
+                for replica in idle:
+                    replicas.remove(replica)
+                    await self._stop_replica(replica)
+                    logger.info(f"Stopped idle global MCP server {server_id} replica {replica.index}")
+
+    async def shutdown(self):
+        """Stop every replica"""
+        for server_id, replicas in list(self._replicas.items()):
+            for replica in replicas:
+                await self._stop_replica(replica)
+        self._replicas.clear()
+
+    def process_count(self) -> int:
+        """Number of running shared server connections"""
+        return sum(len(replicas) for replicas in self._replicas.values())
+
+    def stats(self) -> Dict[str, Any]:
+        """Leases per replica of every global server"""
+        return {
+            "processes": self.process_count(),
+            "servers": {
+                server_id: [{"replica": r.index, "leases": r.leases, "alive": r.is_alive()} for r in replicas]
+                for server_id, replicas in self._replicas.items()
+            }
+        }
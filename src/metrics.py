@@ -0,0 +1,210 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Prometheus text format metrics of model and stream performance
+
+Recording is a dict lookup plus an addition (histograms bisect a short bucket
+list), no I/O and no formatting, so it can be called for every streamed delta.
+Gauges are callbacks that are only evaluated when /metrics is scraped.
+
+Every worker process keeps its own metrics; each sample carries a `worker`
+label, scrape every worker (or each ECS task) to get the totals.
+"""
+import bisect
+import threading
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+from fastapi import APIRouter
+from fastapi.responses import PlainTextResponse
+import workers
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60)
+GAP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+DURATION_BUCKETS = (1, 2.5, 5, 10, 30, 60, 120, 300, 600, 1200)
+TOKENS_PER_SECOND_BUCKETS = (5, 10, 20, 30, 50, 75, 100, 150, 200, 300)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    pairs.append(f'worker="{workers.worker_index}"')
+    return "{" + ",".join(pairs) + "}"
+
+
+def _number(value: float) -> str:
+    return str(int(value)) if float(value).is_integer() else repr(float(value))
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount: float = 1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}")
+        return lines
+
+
+class Histogram:
+    def __init__(self, name: str, documentation: str, buckets: Sequence[float], labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        self.labelnames = tuple(labelnames)
+        # labels -> [count per bucket (last one is +Inf), sum]
+        self._values: Dict[Tuple, list] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            values = [(labels, list(counts), total) for labels, (counts, total) in self._values.items()]
+        for labels, counts, total in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += count
+                le = 'le="+Inf"' if bound == float("inf") else f'le="{_number(bound)}"'
+                lines.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {cumulative}")
+            lines.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_number(total)}")
+            lines.append(f"{self.name}_count{_labels(self.labelnames, labels)} {cumulative}")
+        return lines
+
+
+class CallbackMetric:
+    """Gauge or counter whose samples are computed when the metrics are scraped"""
+
+    def __init__(self, name: str, documentation: str, callback: Callable[[], Iterable[Tuple[Tuple, float]]],
+                 labelnames: Sequence[str] = (), metric_type: str = "gauge"):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.labelnames = tuple(labelnames)
+        self.metric_type = metric_type
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.metric_type}"]
+        for labels, value in self.callback():
+            lines.append(f"{self.name}{_labels(self.labelnames, labels)} {_number(value)}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        self._metrics[metric.name] = metric
+        return metric
+
+    def gauge(self, name: str, documentation: str, callback: Callable[[], float]) -> CallbackMetric:
+        """Register an unlabelled gauge reading `callback()`"""
+        return self.register(CallbackMetric(name, documentation, lambda: [((), callback())]))
+
+    def render(self) -> str:
+        lines = []
+        for metric in list(self._metrics.values()):
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                lines.append(f"# {metric.name} unavailable: {_escape(e)}")
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+time_to_first_token = registry.register(Histogram(
+    "chat_time_to_first_token_seconds", "Time from the chat request to the first streamed token",
+    LATENCY_BUCKETS, ("model",)))
+inter_token_gap = registry.register(Histogram(
+    "chat_inter_token_gap_seconds", "Time between consecutive streamed deltas",
+    GAP_BUCKETS, ("model",)))
+stream_duration = registry.register(Histogram(
+    "chat_stream_duration_seconds", "Total duration of a chat stream",
+    DURATION_BUCKETS, ("model", "outcome")))
+tokens_per_second = registry.register(Histogram(
+    "model_output_tokens_per_second", "Output tokens per second of a model call (usage / latencyMs)",
+    TOKENS_PER_SECOND_BUCKETS, ("model",)))
+model_tokens = registry.register(Counter(
+    "model_tokens_total", "Tokens of the model calls by kind", ("model", "kind")))
+throttles = registry.register(Counter(
+    "chat_throttles_total", "Requests throttled by the model provider or rejected by admission control",
+    ("source",)))
+errors = registry.register(Counter(
+    "chat_errors_total", "Chat streams ended by an error", ("model", "type")))
+
+
+def model_label(model: str, known_models) -> str:
+    """`model` when it is a configured model, "other" otherwise (the model id comes from the client)"""
+    return model if model in known_models else "other"
+
+
+def is_throttle(error: BaseException) -> bool:
+    text = f"{type(error).__name__} {error}"
+    return any(marker in text for marker in ("Throttling", "TooManyRequests", "Too many requests", "Rate limit"))
+
+
+class StreamMetrics:
+    """Timing of one chat stream from the arrival of its request, call `delta()` for each streamed delta"""
+
+    __slots__ = ("model", "start", "last")
+
+    def __init__(self, model: str, start: float):
+        self.model = model
+        self.start = start
+        self.last = None
+
+    def delta(self, now: float):
+        if self.last is None:
+            time_to_first_token.observe(now - self.start, self.model)
+        else:
+            inter_token_gap.observe(now - self.last, self.model)
+        self.last = now
+
+    def usage(self, metadata: dict):
+        """Record the `metadata` event of a model call"""
+        usage = metadata.get("usage") or {}
+        for kind, key in (("input", "inputTokens"), ("output", "outputTokens"),
+                          ("cache_read", "cacheReadInputTokens"), ("cache_write", "cacheWriteInputTokens")):
+            if usage.get(key):
+                model_tokens.inc(self.model, kind, amount=usage[key])
+        latency_ms = (metadata.get("metrics") or {}).get("latencyMs")
+        if latency_ms and usage.get("outputTokens"):
+            tokens_per_second.observe(usage["outputTokens"] / (latency_ms / 1000), self.model)
+
+    def finish(self, now: float, outcome: str):
+        stream_duration.observe(now - self.start, self.model, outcome)
+
+
+router = APIRouter()
+
+
+@router.get("/metrics")
+async def metrics():
+    """Prometheus scrape endpoint"""
+    return PlainTextResponse(registry.render(), media_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,117 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Prompt cache placement and hit tracking for Bedrock models
+
+A Bedrock request is cached by prefix: tools, then the system prompt, then the
+messages. BedrockModel already puts cache points after the tools and the system
+prompt; `CachePointBedrockModel` additionally puts rolling cache points on the
+conversation, at the end of the last CACHE_MESSAGE_POINTS user messages of each
+request. Within a tool loop the last user message is the newest tool result
+(cache write) and the one before it ended the previous request (cache read), so
+every model call re-reads the whole conversation prefix from the cache. The
+points are added to a copy of the messages, agent.messages and the stored
+history never contain them.
+
+`PromptCacheTracker` aggregates the cacheRead/cacheWrite token counts of the
+stream metadata events per model and per user.
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Dict, List
+from strands.models import BedrockModel
+
+# 每次请求在对话消息上放置的cache point数量(Bedrock每个请求最多4个, tools和system各占一个)
+CACHE_MESSAGE_POINTS = int(os.environ.get("CACHE_MESSAGE_POINTS", 2))
+# 统计中保留的用户数
+PROMPT_CACHE_STATS_MAX_USERS = int(os.environ.get("PROMPT_CACHE_STATS_MAX_USERS", 1000))
+
+CACHE_POINT = {"cachePoint": {"type": "default"}}
+
+
+def place_cache_points(messages: List[Dict[str, Any]], count: int = CACHE_MESSAGE_POINTS) -> List[Dict[str, Any]]:
+    """
+    Return `messages` with a cache point at the end of the last `count` user messages
+
+    Only the messages that get a cache point are copied; existing cache points
+    are moved, never duplicated.
+    """
+    if count <= 0:
+        return messages
+    placed = list(messages)
+    remaining = count
+    for index in range(len(placed) - 1, -1, -1):
+        message = placed[index]
+        content = message.get("content")
+        if not isinstance(content, list):
+            continue
+        has_point = any(isinstance(block, dict) and "cachePoint" in block for block in content)
+        if remaining > 0 and message.get("role") == "user" and content:
+            blocks = [block for block in content if not (isinstance(block, dict) and "cachePoint" in block)]
+            placed[index] = {**message, "content": blocks + [dict(CACHE_POINT)]}
+            remaining -= 1
+        elif has_point:
+            placed[index] = {**message, "content": [block for block in content
+                                                    if not (isinstance(block, dict) and "cachePoint" in block)]}
+    return placed
+
+
+class CachePointBedrockModel(BedrockModel):
+    """BedrockModel adding rolling cache points on the conversation of every request"""
+
+    def format_request(self, messages, *args, **kwargs):
+        return super().format_request(place_cache_points(messages), *args, **kwargs)
+
+
+class PromptCacheTracker:
+    """Thread-safe cache token counters per model and per user"""
+
+    def __init__(self, max_users: int = PROMPT_CACHE_STATS_MAX_USERS):
+        self.max_users = max_users
+        self._models: Dict[str, Dict[str, int]] = {}
+        self._users: "OrderedDict[str, Dict[str, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _add(counters: Dict[str, int], usage: Dict[str, Any]):
+        counters["requests"] = counters.get("requests", 0) + 1
+        for name, key in (("input_tokens", "inputTokens"), ("output_tokens", "outputTokens"),
+                          ("cache_read_tokens", "cacheReadInputTokens"),
+                          ("cache_write_tokens", "cacheWriteInputTokens")):
+            counters[name] = counters.get(name, 0) + int(usage.get(key) or 0)
+
+    def record(self, user_id: str, model_id: str, usage: Dict[str, Any]):
+        """Add the `usage` of a stream metadata event"""
+        if not usage:
+            return
+        with self._lock:
+            self._add(self._models.setdefault(model_id, {}), usage)
+            counters = self._users.pop(user_id, None) or {}
+            self._add(counters, usage)
+            self._users[user_id] = counters
+            while len(self._users) > self.max_users:
+                self._users.popitem(last=False)
+
+    @staticmethod
+    def _with_rate(counters: Dict[str, int]) -> Dict[str, Any]:
+        # Bedrock的inputTokens不包括从缓存读取和写入缓存的token
+        prompt_tokens = (counters.get("input_tokens", 0) + counters.get("cache_read_tokens", 0)
+                         + counters.get("cache_write_tokens", 0))
+        return {**counters,
+                "cache_hit_rate": round(counters.get("cache_read_tokens", 0) / prompt_tokens, 4)
+                if prompt_tokens else 0.0}
+
+    def stats(self, user_id: str = None) -> Dict[str, Any]:
+        with self._lock:
+            result = {"models": {model_id: self._with_rate(counters) for model_id, counters in self._models.items()}}
+            if user_id is not None:
+                result["user"] = self._with_rate(self._users.get(user_id, {}))
+            else:
+                result["users"] = len(self._users)
+            return result
+
+
+prompt_cache_tracker = PromptCacheTracker()
@@ -0,0 +1,80 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+OpenAI chat.completion.chunk encoder for the SSE stream
+
+The envelope of a chunk (id, object, created, model, choice index) is the same
+for every chunk of a stream, so it is serialized once per stream. Encoding a
+text delta then only escapes the delta string and concatenates it between the
+precomputed prefix and suffix.
+
+SSE_JSON_BACKEND=orjson switches to orjson if it is installed (non-ASCII
+characters are then emitted as UTF-8 instead of \\u escapes, both are valid JSON).
+"""
+import os
+import json
+import time
+import logging
+from typing import Any, Dict, Optional
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
+)
+logger = logging.getLogger(__name__)
+
+SSE_JSON_BACKEND = os.environ.get("SSE_JSON_BACKEND", "json").lower()
+
+# json.dumps(str) without the dumps() call overhead
+_encode_str = json.encoder.encode_basestring_ascii
+_dumps = json.dumps
+
+if SSE_JSON_BACKEND == "orjson":
+    try:
+        import orjson
+
+        def _encode_str(value: str) -> str:
+            return orjson.dumps(value).decode()
+
+        def _dumps(obj: Any) -> str:
+            return orjson.dumps(obj).decode()
+    except ImportError:
+        logger.warning("orjson is not installed, using the json module for SSE chunks")
+
+
+class ChatChunkEncoder:
+    """Encodes the SSE frames of one chat completion stream"""
+
+    def __init__(self, model: str):
+        self.id = f"chat{time.time_ns()}"
+        self.created = int(time.time())
+        self.model = model
+        envelope = json.dumps({"id": self.id, "object": "chat.completion.chunk",
+                               "created": self.created, "model": model})
+        self._prefix = 'data: ' + envelope[:-1] + ', "choices": [{"index": 0, "delta": {"'
+        self._suffix = '}, "finish_reason": null}]}\n\n'
+
+    def delta(self, key: str, text: str) -> str:
+        """SSE frame of a chunk whose delta is `{key: text}`, e.g. ("content", "Hello")"""
+        return self._prefix + key + '": ' + _encode_str(text) + self._suffix
+
+    def envelope(self) -> Dict[str, Any]:
+        """A fresh chunk dict with an empty delta, for the less frequent events"""
+        return {
+            "id": self.id,
+            "object": "chat.completion.chunk",
+            "created": self.created,
+            "model": self.model,
+            "choices": [{
+                "index": 0,
+                "delta": {},
+                "finish_reason": None
+            }]
+        }
+
+    @staticmethod
+    def encode(event_data: Dict[str, Any]) -> str:
+        """SSE frame of an arbitrary chunk dict"""
+        return f"data: {_dumps(event_data)}\n\n"
@@ -0,0 +1,123 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Per-request latency breakdown of the chat request path
+
+A `StageTimer` is bound to the request context with `start_request()`; code
+along the path wraps its work in `with stage("name"):` and AsyncDDBStorage
+counts its round trips with `count_round_trip()`. Both are no-ops when the
+request is not sampled, so unsampled requests only pay a context variable
+lookup. The stages are measured on the event loop; work run in the agent
+thread is timed by the code waiting for it (e.g. the model's first byte).
+
+The breakdown is logged as one JSON line per sampled request:
+
+    stage_timings {"request": "...", "model": "...", "total_ms": 2630.1, "round_trips": 7,
+                   "stages": {"session": 12.4, "load_history": 38.0, ...}}
+
+and, when the request asks for it (extra_params.stage_timings), also sent as an
+SSE comment `: stage_timings {...}` at the end of the stream.
+"""
+import os
+import json
+import time
+import random
+import logging
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Optional
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
+)
+logger = logging.getLogger(__name__)
+
+# 记录阶段耗时的请求比例, 0表示只在请求中指定extra_params.stage_timings时记录
+STAGE_TIMING_SAMPLE_RATE = float(os.environ.get("STAGE_TIMING_SAMPLE_RATE", 0.05))
+
+_current: ContextVar[Optional["StageTimer"]] = ContextVar("stage_timer", default=None)
+
+
+class StageTimer:
+    """Durations of the named stages of one request, in milliseconds"""
+
+    def __init__(self, request_id: str, model: str = ""):
+        self.request_id = request_id
+        self.model = model
+        self.start = time.perf_counter()
+        self.stages: Dict[str, float] = {}
+        self.round_trips = 0
+
+    def add(self, name: str, seconds: float):
+        # 同名阶段(如多次工具加载)累加
+        self.stages[name] = self.stages.get(name, 0.0) + seconds * 1000
+
+    def mark(self, name: str):
+        """Record `name` as the time elapsed since the start of the request"""
+        if name not in self.stages:
+            self.stages[name] = (time.perf_counter() - self.start) * 1000
+
+    def summary(self) -> Dict:
+        return {
+            "request": self.request_id,
+            "model": self.model,
+            "total_ms": round((time.perf_counter() - self.start) * 1000, 1),
+            "round_trips": self.round_trips,
+            "stages": {name: round(ms, 1) for name, ms in self.stages.items()},
+        }
+
+    def log(self):
+        logger.info("stage_timings " + json.dumps(self.summary(), ensure_ascii=False))
+
+    def sse_comment(self) -> str:
+        return f": stage_timings {json.dumps(self.summary(), ensure_ascii=False)}\n\n"
+
+
+def start_request(request_id: str, model: str = "", force: bool = False) -> Optional[StageTimer]:
+    """Bind a timer to the current context if the request is sampled (or `force`)"""
+    if not force and (STAGE_TIMING_SAMPLE_RATE <= 0 or random.random() >= STAGE_TIMING_SAMPLE_RATE):
+        return None
+    timer = StageTimer(request_id, model)
+    _current.set(timer)
+    return timer
+
+
+def current() -> Optional[StageTimer]:
+    return _current.get()
+
+
+@contextmanager
+def _timed(timer: StageTimer, name: str):
+    start = time.perf_counter()
+    try:
+        yield timer
+    finally:
+        timer.add(name, time.perf_counter() - start)
+
+
+class _NoStage:
+    def __enter__(self):
+        return None
+
+    def __exit__(self, *exc):
+        return False
+
+
+_NO_STAGE = _NoStage()
+
+
+def stage(name: str):
+    """Context manager timing the stage `name` of the current request"""
+    timer = _current.get()
+    if timer is None:
+        return _NO_STAGE
+    return _timed(timer, name)
+
+
+def count_round_trip(count: int = 1):
+    timer = _current.get()
+    if timer is not None:
+        timer.round_trips += count
@@ -0,0 +1,105 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Key/value state shared by the worker processes of one deployment
+
+State is grouped in namespaces (e.g. "streams": stream_id -> user_id). The
+in-memory backend keeps it in the current process and is enough for a single
+worker; the Redis backend keeps every namespace in a Redis hash so all workers
+and instances see the same state.
+
+Select the backend with STATE_BACKEND=memory|redis. For a local Redis stand-in
+run `docker compose --profile redis up redis` and set REDIS_URL.
+"""
+import os
+import json
+import logging
+import threading
+from typing import Any, Dict, Optional
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
+)
+logger = logging.getLogger(__name__)
+
+STATE_BACKEND = os.environ.get("STATE_BACKEND", "memory").lower()
+REDIS_URL = os.environ.get("REDIS_URL", "redis://localhost:6379/0")
+STATE_KEY_PREFIX = os.environ.get("STATE_KEY_PREFIX", "mcp:state")
+
+
+class StateBackend:
+    """In-process state backend, also the interface of the shared backends"""
+
+    shared = False
+
+    def __init__(self):
+        self._data: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+
+    async def get(self, namespace: str, key: str) -> Optional[Any]:
+        with self._lock:
+            return self._data.get(namespace, {}).get(key)
+
+    async def set(self, namespace: str, key: str, value: Any):
+        with self._lock:
+            self._data.setdefault(namespace, {})[key] = value
+
+    async def delete(self, namespace: str, key: str):
+        with self._lock:
+            self._data.get(namespace, {}).pop(key, None)
+
+    async def items(self, namespace: str) -> Dict[str, Any]:
+        with self._lock:
+            return dict(self._data.get(namespace, {}))
+
+    async def close(self):
+        pass
+
+
+class RedisStateBackend(StateBackend):
+    """State backend storing each namespace as a Redis hash of JSON values"""
+
+    shared = True
+
+    def __init__(self, url: str = REDIS_URL, prefix: str = STATE_KEY_PREFIX):
+        super().__init__()
+        import redis.asyncio as aioredis
+        self.url = url
+        self.prefix = prefix
+        self._redis = aioredis.from_url(url, decode_responses=True)
+
+    def _key(self, namespace: str) -> str:
+        return f"{self.prefix}:{namespace}"
+
+    async def get(self, namespace: str, key: str) -> Optional[Any]:
+        value = await self._redis.hget(self._key(namespace), key)
+        return json.loads(value) if value is not None else None
+
+    async def set(self, namespace: str, key: str, value: Any):
+        await self._redis.hset(self._key(namespace), key, json.dumps(value))
+
+    async def delete(self, namespace: str, key: str):
+        await self._redis.hdel(self._key(namespace), key)
+
+    async def items(self, namespace: str) -> Dict[str, Any]:
+        values = await self._redis.hgetall(self._key(namespace))
+        return {key: json.loads(value) for key, value in values.items()}
+
+    async def close(self):
+        await self._redis.aclose()
+
+
+def create_state_backend(backend: str = STATE_BACKEND) -> StateBackend:
+    """Create the configured backend, falling back to the in-memory backend if Redis is unavailable"""
+    if backend == 'redis':
+        try:
+            return RedisStateBackend()
+        except ImportError:
+            logger.warning("redis package is not installed, using the in-memory state backend")
+    return StateBackend()
+
+
+state_backend = create_state_backend()
@@ -10,14 +10,18 @@ import logging
 import json
 import base64
 from dotenv import load_dotenv
-import boto3
 from strands import Agent, tool
 from strands.models.openai import OpenAIModel
 from strands.models import BedrockModel
 from chat_client import ChatClient
 from mcp_client_strands import StrandsMCPClient
-from strands.agent.conversation_manager import SlidingWindowConversationManager
-from botocore.config import Config
+from conversation_manager import TokenBudgetConversationManager, context_budget
+from stage_timer import stage
+from prompt_cache import CachePointBedrockModel
+from fake_model import FakeModel
+from tool_result_cache import wrap_cached_tools
+from aws_clients import aws_client_registry
+from utils import get_model_config
 from custom_tools import mem0_memory
 from strands.telemetry import StrandsTelemetry
 from constant import *
@@ -88,18 +92,16 @@ class StrandsAgentClient(ChatClient):
                     "temperature": temperature,
                 }
             )
+        elif self.model_provider == 'fake':
+            # 离线压测用的模拟模型, 见benchmarks/loadtest
+            return FakeModel(model_id=model_id)
         elif self.model_provider == 'bedrock':
-            # Create a custom boto3 session
-            if self.env['AWS_ACCESS_KEY_ID']:
-                session = boto3.Session(
-                    aws_access_key_id=self.env['AWS_ACCESS_KEY_ID'],
-                    aws_secret_access_key=self.env['AWS_SECRET_ACCESS_KEY'],
-                    region_name=self.env['AWS_REGION']
-                )
-            else:
-                session = boto3.Session(
-                    region_name=self.env['AWS_REGION']
-                )
+            # Reuse the process-wide session for these credentials
+            session = aws_client_registry.get_session(
+                region_name=self.env['AWS_REGION'],
+                aws_access_key_id=self.env['AWS_ACCESS_KEY_ID'] or None,
+                aws_secret_access_key=self.env['AWS_SECRET_ACCESS_KEY'] or None,
+            )
             
             additional_request_fields = {
                     "thinking": {
@@ -113,45 +115,52 @@ class StrandsAgentClient(ChatClient):
             
             if model_id in [CLAUDE_4_SONNET_MODEL_ID,CLAUDE_4_OPUS_MODEL_ID,CLAUDE_37_SONNET_MODEL_ID,CLAUDE_35_SONNET_MODEL_ID]:
                 cache_tools = "default"
+                # 支持prompt cache的模型在对话消息上也放置cache point
+                model_class = CachePointBedrockModel
             else:
                 cache_tools = None
+                model_class = BedrockModel
                 
             if model_id in [CLAUDE_4_SONNET_MODEL_ID,CLAUDE_4_OPUS_MODEL_ID,CLAUDE_37_SONNET_MODEL_ID] and thinking:
                 temperature = 1.0
 
-            return BedrockModel(
+            # BedrockModel owns its bedrock-runtime client, so the model itself is
+            # cached per configuration and its connection pool is reused across turns
+            model_key = ('bedrock', id(session), model_id, bool(thinking), thinking_budget, max_tokens, temperature)
+            return aws_client_registry.get_or_create(model_key, lambda: model_class(
                 model_id=model_id,
                 boto_session=session,
                 cache_tools=cache_tools,
                 cache_prompt="default",
                 max_tokens=max_tokens,
                 temperature=temperature,
-                boto_client_config=Config(
+                boto_client_config=aws_client_registry.client_config(
                             read_timeout=900,
                             connect_timeout=30,
                             retries=dict(max_attempts=3, mode="adaptive"),
                             ),
                 additional_request_fields=additional_request_fields,
-            )
+            ))
         else:
             # Default to Bedrock
-            session = boto3.Session(
-                aws_access_key_id=self.env['AWS_ACCESS_KEY_ID'],
-                aws_secret_access_key=self.env['AWS_SECRET_ACCESS_KEY'],
-                region_name=self.env['AWS_REGION']
+            session = aws_client_registry.get_session(
+                region_name=self.env['AWS_REGION'],
+                aws_access_key_id=self.env['AWS_ACCESS_KEY_ID'] or None,
+                aws_secret_access_key=self.env['AWS_SECRET_ACCESS_KEY'] or None,
             )
             
-            return BedrockModel(
+            model_key = (self.model_provider, id(session), model_id, max_tokens, temperature)
+            return aws_client_registry.get_or_create(model_key, lambda: BedrockModel(
                 model_id=model_id,
                 boto_session=session,
                 max_tokens=max_tokens,
                 temperature=temperature,
-                boto_client_config=Config(
+                boto_client_config=aws_client_registry.client_config(
                 read_timeout=900,
                 connect_timeout=900,
                 retries=dict(max_attempts=3, mode="adaptive"),
                 ),
-            )
+            ))
         
     def _convert_messages_to_strands_format(self, messages, system=None):
         """Convert Bedrock message format to Strands format"""
@@ -226,6 +235,10 @@ class StrandsAgentClient(ChatClient):
                 if isinstance(mcp_client, StrandsMCPClient):
                     # Get tools from Strands MCP client
                     strands_tools = mcp_client.get_tools(server_id)
+                    # 按server配置中的result_cache缓存幂等工具的结果
+                    strands_tools = wrap_cached_tools(strands_tools, server_id,
+                                                      mcp_client.get_result_cache_config(server_id), self.user_id,
+                                                      shared=mcp_client.shared)
                     tools.extend(strands_tools)
                     logger.info(f"Added {len(strands_tools)} Strands tools from server: {server_id}")
                 else:
@@ -248,7 +261,10 @@ class StrandsAgentClient(ChatClient):
         """Create a Strands agent with MCP tools"""
         
         # Create MCP tools
-        mcp_tools = await self._create_mcp_tools(mcp_clients, mcp_server_ids)
+        with stage("create_mcp_tools"):
+            mcp_tools = await self._create_mcp_tools(mcp_clients, mcp_server_ids)
+        # 工具列表是prompt cache前缀的一部分, 按名称排序使其不随server的连接顺序变化
+        mcp_tools.sort(key=lambda t: t.tool_name)
         logger.info(mcp_tools)
         
         # Add Strands built-in tools by default (configurable via environment)
@@ -287,16 +303,22 @@ class StrandsAgentClient(ChatClient):
         # add stop tool
         # tools += [stop]
         # Create agent
+        system_prompt = system_prompt or "You are a helpful assistant."
+        # 按模型的上下文长度(conf/config.json中的max_context_tokens)裁剪对话
+        budget = context_budget(get_model_config(model_id).get('max_context_tokens'), max_tokens, system_prompt)
         agent = Agent(
             model=model,
             messages=messages,
-            conversation_manager = SlidingWindowConversationManager(
-                window_size=window_size,  # Maximum number of message pairs to keep
+            conversation_manager = TokenBudgetConversationManager(
+                budget=budget,
+                window_size=window_size,  # Maximum number of messages to keep
             ),
             # callback_handler=None,
-            system_prompt=system_prompt or "You are a helpful assistant.",
+            system_prompt=system_prompt,
             tools=tools,
             load_tools_from_directory=False
         )
+        # 第一次调用模型前就保证历史消息在预算内, 这里在服务器的event loop上, 不做同步的总结调用
+        agent.conversation_manager.apply_management(agent, summarize=False)
         
         return agent
\ No newline at end of file
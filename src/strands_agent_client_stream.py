@@ -16,9 +16,14 @@ from typing import Dict, AsyncGenerator, Optional, List, AsyncIterator, Any
 from dotenv import load_dotenv
 from strands_agent_client import StrandsAgentClient
 from mcp_client_strands import StrandsMCPClient
-from utils import maybe_filter_to_n_most_recent_images, remove_cache_checkpoint,get_stream_id
+from utils import maybe_filter_to_n_most_recent_images, remove_cache_checkpoint
+from prompt_cache import prompt_cache_tracker
+from cancellation import cancellation_bus
+from loop_pool import get_worker_loop_pool
+from stream_channel import StreamChannel
+from blob_store import materialize_attachments
+from stage_timer import stage, current as current_stage_timer
 from constant import *
-import queue
 
 load_dotenv()  # load environment variables from .env
 
@@ -28,6 +33,12 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# Agent流的执行方式:
+#   thread - 每个流一个agent线程，创建自己的event loop
+#   loop   - agent流作为task运行在服务器的event loop上
+#   pool   - agent流分配到固定数量的worker loop上(AGENT_LOOP_WORKERS)
+AGENT_EXECUTION_MODE = os.environ.get("AGENT_EXECUTION_MODE", "thread").lower()
+
 class StrandsAgentClientStream(StrandsAgentClient):
     """Extended Strands Agent Client with streaming support"""
     
@@ -37,15 +48,15 @@ class StrandsAgentClientStream(StrandsAgentClient):
                         model_provider, api_key, api_base)
         # Stream-specific properties
         self.stop_flags = {}  # Dict to track stop flags for streams
-        self.monitor_threads = {}  # Dict to track monitor threads for streams
-        self.thread_stop_events = {}  # Dict to track stop events for threads
         self.agent_threads = {}  # Dict to track agent processing threads
         self.agent_stop_events = {}  # Dict to track stop events for agent threads
-        self.stream_queues = {}  # Dict to store stream results from agent threads
+        self.stream_queues = {}  # Dict to store the StreamChannel of each stream
+        self.agent_tasks = {}  # Dict to track agent tasks/futures in loop and pool modes
         
     def register_stream(self, stream_id):
-        """Register a new stream with a stop flag"""
+        """Register a new stream with a stop flag and subscribe it to stop requests"""
         self.stop_flags[stream_id] = False
+        cancellation_bus.subscribe(stream_id, self.stop_stream)
         logger.info(f"Registered stream: {stream_id}")
     
     def stop_stream(self, stream_id):
@@ -53,6 +64,9 @@ class StrandsAgentClientStream(StrandsAgentClient):
         if stream_id in self.stop_flags:
             self.stop_flags[stream_id] = True
             logger.info(f"Stopping stream: {stream_id}")
+            # Wake the consumer so the stop takes effect without waiting for the next token
+            if stream_id in self.stream_queues:
+                self.stream_queues[stream_id].put({"type": "wake"})
             return True
         return False
 
@@ -61,45 +75,12 @@ class StrandsAgentClientStream(StrandsAgentClient):
         if stream_id in self.stop_flags:
             del self.stop_flags[stream_id]
             logger.info(f"Unregistered stream: {stream_id}")
+        cancellation_bus.unsubscribe(stream_id)
         
-        # Stop and clean up monitor thread
-        self._stop_monitor_thread(stream_id)
-            
-    def _start_monitor_thread(self, stream_id: str):
-        """Start a monitor thread for the given stream"""
-        if stream_id in self.monitor_threads:
-            logger.warning(f"Monitor thread for stream {stream_id} already exists")
-            return
-            
-        # Create stop event for this thread
-        stop_event = threading.Event()
-        self.thread_stop_events[stream_id] = stop_event
-        
-        # Create and start monitor thread
-        monitor_thread = threading.Thread(
-            target=self._monitor_stream_status,
-            args=(stream_id, stop_event),
-            daemon=True,
-            name=f"StreamMonitor-{stream_id}"
-        )
-        self.monitor_threads[stream_id] = monitor_thread
-        monitor_thread.start()
-        logger.info(f"Started monitor thread for stream: {stream_id}")
-    
-    def _stop_monitor_thread(self, stream_id: str):
-        """Stop the monitor thread for the given stream"""
-        if stream_id in self.thread_stop_events:
-            self.thread_stop_events[stream_id].set()
-            del self.thread_stop_events[stream_id]
+        # Stop and clean up agent thread or task
+        self._stop_agent_thread(stream_id)
+        self._stop_agent_task(stream_id)
             
-        if stream_id in self.monitor_threads:
-            monitor_thread = self.monitor_threads[stream_id]
-            # Give thread a moment to stop gracefully
-            monitor_thread.join(timeout=1.0)
-            del self.monitor_threads[stream_id]
-            logger.info(f"Stopped monitor thread for stream: {stream_id}")
-            self._stop_agent_thread(stream_id)
-    
     def _start_agent_thread(self, stream_id: str, prompt: str):
         """Start an agent processing thread for the given stream"""
         if stream_id in self.agent_threads:
@@ -110,9 +91,8 @@ class StrandsAgentClientStream(StrandsAgentClient):
         stop_event = threading.Event()
         self.agent_stop_events[stream_id] = stop_event
         
-        # Create queue for stream results
-        import queue
-        stream_queue = queue.Queue()
+        # Create channel for stream results, consumed on the calling loop
+        stream_queue = StreamChannel()
         self.stream_queues[stream_id] = stream_queue
         
         # Create and start agent thread
@@ -155,14 +135,42 @@ class StrandsAgentClientStream(StrandsAgentClient):
             logger.info(f"Stopped agent thread for stream: {stream_id}")
             
         if stream_id in self.stream_queues:
-            # Clear the queue to free memory
-            stream_queue = self.stream_queues[stream_id]
-            try:
-                while not stream_queue.empty():
-                    stream_queue.get_nowait()
-            except:
-                pass  # Queue might be empty or have other issues
-            del self.stream_queues[stream_id]
+            # Drop late events to free memory
+            self.stream_queues.pop(stream_id).close()
+    
+    def _start_agent_task(self, stream_id: str, prompt: str):
+        """Start agent processing on the server loop or on a worker loop, without new threads"""
+        if stream_id in self.agent_tasks:
+            logger.warning(f"Agent task for stream {stream_id} already exists")
+            return
+        
+        stop_event = threading.Event()
+        self.agent_stop_events[stream_id] = stop_event
+        
+        # The consumer awaits this channel on the server loop, the producer may run on a worker loop
+        stream_queue = StreamChannel()
+        self.stream_queues[stream_id] = stream_queue
+        
+        worker = self._agent_stream_worker(stream_id, prompt, stop_event, stream_queue.put)
+        if AGENT_EXECUTION_MODE == 'pool':
+            self.agent_tasks[stream_id] = get_worker_loop_pool().submit(worker)
+        else:
+            self.agent_tasks[stream_id] = asyncio.create_task(worker)
+
+        logger.info(f"Started agent task for stream: {stream_id} ({AGENT_EXECUTION_MODE} mode)")
+    
+    def _stop_agent_task(self, stream_id: str):
+        """Cancel the agent task of the given stream"""
+        if stream_id not in self.agent_tasks:
+            return
+        if stream_id in self.agent_stop_events:
+            self.agent_stop_events[stream_id].set()
+            del self.agent_stop_events[stream_id]
+        # Both asyncio.Task and concurrent.futures.Future are cancelled without blocking
+        self.agent_tasks.pop(stream_id).cancel()
+        if stream_id in self.stream_queues:
+            self.stream_queues.pop(stream_id).close()
+        logger.info(f"Stopped agent task for stream: {stream_id}")
     
     def _run_agent_stream(self, stream_id: str, prompt: str, stop_event: threading.Event, stream_queue):
         """Run agent stream processing in a separate thread"""
@@ -174,7 +182,7 @@ class StrandsAgentClientStream(StrandsAgentClient):
             asyncio.set_event_loop(loop)
             
             # Run the agent stream processing
-            loop.run_until_complete(self._agent_stream_worker(stream_id, prompt, stop_event, stream_queue))
+            loop.run_until_complete(self._agent_stream_worker(stream_id, prompt, stop_event, stream_queue.put))
             
         except Exception as e:
             logger.error(f"Error in agent thread for stream {stream_id}: {e}")
@@ -183,8 +191,8 @@ class StrandsAgentClientStream(StrandsAgentClient):
         finally:
             logger.info(f"Agent thread for stream {stream_id} terminated")
     
-    async def _agent_stream_worker(self, stream_id: str, prompt: str, stop_event: threading.Event, stream_queue):
-        """Async worker for agent stream processing"""
+    async def _agent_stream_worker(self, stream_id: str, prompt: str, stop_event: threading.Event, emit):
+        """Async worker for agent stream processing, `emit` hands each event to the consumer"""
         try:
             if not self.agent:
                 logger.error(f"No agent available for stream {stream_id}")
@@ -197,54 +205,16 @@ class StrandsAgentClientStream(StrandsAgentClient):
                     break
                 # logger.info(event)
                 # Put event in queue for main thread to consume
-                stream_queue.put(event)
+                emit(event)
                 
             #save history message as stream end
             await self.save_history()
             # Signal end of stream
-            stream_queue.put({"type": "stream_end"})
+            emit({"type": "stream_end"})
             
         except Exception as e:
             logger.error(f"Error in agent stream worker for {stream_id}: {e}")
-            stream_queue.put({"type": "error", "data": {"message": str(e)}})
-    
-    def _monitor_stream_status(self, stream_id: str, stop_event: threading.Event):
-        """Monitor stream status in a separate thread"""
-        logger.info(f"Monitor thread started for stream: {stream_id}")
-        
-        # Create event loop once for this thread
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        
-        try:
-            while not stop_event.is_set():
-                try:
-                    # Check if stream still exists in remote DDB
-                    stream_exists = loop.run_until_complete(get_stream_id(stream_id=stream_id))
-                    
-                    # If stream doesn't exist and agent exists, clean up
-                    if not stream_exists and hasattr(self, 'agent') and self.agent:
-                        logger.info(f"Stream {stream_id} not found in remote, cleaning up agent")
-                        # Set stop flag to terminate the stream
-                        if stream_id in self.stop_flags:
-                            self.stop_flags[stream_id] = True
-                        # Clean up agent
-                        # del self.agent
-                        # self.agent = None
-                        break
-                        
-                except Exception as e:
-                    logger.error(f"Error in monitor thread for stream {stream_id}: {e}")
-                
-                # Wait for 3 seconds before next check
-                if stop_event.wait(timeout=3.0):
-                    break  # Stop event was set, exit immediately
-                
-        except Exception as e:
-            logger.error(f"Monitor thread for stream {stream_id} encountered error: {e}")
-        finally:
-            loop.close()
-            logger.info(f"Monitor thread for stream {stream_id} terminated")
+            emit({"type": "error", "data": {"message": str(e)}})
     
     async def   _process_stream_response(self, stream_id: Optional[str], response) -> AsyncIterator[Dict]:
         """Process the raw response from converse_stream"""
@@ -312,7 +282,8 @@ class StrandsAgentClientStream(StrandsAgentClient):
         # must be kept with Strands
         keep_session = True
         if keep_session:
-            history = await self.load_history()
+            with stage("load_history"):
+                history = await self.load_history()
             if history:
                 messages = history + messages 
             system = self.system if self.system else system #system 消息每次都会传入
@@ -320,12 +291,13 @@ class StrandsAgentClientStream(StrandsAgentClient):
             await self.clear_history()
             
         logger.info(f'llm input message list length:{len(messages)}')
+        # 附件在history中只保存blobRef, 调用模型前再读取内容
+        with stage("materialize_attachments"):
+            await materialize_attachments(messages)
         
         # Register this stream if an ID is provided
         if stream_id:
             self.register_stream(stream_id)
-            # Start monitor thread for this stream
-            self._start_monitor_thread(stream_id)
         
         # Convert system messages to system prompt
         system_prompt = ""
@@ -334,9 +306,10 @@ class StrandsAgentClientStream(StrandsAgentClient):
                 if isinstance(item, dict) and "text" in item:
                     system_prompt += item["text"]
         
-        # 添加用户id标志，用于mem0
-        user_identity = f"\nHere is the request from User with user id:{self.user_id}\n"
-        system_prompt += user_identity
+        # 添加用户id标志，用于mem0; 不使用mem0时不添加, 使不同用户的system prompt相同, 可以共享prompt cache
+        if use_mem:
+            user_identity = f"\nHere is the request from User with user id:{self.user_id}\n"
+            system_prompt += user_identity
         # Convert messages to Strands format
         
         
@@ -355,19 +328,20 @@ class StrandsAgentClientStream(StrandsAgentClient):
         thinking_budget = extra_params.get("budget_tokens",4096)
         max_tokens = max(thinking_budget + 1, max_tokens) if thinking else max_tokens
         # Create agent with MCP tools
-        self.agent = await self._create_agent_with_tools(
-            messages=history_messages,
-            model_id=model_id,
-            mcp_clients=mcp_clients,
-            mcp_server_ids=mcp_server_ids,
-            system_prompt=system_prompt,
-            thinking=thinking,
-            thinking_budget=thinking_budget,
-            max_tokens=max_tokens,
-            temperature=temperature,
-            use_mem=use_mem,
-            use_swarm=use_swarm
-        )
+        with stage("create_agent"):
+            self.agent = await self._create_agent_with_tools(
+                messages=history_messages,
+                model_id=model_id,
+                mcp_clients=mcp_clients,
+                mcp_server_ids=mcp_server_ids,
+                system_prompt=system_prompt,
+                thinking=thinking,
+                thinking_budget=thinking_budget,
+                max_tokens=max_tokens,
+                temperature=temperature,
+                use_mem=use_mem,
+                use_swarm=use_swarm
+            )
         
         current_content = ""
         turn_i = 1
@@ -389,15 +363,20 @@ class StrandsAgentClientStream(StrandsAgentClient):
             yield {"type": "error", "data": {"message": "无stream id"}}
             return
             
-        # Start agent thread to handle stream processing
-        self._start_agent_thread(stream_id, prompt)
+        # Start agent thread (or task) to handle stream processing
+        with stage("agent_start"):
+            if AGENT_EXECUTION_MODE == 'thread':
+                self._start_agent_thread(stream_id, prompt)
+            else:
+                self._start_agent_task(stream_id, prompt)
+        timer = current_stage_timer()
         
-        # Get events from agent thread via queue
+        # Get events from agent thread via channel, the consumer is woken by each event
         stream_queue = self.stream_queues[stream_id]
         
         while True:
             try:
-                event = stream_queue.get(timeout=1)
+                event = await stream_queue.get()
                 # Check if stream should stop
                 if stream_id in self.stop_flags and self.stop_flags[stream_id]:
                     logger.info(f"Stream {stream_id} was requested to stop")
@@ -406,6 +385,12 @@ class StrandsAgentClientStream(StrandsAgentClient):
                     break
                 
                 # Handle special control events
+                if event.get("type") == "wake":
+                    continue
+                if timer is not None:
+                    # 自请求开始到收到模型的第一个事件, 只记录第一次
+                    timer.mark("model_first_byte")
+
                 if event.get("type") == "stream_end":
                     logger.info(f"Stream {stream_id} ended normally")
                     break
@@ -417,16 +402,6 @@ class StrandsAgentClientStream(StrandsAgentClient):
                 # Yield normal events
                 yield event
                 
-            except queue.Empty:
-                # Yield control to event loop more frequently
-                await asyncio.sleep(0.01)
-                # Check if we should continue waiting
-                if stream_id in self.stop_flags and self.stop_flags[stream_id]:
-                    # self.agent.tool.stop(reason="User requested to stop")
-                    logger.info(f"Stream {stream_id} timed out and stop flag is set")
-                    yield {"type": "stopped", "data": {"message": "Stream stopped by user request"}}
-                    break
-                continue
             except Exception as e:
                 logger.error(f"Error getting event from queue for stream {stream_id}: {e}")
                 break
@@ -474,6 +449,10 @@ class StrandsAgentClientStream(StrandsAgentClient):
                     sent_results_history[toolUseId] = toolUseId
                     # logger.info(new_event)
                 
+            # 按用户和模型统计prompt cache的读写token
+            if event["type"] == "metadata":
+                prompt_cache_tracker.record(self.user_id, model_id, event["data"].get("usage", {}))
+
             if event["type"] == "message_stop":
                 # Save the system to session
                 self.system = system
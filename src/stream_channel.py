@@ -0,0 +1,77 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Thread-safe async channel between an agent producer and the SSE consumer
+
+The producer may run on any thread or event loop (an agent thread, a worker
+loop or the server loop itself). The consumer awaits `get()` on the loop that
+created the channel, so it is woken as soon as an item arrives, with no polling
+and without ever blocking that loop.
+"""
+import asyncio
+import collections
+from typing import Any, Optional
+
+
+class StreamChannel:
+    """
+    Unbounded multi-producer, single-consumer channel
+
+    Items from other threads are appended to a deque and at most one drain
+    callback is scheduled on the consumer loop per burst, so a fast producer
+    does not pay one loop wakeup per token.
+    """
+
+    def __init__(self, loop: Optional[asyncio.AbstractEventLoop] = None):
+        """
+        Args:
+            loop: Loop of the consumer, defaults to the running loop
+        """
+        self._loop = loop or asyncio.get_running_loop()
+        self._queue: asyncio.Queue = asyncio.Queue()
+        self._pending = collections.deque()
+        self._drain_scheduled = False
+        self._closed = False
+
+    def _drain(self):
+        # clear the flag before draining so an item appended meanwhile schedules another drain
+        self._drain_scheduled = False
+        while self._pending:
+            self._queue.put_nowait(self._pending.popleft())
+
+    def _on_consumer_loop(self) -> bool:
+        try:
+            return asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            return False
+
+    def put(self, item: Any):
+        """Hand an item to the consumer, callable from any thread"""
+        if self._closed:
+            return
+        if self._on_consumer_loop():
+            self._drain()
+            self._queue.put_nowait(item)
+            return
+        self._pending.append(item)
+        if not self._drain_scheduled:
+            self._drain_scheduled = True
+            try:
+                self._loop.call_soon_threadsafe(self._drain)
+            except RuntimeError:
+                # consumer loop already closed
+                self._closed = True
+
+    async def get(self) -> Any:
+        """Wait for the next item"""
+        return await self._queue.get()
+
+    def close(self):
+        """Drop items put after this point"""
+        self._closed = True
+        self._pending.clear()
+
+    def qsize(self) -> int:
+        return self._queue.qsize() + len(self._pending)
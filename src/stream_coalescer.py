@@ -0,0 +1,128 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Adaptive coalescing of text deltas between process_query_stream and the SSE writer
+
+Consecutive text (or reasoning text) deltas of the same content block are merged
+into one block_delta until a byte budget or a time budget is reached, so a fast
+model produces a few larger SSE frames instead of one frame per token. Every
+other event (tool input, block start/stop, message stop, tool results, errors)
+flushes the pending text first and is passed through immediately.
+
+Enabled per request with extra_params:
+    {"coalesce_deltas": true, "coalesce_max_bytes": 2048, "coalesce_max_ms": 20}
+"""
+import time
+import asyncio
+from typing import Any, AsyncIterator, Dict, Optional, Tuple
+
+COALESCE_MAX_BYTES = 2048
+COALESCE_MAX_MS = 20
+
+_SOURCE_DONE = object()
+
+
+def _text_delta(event: Dict[str, Any]) -> Optional[Tuple[Any, str, str]]:
+    """Return (block index, kind, text) of a mergeable delta, None otherwise"""
+    if event.get("type") != "block_delta":
+        return None
+    data = event.get("data", {})
+    delta = data.get("delta", {})
+    if len(delta) != 1:
+        return None
+    if "text" in delta:
+        return data.get("contentBlockIndex"), "text", delta["text"]
+    reasoning = delta.get("reasoningContent")
+    if isinstance(reasoning, dict) and list(reasoning) == ["text"]:
+        return data.get("contentBlockIndex"), "reasoningContent", reasoning["text"]
+    return None
+
+
+def _merged_event(block_index: Any, kind: str, text: str) -> Dict[str, Any]:
+    delta = {"text": text} if kind == "text" else {"reasoningContent": {"text": text}}
+    return {"type": "block_delta", "data": {"delta": delta, "contentBlockIndex": block_index}}
+
+
+async def _pump(stream: AsyncIterator, queue: asyncio.Queue):
+    try:
+        async for event in stream:
+            await queue.put(event)
+    except Exception as e:
+        await queue.put(e)
+        return
+    await queue.put(_SOURCE_DONE)
+
+
+async def coalesce_deltas(stream: AsyncIterator[Dict[str, Any]], max_bytes: int = COALESCE_MAX_BYTES,
+                          max_ms: float = COALESCE_MAX_MS) -> AsyncIterator[Dict[str, Any]]:
+    """
+    Merge consecutive text deltas of `stream`
+
+    Args:
+        stream: Events of process_query_stream
+        max_bytes: Flush once the pending text reaches this many UTF-8 bytes
+        max_ms: Flush once the oldest pending delta has waited this long
+
+    Yields:
+        The same events, with runs of text deltas merged
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=256)
+    pump = asyncio.create_task(_pump(stream, queue))
+    max_wait = max_ms / 1000
+    pending_key = None
+    pending_parts = []
+    pending_bytes = 0
+    deadline = 0.0
+    try:
+        while True:
+            if pending_parts:
+                remaining = deadline - time.monotonic()
+                try:
+                    if queue.empty():
+                        if remaining <= 0:
+                            raise TimeoutError
+                        async with asyncio.timeout(remaining):
+                            event = await queue.get()
+                    else:
+                        event = queue.get_nowait()
+                except TimeoutError:
+                    yield _merged_event(*pending_key, "".join(pending_parts))
+                    pending_key, pending_parts, pending_bytes = None, [], 0
+                    continue
+            else:
+                event = await queue.get()
+
+            if event is _SOURCE_DONE or isinstance(event, Exception):
+                if pending_parts:
+                    yield _merged_event(*pending_key, "".join(pending_parts))
+                if isinstance(event, Exception):
+                    raise event
+                return
+
+            text_delta = _text_delta(event)
+            if text_delta is not None:
+                block_index, kind, text = text_delta
+                if pending_parts and pending_key != (block_index, kind):
+                    yield _merged_event(*pending_key, "".join(pending_parts))
+                    pending_key, pending_parts, pending_bytes = None, [], 0
+                if not pending_parts:
+                    pending_key = (block_index, kind)
+                    deadline = time.monotonic() + max_wait
+                pending_parts.append(text)
+                pending_bytes += len(text.encode('utf-8'))
+                if pending_bytes >= max_bytes or max_wait <= 0:
+                    yield _merged_event(*pending_key, "".join(pending_parts))
+                    pending_key, pending_parts, pending_bytes = None, [], 0
+                continue
+
+            # tool, stop and control events are never delayed
+            if pending_parts:
+                yield _merged_event(*pending_key, "".join(pending_parts))
+                pending_key, pending_parts, pending_bytes = None, [], 0
+            yield event
+    finally:
+        if not pump.done():
+            pump.cancel()
+        await asyncio.gather(pump, return_exceptions=True)
@@ -0,0 +1,85 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Fan-in of several async generators into one
+
+Each source is drained by one pump task into a shared queue, so merging costs a
+queue put/get per item instead of a new task and an asyncio.wait per item, and
+the consumer is woken only when an item is available.
+"""
+import asyncio
+import logging
+from typing import Any, AsyncIterator
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
+)
+logger = logging.getLogger(__name__)
+
+# 每个流最多预取的事件数
+MERGE_QUEUE_SIZE = 64
+
+_SOURCE_DONE = object()
+
+
+class _SourceError:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+def is_main_stream_end(item: Any) -> bool:
+    """只有在明确的结束条件下才停止所有流: stopped, error, 或end_turn/max_tokens的message_stop"""
+    if not isinstance(item, dict):
+        return False
+    item_type = item.get("type")
+    if item_type in ("stopped", "error"):
+        return True
+    if item_type == "message_stop":
+        return item.get("data", {}).get("stopReason") in ['end_turn', 'max_tokens']
+    return False
+
+
+async def _pump(stream: AsyncIterator, queue: asyncio.Queue):
+    # CancelledError is not caught, a cancelled pump does not report completion
+    try:
+        async for item in stream:
+            await queue.put(item)
+    except Exception as e:
+        await queue.put(_SourceError(e))
+        return
+    await queue.put(_SOURCE_DONE)
+
+
+async def merge_streams(*streams: AsyncIterator) -> AsyncIterator[Any]:
+    """
+    合并多个异步生成器流
+
+    Items are yielded in arrival order. Merging stops when every source is
+    exhausted or when the main stream signals its end (see is_main_stream_end).
+    An exception raised by a source is re-raised to the consumer.
+    """
+    queue: asyncio.Queue = asyncio.Queue(maxsize=MERGE_QUEUE_SIZE * max(1, len(streams)))
+    pumps = [asyncio.create_task(_pump(stream, queue)) for stream in streams]
+    remaining = len(pumps)
+    try:
+        while remaining:
+            item = await queue.get()
+            if item is _SOURCE_DONE:
+                remaining -= 1
+                continue
+            if isinstance(item, _SourceError):
+                logger.error(f"Error in merged stream task: {item.error}")
+                raise item.error
+            yield item
+            if is_main_stream_end(item):
+                logger.info("Main stream ended, stopping all streams")
+                break
+    finally:
+        # 清理所有剩余的pump任务
+        for pump in pumps:
+            if not pump.done():
+                pump.cancel()
+        await asyncio.gather(*pumps, return_exceptions=True)
@@ -0,0 +1,190 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Result cache for idempotent MCP tool calls
+
+Opt-in per server with a `result_cache` entry in the server config:
+
+    "mysql": {
+        "command": "uvx", "args": ["mysql_mcp_server"],
+        "result_cache": {
+            "ttl": 300,                 # seconds, default MCP_TOOL_RESULT_CACHE_TTL
+            "scope": "global",          # "user" (default) or "global"
+            "tools": {                  # omitted: every tool of the server
+                "describe_table": {"ttl": 3600},
+                "list_tables": {}
+            }
+        }
+    }
+
+`tools` may also be a list of tool names. Calls are keyed by scope, server,
+tool name and the canonical JSON of the arguments; only successful results are
+cached. The global scope is only honoured for the shared servers of --mcp-conf:
+users choose both the id and the config of the servers they add, so their
+results always stay in the user scope. Entries live in one process-wide LRU of MCP_TOOL_RESULT_CACHE_SIZE
+entries, results above MCP_TOOL_RESULT_CACHE_MAX_BYTES are not cached.
+"""
+import os
+import copy
+import json
+import logging
+import threading
+from typing import Any, Dict, List, Optional
+from strands.types.tools import AgentTool, ToolGenerator, ToolSpec, ToolUse
+from ttl_cache import TTLCache
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
+)
+logger = logging.getLogger(__name__)
+
+# 未在result_cache中指定ttl时的缓存时间(秒)
+MCP_TOOL_RESULT_CACHE_TTL = float(os.environ.get("MCP_TOOL_RESULT_CACHE_TTL", 300))
+# 缓存的工具结果条数上限(LRU淘汰)
+MCP_TOOL_RESULT_CACHE_SIZE = int(os.environ.get("MCP_TOOL_RESULT_CACHE_SIZE", 2000))
+# 超过该大小的工具结果不缓存
+MCP_TOOL_RESULT_CACHE_MAX_BYTES = int(os.environ.get("MCP_TOOL_RESULT_CACHE_MAX_BYTES", 1024 * 1024))
+# 命中统计最多记录的server/tool数, 之后新的server/tool计入other
+MCP_TOOL_RESULT_STATS_MAX_TOOLS = int(os.environ.get("MCP_TOOL_RESULT_STATS_MAX_TOOLS", 500))
+
+SCOPES = ("user", "global")
+
+tool_result_cache = TTLCache(MCP_TOOL_RESULT_CACHE_TTL, max_size=MCP_TOOL_RESULT_CACHE_SIZE,
+                             name="mcp_tool_results")
+
+# (server_id, tool_name) -> {"hits": n, "misses": n}
+tool_result_stats: Dict[tuple, Dict[str, int]] = {}
+_tool_result_stats_lock = threading.Lock()
+OTHER_TOOLS = ("other", "other")
+
+
+def _count(server_id: str, tool_name: str, counter: str):
+    key = (server_id, tool_name)
+    with _tool_result_stats_lock:
+        # server和tool的id由用户决定, 统计的条数有上限
+        if key not in tool_result_stats and len(tool_result_stats) >= MCP_TOOL_RESULT_STATS_MAX_TOOLS:
+            key = OTHER_TOOLS
+        counters = tool_result_stats.setdefault(key, {"hits": 0, "misses": 0})
+        counters[counter] += 1
+
+
+def canonical_arguments(arguments: Any) -> str:
+    """Arguments as JSON with sorted keys, so equal arguments give equal keys"""
+    return json.dumps(arguments, sort_keys=True, separators=(',', ':'), ensure_ascii=False, default=str)
+
+
+def _result_size(result: Dict[str, Any]) -> int:
+    size = 0
+    for item in result.get("content", []):
+        if "text" in item:
+            size += len(item["text"])
+        elif "json" in item:
+            size += len(canonical_arguments(item["json"]))
+        else:
+            for value in item.values():
+                data = value.get("source", {}).get("bytes", b"") if isinstance(value, dict) else b""
+                size += len(data)
+    return size
+
+
+def tool_cache_policy(config: Optional[Dict[str, Any]], tool_name: str) -> Optional[Dict[str, Any]]:
+    """TTL and scope for `tool_name` under the server's result_cache config, None if not cached"""
+    if not config:
+        return None
+    tools = config.get("tools")
+    if tools is None:
+        tool_config = {}
+    elif isinstance(tools, list):
+        if tool_name not in tools:
+            return None
+        tool_config = {}
+    elif tool_name in tools:
+        tool_config = tools[tool_name] or {}
+    else:
+        return None
+    ttl = float(tool_config.get("ttl", config.get("ttl", MCP_TOOL_RESULT_CACHE_TTL)))
+    scope = tool_config.get("scope", config.get("scope", "user"))
+    if scope not in SCOPES:
+        logger.warning(f"Unknown result cache scope {scope} of tool {tool_name}, using user scope")
+        scope = "user"
+    return {"ttl": ttl, "scope": scope} if ttl > 0 else None
+
+
+class CachedAgentTool(AgentTool):
+    """Wraps an MCP tool and serves repeated calls with the same arguments from the cache"""
+
+    def __init__(self, tool: AgentTool, server_id: str, user_id: str, ttl: float, scope: str = "user"):
+        super().__init__()
+        self._tool = tool
+        self.server_id = server_id
+        self.user_id = user_id
+        self.ttl = ttl
+        self.scope = scope
+
+    @property
+    def tool_name(self) -> str:
+        return self._tool.tool_name
+
+    @property
+    def tool_spec(self) -> ToolSpec:
+        return self._tool.tool_spec
+
+    @property
+    def tool_type(self) -> str:
+        return self._tool.tool_type
+
+    def _key(self, tool_use: ToolUse) -> tuple:
+        owner = self.user_id if self.scope == "user" else ""
+        return (owner, self.server_id, self.tool_name, canonical_arguments(tool_use.get("input") or {}))
+
+    async def stream(self, tool_use: ToolUse, invocation_state: Dict[str, Any], **kwargs: Any) -> ToolGenerator:
+        key = self._key(tool_use)
+        cached = tool_result_cache.get(key)
+        if cached is not None:
+            _count(self.server_id, self.tool_name, "hits")
+            logger.info(f"Tool result cache hit: {self.server_id}/{self.tool_name}")
+            yield {**copy.deepcopy(cached), "toolUseId": tool_use["toolUseId"]}
+            return
+
+        _count(self.server_id, self.tool_name, "misses")
+        result = None
+        async for event in self._tool.stream(tool_use, invocation_state, **kwargs):
+            result = event
+            yield event
+        # the last event of a tool stream is its result
+        if isinstance(result, dict) and result.get("status") == "success" \
+                and _result_size(result) <= MCP_TOOL_RESULT_CACHE_MAX_BYTES:
+            tool_result_cache.set(key, copy.deepcopy(result), ttl=self.ttl)
+
+
+def wrap_cached_tools(tools: List[AgentTool], server_id: str, config: Optional[Dict[str, Any]],
+                      user_id: str, shared: bool = False) -> List[AgentTool]:
+    """
+    Wrap the tools that the server's result_cache config opts in
+
+    Args:
+        shared: Whether the server is a shared global server from --mcp-conf,
+            only those may cache results in the global scope
+    """
+    if not config:
+        return tools
+    wrapped = []
+    for tool in tools:
+        policy = tool_cache_policy(config, tool.tool_name)
+        if policy and policy["scope"] == "global" and not shared:
+            logger.warning(f"Global result cache scope of {server_id}/{tool.tool_name} is only allowed "
+                           f"for global servers, using user scope")
+            policy["scope"] = "user"
+        wrapped.append(CachedAgentTool(tool, server_id, user_id, **policy) if policy else tool)
+    return wrapped
+
+
+def get_tool_result_cache_stats() -> Dict[str, Any]:
+    """Size and hit/miss counters of the cache, overall and per server/tool"""
+    with _tool_result_stats_lock:
+        tools = {f"{server_id}/{tool_name}": dict(counters)
+                 for (server_id, tool_name), counters in tool_result_stats.items()}
+    return {**tool_result_cache.stats(), "tools": tools}
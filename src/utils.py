@@ -6,18 +6,27 @@ SPDX-License-Identifier: MIT-0
 DynamoDB utility functions for the FastAPI server
 """
 import os
+import copy
 import json
+import time
 import logging
-import boto3
 from datetime import datetime
 from typing import Dict
 import hashlib
 import re
 import threading
+import weakref
 from dotenv import load_dotenv
 from urllib.parse import urlparse
 from botocore.exceptions import ClientError
+from boto3.dynamodb.conditions import Attr
 import asyncio
+import fcntl
+from ddb_storage import AsyncDDBStorage
+from ttl_cache import TTLCache
+from aws_clients import aws_client_registry
+from state_backend import state_backend
+from history_codec import encode_payload, decode_payload, chunk_count, part_key
 # Initialize logger
 
 logging.basicConfig(
@@ -29,23 +38,46 @@ logger = logging.getLogger(__name__)
 load_dotenv()  # load env vars from .env
 # DynamoDB 客户端
 dynamodb_client = None
+# 非阻塞的DynamoDB存储层，所有async helper都通过它访问DDB
+ddb_storage = None
 DDB_TABLE = os.environ.get("ddb_table")  # DynamoDB表名，用于存储用户配置
+DDB_ENDPOINT_URL = os.environ.get("DDB_ENDPOINT_URL")  # 可选，例如本地DynamoDB Local: http://localhost:8000
 user_mcp_server_configs = {}  # 用户特有的MCP服务器配置 user_id -> {server_id: config}
 global_mcp_server_configs = {}  # 全局MCP服务器配置 server_id -> config
-# 活跃流式请求的字典，用于跟踪可以停止的请求
+model_configs = {}  # conf/config.json中的模型配置 model_id -> config
+user_config_revisions = {}  # 未配置DDB时的用户配置版本号 user_id -> revision
+# 本实例的会话/配置缓存，TTL内的请求不需要访问存储
+SESSION_CACHE_TTL = float(os.environ.get("SESSION_CACHE_TTL", 60))  # seconds
+session_cache = TTLCache(SESSION_CACHE_TTL, name="session")  # user_id -> True
+user_config_cache = TTLCache(SESSION_CACHE_TTL, name="user_config")  # user_id -> (revision, configs)
+# user_id -> (end, messages), write-through; 保存的是完整历史, 条目数比其他缓存少得多
+HISTORY_CACHE_SIZE = int(os.environ.get("HISTORY_CACHE_SIZE", 500))
+user_message_cache = TTLCache(SESSION_CACHE_TTL, max_size=HISTORY_CACHE_SIZE, name="user_message")
+# 对话历史按消息逐条存储: head item `{user_id}_messages` 记录序号范围, 每条消息存为 `{user_id}_messages#{seq}`
+HISTORY_FORMAT = "turns"
+HISTORY_ITEM_KIND = "history_turn"
+HISTORY_TAIL_WINDOW = int(os.environ.get("HISTORY_TAIL_WINDOW", 0))  # 每次只加载最后N条历史消息, 0表示全部加载
+# 本worker进程中活跃流式请求的字典，用于跟踪可以停止的请求
+# 流的归属(stream_id -> user_id)在未配置DDB时保存在state_backend中，所有worker可见
 active_streams = {}
-# 使用独立的锁来保护active_streams字典
+# 使用独立的锁来保护active_streams字典, 只用于同步的字典操作，不能跨await持有
 active_streams_lock = threading.RLock()
 session_lock = threading.RLock()
+# 每个用户一个asyncio锁，保护DDB上的读-改-写操作
+_user_config_locks = weakref.WeakValueDictionary()
 
-def get_secret(secret_name):
-    # Create a Secrets Manager client
-    session = boto3.session.Session()
-    client = session.client(
-        service_name='secretsmanager',
-        region_name=  os.environ.get('AWS_REGION', 'us-east-1')
+def _get_user_config_lock(user_id: str) -> asyncio.Lock:
+    """获取用户配置的asyncio锁"""
+    with session_lock:
+        lock = _user_config_locks.get(user_id)
+        if lock is None:
+            lock = asyncio.Lock()
+            _user_config_locks[user_id] = lock
+        return lock
 
-    )
+def get_secret(secret_name):
+    # Shared Secrets Manager client
+    client = aws_client_registry.get_client('secretsmanager', region_name=os.environ.get('AWS_REGION', 'us-east-1'))
     try:
         get_secret_value_response = client.get_secret_value(
             SecretId=secret_name
@@ -63,24 +95,273 @@ def get_secret(secret_name):
 if DDB_TABLE:
     try:
         region = os.environ.get('AWS_REGION', 'us-east-1')
-        dynamodb_client = boto3.resource('dynamodb', region_name=region)
+        dynamodb_client = aws_client_registry.create_resource('dynamodb', region_name=region,
+                                                              endpoint_url=DDB_ENDPOINT_URL)
+        ddb_storage = AsyncDDBStorage(DDB_TABLE, region_name=region, endpoint_url=DDB_ENDPOINT_URL)
         logger.info(f"已连接到DynamoDB, 表名: {DDB_TABLE}")
     except Exception as e:
         logger.error(f"DynamoDB连接失败: {e}")
 
-def save_configs_to_json(configs:dict):
+def save_configs_to_json(configs:dict, user_id:str = None):
+    """保存用户配置文件, 指定user_id时只替换该用户的配置, 多个worker进程同时写入也不会互相覆盖"""
     config_file = os.environ.get('USER_MCP_CONFIG_FILE', 'conf/user_mcp_configs.json')
-    with open(config_file, 'w') as f:
-        json.dump(configs, f, indent=2)
+    with open(config_file, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            if user_id is not None:
+                f.seek(0)
+                content = f.read()
+                merged = json.loads(content) if content.strip() else {}
+                if configs.get(user_id):
+                    merged[user_id] = configs[user_id]
+                else:
+                    merged.pop(user_id, None)
+                configs = merged
+            f.seek(0)
+            f.truncate()
+            json.dump(configs, f, indent=2)
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+def _history_head_key(user_id: str) -> str:
+    return f"{user_id}_messages"
+
+def _history_item_key(user_id: str, seq: int) -> str:
+    return f"{user_id}_messages#{seq}"
+
+def _align_history_tail(messages: list) -> list:
+    """截断后的历史必须从普通的user消息开始，不能以assistant消息或孤立的toolResult开头"""
+    for i, message in enumerate(messages):
+        if message.get('role') == 'user' and not any(
+                isinstance(block, dict) and 'toolResult' in block for block in message.get('content', [])):
+            return messages[i:]
+    return []
+
+def _cache_history(user_id: str, end, messages: list):
+    # 调用方会原地修改返回的消息(填入附件字节、上下文管理的裁剪), 缓存中只保存和返回深拷贝
+    user_message_cache.set(user_id, (end, copy.deepcopy(messages)))
+
+def _history_window(messages: list, tail: int) -> list:
+    if tail and len(messages) > tail:
+        return _align_history_tail(messages[-tail:])
+    return list(messages)
+
+def _history_turn_items(user_id: str, messages: list, start_seq: int) -> list:
+    timestamp = datetime.now().isoformat()
+    items = []
+    for i, message in enumerate(messages):
+        key = _history_item_key(user_id, start_seq + i)
+        attributes, extra_chunks = encode_payload(message)
+        items.append({'userId': key, 'kind': HISTORY_ITEM_KIND, 'timestamp': timestamp, **attributes})
+        # 超大的消息拆分到多个item中
+        for index, chunk in enumerate(extra_chunks, start=1):
+            items.append({'userId': part_key(key, index), 'kind': HISTORY_ITEM_KIND, 'blob': chunk})
+    return items
+
+async def _read_history_items(keys: list) -> dict:
+    """批量读取消息item并解码, 返回 key -> message"""
+    items = await ddb_storage.batch_get_items(keys) if keys else []
+    part_keys = [{'userId': part_key(item['userId'], index)}
+                 for item in items for index in range(1, chunk_count(item))]
+    parts = {}
+    if part_keys:
+        parts = {part['userId']: part['blob'] for part in await ddb_storage.batch_get_items(part_keys)}
+    messages = {}
+    for item in items:
+        key = item['userId']
+        try:
+            extra_chunks = [parts[part_key(key, index)] for index in range(1, chunk_count(item))]
+            messages[key] = decode_payload(item, extra_chunks)
+        except Exception as e:
+            logger.warning(f"解码历史消息 {key} 失败: {e}")
+    return messages
+
+async def _delete_history_items(user_id: str, start: int, end: int):
+    """删除序号在[start, end)范围内的消息及其拆分出的item"""
+    keys = [{'userId': _history_item_key(user_id, seq)} for seq in range(start, end)]
+    if not keys:
+        return
+    items = await ddb_storage.batch_get_items(keys, ProjectionExpression="userId, #chunks",
+                                              ExpressionAttributeNames={'#chunks': 'chunks'})
+    keys += [{'userId': part_key(item['userId'], index)}
+             for item in items for index in range(1, chunk_count(item))]
+    await ddb_storage.batch_delete_items(keys)
+
+async def _get_history_head(user_id: str):
+    """返回(start, end, legacy_messages), 旧格式(整个列表存在一个item中)时start/end为None"""
+    item = await get_item_from_ddb(_history_head_key(user_id))
+    if not item:
+        return 0, 0, None
+    if 'historyEnd' in item:
+        return int(item['historyStart']), int(item['historyEnd']), None
+    data = json.loads(item.get('data', '[]'))
+    return None, None, data if isinstance(data, list) else []
+
+def _history_head_item(user_id: str, start: int, end: int) -> dict:
+    return {'userId': _history_head_key(user_id), 'data': json.dumps({"format": HISTORY_FORMAT}),
+            'timestamp': datetime.now().isoformat(), 'historyStart': start, 'historyEnd': end}
+
+async def _put_history_head(user_id: str, start: int, end: int, expected_end):
+    """
+    把head的范围设为[start, end), 在写入这些消息之前调用以预留序号
+
+    head在读取后被其他写入者更新过(historyEnd不是expected_end)时抛出ConditionalCheckFailedException;
+    head不存在或是旧格式时expected_end为0/None
+    """
+    await ddb_storage.put_item(
+        _history_head_item(user_id, start, end),
+        ConditionExpression="attribute_not_exists(historyEnd) OR historyEnd = :expected",
+        ExpressionAttributeValues={':expected': expected_end or 0},
+    )
+
+async def _restore_history_head(user_id: str, start, end, legacy_messages, reserved_end: int):
+    """写入消息失败时把head恢复为预留之前的内容, head已被其他写入者更新时保持不变"""
+    if legacy_messages is not None:
+        item = {'userId': _history_head_key(user_id), 'data': json.dumps(legacy_messages),
+                'timestamp': datetime.now().isoformat()}
+    else:
+        item = _history_head_item(user_id, start, end)
+    try:
+        await ddb_storage.put_item(item, ConditionExpression="historyEnd = :reserved",
+                                   ExpressionAttributeValues={':reserved': reserved_end})
+    except Exception as e:
+        logger.warning(f"恢复用户 {user_id} 历史head失败: {e}")
+
+async def get_user_history(user_id: str, tail: int = HISTORY_TAIL_WINDOW):
+    """
+    读取用户的对话历史, tail>0时只读取最后tail条消息
+
+    Returns:
+        (end, messages): end为存储中下一条消息的序号, 旧格式的历史返回None
+    """
+    # 缓存中保存的是HISTORY_TAIL_WINDOW窗口内的历史
+    use_cache = tail == HISTORY_TAIL_WINDOW
+    cached = user_message_cache.get(user_id) if use_cache else None
+    if cached is not None:
+        end, messages = cached
+        return end, copy.deepcopy(messages)
+    if not ddb_storage:
+        return 0, []
+    try:
+        start, end, legacy_messages = await _get_history_head(user_id)
+        if legacy_messages is not None:
+            # 旧格式的历史在下一次保存时整体迁移, 不能只加载尾部窗口, 否则迁移会丢掉更早的消息
+            result = (None, legacy_messages)
+        else:
+            first = max(start, end - tail) if tail else start
+            keys = [{'userId': _history_item_key(user_id, seq)} for seq in range(first, end)]
+            by_key = await _read_history_items(keys)
+            messages = [by_key[key['userId']] for key in keys if key['userId'] in by_key]
+            if len(messages) != len(keys):
+                logger.warning(f"用户 {user_id} 的历史消息缺少 {len(keys) - len(messages)} 条")
+            result = (end, _align_history_tail(messages) if first > start else messages)
+    except Exception as e:
+        logger.warning(f"从DynamoDB读取用户 {user_id} 历史消息失败: {e}")
+        return 0, []
+    if use_cache:
+        _cache_history(user_id, *result)
+    return result
+
+async def append_user_history(user_id: str, messages: list, start_seq: int, history: list):
+    """
+    把新消息追加为序号从start_seq开始的独立item, 再更新head item
+
+    Args:
+        messages: 新增的消息
+        start_seq: 第一条新消息的序号, 即上一次读取/写入得到的end
+        history: 追加后客户端持有的完整消息列表, 用于刷新本地缓存
+
+    Returns:
+        新的end, 失败时返回None
+    """
+    if not ddb_storage:
+        return None
+    end = start_seq + len(messages)
+    head_key = {'userId': _history_head_key(user_id)}
+    try:
+        # 先用条件更新在head中预留[start_seq, end)再写消息: 持有过期start_seq的写入者(另一个实例,
+        # 或过期的缓存)在这里失败, 不会覆盖已提交的消息
+        await ddb_storage.update_item(
+            head_key,
+            UpdateExpression="SET historyEnd = :end, #ts = :ts",
+            ConditionExpression="historyEnd = :start_seq",
+            ExpressionAttributeNames={'#ts': 'timestamp'},
+            ExpressionAttributeValues={':end': end, ':start_seq': start_seq, ':ts': datetime.now().isoformat()},
+        )
+    except Exception as e:
+        logger.error(f"追加用户 {user_id} 历史消息失败: {e}")
+        user_message_cache.invalidate(user_id)
+        return None
+    try:
+        await ddb_storage.batch_put_items(_history_turn_items(user_id, messages, start_seq))
+    except Exception as e:
+        logger.error(f"写入用户 {user_id} 历史消息失败: {e}")
+        user_message_cache.invalidate(user_id)
+        # 归还预留的序号, 已写入的部分消息在序号被再次预留时覆盖
+        try:
+            await ddb_storage.update_item(
+                head_key,
+                UpdateExpression="SET historyEnd = :start_seq",
+                ConditionExpression="historyEnd = :end",
+                ExpressionAttributeValues={':end': end, ':start_seq': start_seq},
+            )
+        except Exception as rollback_error:
+            logger.warning(f"归还用户 {user_id} 预留的历史序号失败: {rollback_error}")
+        return None
+    _cache_history(user_id, end, _history_window(history, HISTORY_TAIL_WINDOW))
+    return end
+
+async def save_user_message(user_id: str, data: list):
+    """
+    用data整体替换用户的对话历史(包括迁移旧格式), 新消息写在旧序号之后, 写入成功后再删除旧消息
 
-async def save_user_message(user_id: str, data: dict) -> bool:
-    return await save_to_ddb(f"{user_id}_messages",data)
+    Returns:
+        新的end, 失败时返回None
+    """
+    if not ddb_storage:
+        return None
+    try:
+        start, end, legacy_messages = await _get_history_head(user_id)
+        new_start = end or 0
+        new_end = new_start + len(data)
+        # 与append_user_history相同, 先有条件地切换head预留序号, 读取head之后有其他写入者时放弃
+        await _put_history_head(user_id, new_start, new_end, expected_end=end)
+    except Exception as e:
+        logger.error(f"保存用户 {user_id} 历史消息失败: {e}")
+        user_message_cache.invalidate(user_id)
+        return None
+    try:
+        await ddb_storage.batch_put_items(_history_turn_items(user_id, data, new_start))
+    except Exception as e:
+        logger.error(f"写入用户 {user_id} 历史消息失败: {e}")
+        user_message_cache.invalidate(user_id)
+        await _restore_history_head(user_id, start, end, legacy_messages, new_end)
+        return None
+    _cache_history(user_id, new_end, _history_window(data, HISTORY_TAIL_WINDOW))
+    if end:
+        try:
+            await _delete_history_items(user_id, start, end)
+        except Exception as e:
+            logger.warning(f"删除用户 {user_id} 旧的历史消息失败: {e}")
+    return new_end
 
-async def get_user_message(user_id: str) ->dict:
-    return await get_from_ddb(f"{user_id}_messages")
+async def get_user_message(user_id: str, tail: int = HISTORY_TAIL_WINDOW) -> list:
+    _, messages = await get_user_history(user_id, tail)
+    return messages
 
-async def delete_user_message(user_id: str) ->dict:
-    return await delete_from_ddb(f"{user_id}_messages")
+async def delete_user_message(user_id: str) -> bool:
+    user_message_cache.invalidate(user_id)
+    if not ddb_storage:
+        return False
+    start, end, _ = await _get_history_head(user_id)
+    deleted = await delete_from_ddb(_history_head_key(user_id))
+    if end:
+        try:
+            await _delete_history_items(user_id, start, end)
+        except Exception as e:
+            logger.warning(f"删除用户 {user_id} 历史消息失败: {e}")
+            return False
+    return deleted
 
 async def save_user_session(user_id: str, data: dict) -> bool:
     return await save_to_ddb(f"{user_id}_session",data)
@@ -91,20 +372,20 @@ async def get_user_session(user_id: str) ->dict:
 async def delete_user_session(user_id: str) ->dict:
     return await delete_from_ddb(f"{user_id}_session")
     
-async def save_to_ddb(user_id: str, data: dict):
-    """将用户配置保存到DynamoDB"""
-    if not dynamodb_client or not DDB_TABLE:
+async def save_to_ddb(user_id: str, data: dict, attributes: dict = None):
+    """将用户配置保存到DynamoDB, attributes为额外写入的item属性(如revision)"""
+    if not ddb_storage:
         return False
     
     try:
-        table = dynamodb_client.Table(DDB_TABLE)
-        response = table.put_item(
-            Item={
-                'userId': user_id,
-                'data': json.dumps(data),
-                'timestamp': datetime.now().isoformat()
-            }
-        )
+        item = {
+            'userId': user_id,
+            'data': json.dumps(data),
+            'timestamp': datetime.now().isoformat()
+        }
+        if attributes:
+            item.update(attributes)
+        await ddb_storage.put_item(item)
         logger.info(f"保存用户 {user_id} 配置到DynamoDB成功")
         return True
     except Exception as e:
@@ -134,42 +415,40 @@ def get_from_ddb_sync(user_id: str) -> dict:
         logger.warning(f"从DynamoDB获取用户 {user_id} 配置失败: {e}")
         return {}
     
+async def get_item_from_ddb(user_id: str) -> dict:
+    """从DynamoDB获取原始item(包含data以及revision等属性)"""
+    if not ddb_storage:
+        return {}
+    
+    try:
+        response = await ddb_storage.get_item({'userId': user_id})
+        return response.get('Item', {})
+    except Exception as e:
+        logger.warning(f"从DynamoDB获取用户 {user_id} 配置失败: {e}")
+        return {}
+
 async def get_from_ddb(user_id: str) -> dict:
     """从DynamoDB获取用户配置"""
-    if not dynamodb_client or not DDB_TABLE:
+    if not ddb_storage:
         return {}
     
+    item = await get_item_from_ddb(user_id)
+    if not item:
+        logger.info(f"用户 {user_id} 在DynamoDB中无配置")
+        return {}
     try:
-        table = dynamodb_client.Table(DDB_TABLE)
-        response = table.get_item(
-            Key={
-                'userId': user_id
-            }
-        )
-        
-        if 'Item' in response:
-            data = json.loads(response['Item'].get('data', '{}'))
-            # logger.info(f"从DynamoDB获取用户 {user_id} 配置成功")
-            return data
-        else:
-            logger.info(f"用户 {user_id} 在DynamoDB中无配置")
-            return {}
+        return json.loads(item.get('data', '{}'))
     except Exception as e:
-        logger.warning(f"从DynamoDB获取用户 {user_id} 配置失败: {e}")
+        logger.warning(f"解析用户 {user_id} 的DynamoDB数据失败: {e}")
         return {}
         
 async def delete_from_ddb(user_id: str) -> bool:
     """从DynamoDB删除用户配置"""
-    if not dynamodb_client or not DDB_TABLE:
+    if not ddb_storage:
         return False
     
     try:
-        table = dynamodb_client.Table(DDB_TABLE)
-        response = table.delete_item(
-            Key={
-                'userId': user_id
-            }
-        )
+        await ddb_storage.delete_item({'userId': user_id})
         return True
     except Exception as e:
         logger.warning(f"delete_from_ddb failed: {e}")
@@ -177,40 +456,22 @@ async def delete_from_ddb(user_id: str) -> bool:
 
 async def scan_all_from_ddb() -> dict:
     """从DynamoDB扫描所有用户配置，处理分页"""
-    if not dynamodb_client or not DDB_TABLE:
+    if not ddb_storage:
         return {}
     
     try:
-        # 使用scan操作获取所有用户的配置，并处理分页
-        table = dynamodb_client.Table(DDB_TABLE)
+        # 使用scan操作获取所有用户的配置，scan_all内部处理分页
+        # 跳过逐条存储的历史消息
+        items = await ddb_storage.scan_all(FilterExpression=Attr('kind').not_exists())
         configs = {}
-        
-        # 初始化扫描参数
-        scan_params = {}
-        done = False
-        start_key = None
-        
-        # 处理分页
-        while not done:
-            if start_key:
-                scan_params['ExclusiveStartKey'] = start_key
-            
-            response = table.scan(**scan_params)
-            items = response.get('Items', [])
-            
-            # 处理当前页的结果
-            for item in items:
-                if 'userId' in item and 'data' in item:
-                    user_id = item['userId']
-                    try:
-                        user_data = json.loads(item['data'])
-                        configs[user_id] = user_data
-                    except json.JSONDecodeError as e:
-                        logger.error(f"解析用户 {user_id} 的DynamoDB数据失败: {e}")
-            
-            # 检查是否有更多页
-            start_key = response.get('LastEvaluatedKey')
-            done = start_key is None
+        for item in items:
+            if 'userId' in item and 'data' in item:
+                user_id = item['userId']
+                try:
+                    user_data = json.loads(item['data'])
+                    configs[user_id] = user_data
+                except json.JSONDecodeError as e:
+                    logger.error(f"解析用户 {user_id} 的DynamoDB数据失败: {e}")
         
         logger.info(f"已从DynamoDB扫描到 {len(configs)} 个用户的配置")
         return configs
@@ -218,55 +479,102 @@ async def scan_all_from_ddb() -> dict:
         logger.error(f"从DynamoDB扫描用户配置失败: {e}")
         return {}
     
+# 后台写入中的流记录 stream_id -> task
+_stream_record_tasks = {}
+
+def register_stream_id(stream_id:str, user_id:str):
+    """在本实例同步登记流, 流记录在后台写入存储, 不占用调用模型之前的路径"""
+    with active_streams_lock:
+        active_streams[stream_id]=user_id
+    task = asyncio.get_running_loop().create_task(save_stream_id(stream_id, user_id))
+    _stream_record_tasks[stream_id] = task
+    task.add_done_callback(lambda _: _stream_record_tasks.pop(stream_id, None))
+    return task
+
 # Save stream id
 async def save_stream_id(stream_id:str,user_id:str):
     global active_streams
+    if DDB_TABLE and dynamodb_client:
+        # 获取当前用户的所有配置
+        await save_to_ddb(stream_id, dict(user_id=user_id))
+    else:
+        await state_backend.set("streams", stream_id, user_id)
     with active_streams_lock:
-        if DDB_TABLE and dynamodb_client:
-            # 获取当前用户的所有配置
-            await save_to_ddb(stream_id, dict(user_id=user_id))
-            active_streams[stream_id]=user_id
-        else:
-            active_streams[stream_id]=user_id
+        active_streams[stream_id]=user_id
 
 # Get stream id
 async def get_stream_id(stream_id:str):
-    with active_streams_lock:
-        if DDB_TABLE and dynamodb_client:
-            # 尝试从DynamoDB获取
-            ddb_config = await get_from_ddb(stream_id)
-            if ddb_config:
-                return ddb_config.get('user_id')
-            else:
-                return None
+    if DDB_TABLE and dynamodb_client:
+        # 尝试从DynamoDB获取
+        ddb_config = await get_from_ddb(stream_id)
+        if ddb_config:
+            return ddb_config.get('user_id')
         else:
-            return active_streams.get(stream_id)
+            return None
+    else:
+        return await state_backend.get("streams", stream_id)
     
 def get_stream_id_sync(stream_id:str):
-    with active_streams_lock:
-        if DDB_TABLE and dynamodb_client:
-            # 尝试从DynamoDB获取
-            ddb_config = get_from_ddb_sync(stream_id)
-            if ddb_config:
-                return ddb_config.get('user_id')
-            else:
-                return None
+    if DDB_TABLE and dynamodb_client:
+        # 尝试从DynamoDB获取
+        ddb_config = get_from_ddb_sync(stream_id)
+        if ddb_config:
+            return ddb_config.get('user_id')
         else:
+            return None
+    else:
+        with active_streams_lock:
             return active_streams.get(stream_id)    
 
 
 # delete stream id
 async def delete_stream_id(stream_id:str):
+    # 等待后台写入完成, 避免删除后记录又被写回
+    pending = _stream_record_tasks.get(stream_id)
+    if pending:
+        try:
+            await pending
+        except Exception as e:
+            logger.warning(f"保存流 {stream_id} 记录失败: {e}")
+    if DDB_TABLE and dynamodb_client:
+        # 尝试从DynamoDB获取
+        await delete_from_ddb(stream_id)
+
+    else:
+        await state_backend.delete("streams", stream_id)
     with active_streams_lock:
-        if DDB_TABLE and dynamodb_client:
-            # 尝试从DynamoDB获取
-            await delete_from_ddb(stream_id)
+        active_streams.pop(stream_id, None)
+
+# 跨实例停止流的取消标记(ddb取消总线), kind使其不出现在用户配置的scan中
+STREAM_CANCEL_SUFFIX = "_cancel"
+# 没有被订阅的实例删除的取消标记(流已结束或所在实例已退出)由表的TTL(expireAt属性)清理
+STREAM_CANCEL_MARKER_TTL = 24 * 3600  # seconds
+
+async def save_stream_cancellation(stream_id: str) -> bool:
+    if not ddb_storage:
+        return False
+    await ddb_storage.put_item({
+        'userId': f"{stream_id}{STREAM_CANCEL_SUFFIX}",
+        'kind': 'stream_cancel',
+        'timestamp': datetime.now().isoformat(),
+        'expireAt': int(time.time()) + STREAM_CANCEL_MARKER_TTL
+    })
+    return True
+
+async def get_stream_cancellations(stream_ids: list) -> list:
+    """stream_ids中有取消标记的流"""
+    if not ddb_storage or not stream_ids:
+        return []
+    keys = [{'userId': f"{stream_id}{STREAM_CANCEL_SUFFIX}"} for stream_id in stream_ids]
+    items = await ddb_storage.batch_get_items(keys, ProjectionExpression="userId")
+    return [item['userId'][:-len(STREAM_CANCEL_SUFFIX)] for item in items]
+
+async def delete_stream_cancellations(stream_ids: list):
+    if ddb_storage and stream_ids:
+        await ddb_storage.batch_delete_items([{'userId': f"{stream_id}{STREAM_CANCEL_SUFFIX}"}
+                                              for stream_id in stream_ids])
 
-        else:
-            if stream_id in active_streams:
-                active_streams.pop(stream_id, None)
 
-        
 
 # 保存全局MCP服务器配置
 def save_global_server_config( server_id: str, config: dict):
@@ -276,70 +584,113 @@ def save_global_server_config( server_id: str, config: dict):
     # 在实际应用中，这里应该将配置持久化到数据库或文件系统
     logger.info(f"保存Global服务器配置 {server_id}")
 
+def _bump_memory_revision(user_id: str) -> int:
+    """未配置DDB时，递增内存中的用户配置版本号"""
+    revision = user_config_revisions.get(user_id, 0) + 1
+    user_config_revisions[user_id] = revision
+    return revision
+
+async def _write_user_configs(user_id: str, update) -> None:
+    """读取DDB中的用户配置，调用update修改后带着新的revision写回，并刷新本地缓存"""
+    item = await get_item_from_ddb(user_id)
+    try:
+        user_configs = json.loads(item.get('data', '{}')) if item else {}
+    except json.JSONDecodeError:
+        user_configs = {}
+    if not update(user_configs):
+        return
+    revision = int(item.get('revision', 0)) + 1
+    if await save_to_ddb(user_id, user_configs, attributes={'revision': revision}):
+        user_config_cache.set(user_id, (revision, user_configs))
+    else:
+        user_config_cache.invalidate(user_id)
+
 # 删除用户MCP服务器配置 
 async def delete_user_server_config(user_id: str, server_id: str):
     """删除用户的MCP服务器配置"""
-    with session_lock: 
-        if user_id in user_mcp_server_configs and server_id in user_mcp_server_configs[user_id]:
+    async with _get_user_config_lock(user_id):
+        with session_lock:
+            if user_id not in user_mcp_server_configs or server_id not in user_mcp_server_configs[user_id]:
+                return
             del user_mcp_server_configs[user_id][server_id]
-            # 如果配置了DynamoDB，也从DDB中更新用户配置
-            if DDB_TABLE and dynamodb_client:
-                # 获取当前用户的所有配置
-                user_configs = await get_user_server_configs(user_id)
-                if server_id in user_configs:
-                    del user_configs[server_id]
-                    # 保存更新后的配置到DynamoDB
-                    await save_to_ddb(user_id, user_configs)
-                    logger.info(f"已更新用户 {user_id} 在DynamoDB中的配置")
-            else:
-                try:
-                    save_configs_to_json(user_mcp_server_configs)
-                    logger.info(f"为用户 {user_id} 删除服务器配置 {server_id}")
-                except Exception as e:
-                    logger.error(f"保存用户MCP配置到文件失败: {e}")
+        # 如果配置了DynamoDB，也从DDB中更新用户配置
+        if DDB_TABLE and dynamodb_client:
+            def remove_server(user_configs):
+                return user_configs.pop(server_id, None) is not None
+            # 保存更新后的配置到DynamoDB
+            await _write_user_configs(user_id, remove_server)
+            logger.info(f"已更新用户 {user_id} 在DynamoDB中的配置")
+        else:
+            try:
+                with session_lock:
+                    _bump_memory_revision(user_id)
+                    save_configs_to_json(user_mcp_server_configs, user_id)
+                logger.info(f"为用户 {user_id} 删除服务器配置 {server_id}")
+            except Exception as e:
+                logger.error(f"保存用户MCP配置到文件失败: {e}")
 
 
 # 保存用户MCP服务器配置
 async def save_user_server_config(user_id: str, server_id: str, config: dict):
-    """保存用户的MCP服务器配置"""
+    """保存用户的MCP服务器配置，每次保存都会递增配置版本号(revision)"""
     global user_mcp_server_configs
     
-    with session_lock:
-        if user_id not in user_mcp_server_configs:
-            user_mcp_server_configs[user_id] = {}
-        
-        user_mcp_server_configs[user_id][server_id] = config
+    async with _get_user_config_lock(user_id):
+        with session_lock:
+            if user_id not in user_mcp_server_configs:
+                user_mcp_server_configs[user_id] = {}
+            user_mcp_server_configs[user_id][server_id] = config
         # 如果配置了DynamoDB，也保存到DDB中
         if DDB_TABLE and dynamodb_client:
             #获取原有的记录
-            ddb_config = await get_from_ddb(user_id)
-            ddb_config[server_id] = config
-            await save_to_ddb(user_id, ddb_config)
+            def add_server(user_configs):
+                user_configs[server_id] = config
+                return True
+            await _write_user_configs(user_id, add_server)
             logger.info(f"已保存用户 {user_id} 配置到DynamoDB")
         else:
             try:
-                save_configs_to_json(user_mcp_server_configs)
+                with session_lock:
+                    _bump_memory_revision(user_id)
+                    save_configs_to_json(user_mcp_server_configs, user_id)
                 logger.info(f"已保存用户 {user_id} 配置到config_file")
             except Exception as e:
                 logger.error(f"保存用户MCP配置到文件失败: {e}")
 
-# 获取用户MCP服务器配置
-async def get_user_server_configs(user_id: str) -> dict:
-    """获取指定用户的所有MCP服务器配置"""
-    # 如果设置了DynamoDB表名，优先从DynamoDB读取
+# 获取用户MCP服务器配置及版本号
+async def get_user_server_configs_with_revision(user_id: str) -> tuple:
+    """获取指定用户的所有MCP服务器配置及其版本号，TTL内直接命中本地缓存
+    
+    Returns:
+        tuple: (revision, configs)
+    """
+    # 如果设置了DynamoDB表名，优先从缓存/DynamoDB读取
     if DDB_TABLE and dynamodb_client:
-        # 尝试从DynamoDB获取
-        ddb_config = await get_from_ddb(user_id)
+        cached = user_config_cache.get(user_id)
+        if cached is not None:
+            return cached
+        item = await get_item_from_ddb(user_id)
+        try:
+            ddb_config = json.loads(item.get('data', '{}')) if item else {}
+        except json.JSONDecodeError as e:
+            logger.error(f"解析用户 {user_id} 的DynamoDB数据失败: {e}")
+            ddb_config = {}
+        revision = int(item.get('revision', 0)) if item else 0
         if ddb_config:
-            # 如果DynamoDB中有数据，更新内存缓存并返回
+            # 如果DynamoDB中有数据，更新内存缓存
             with session_lock:
                 user_mcp_server_configs[user_id] = ddb_config
-            return ddb_config
-        else:
-            return {}
+        user_config_cache.set(user_id, (revision, ddb_config))
+        return revision, ddb_config
     else: 
-        # 如果没有设置DynamoDB或无法从DynamoDB获取，从内存中读取
-        return user_mcp_server_configs.get(user_id, {})
+        # 如果没有设置DynamoDB，从内存中读取
+        return user_config_revisions.get(user_id, 0), user_mcp_server_configs.get(user_id, {})
+
+# 获取用户MCP服务器配置
+async def get_user_server_configs(user_id: str) -> dict:
+    """获取指定用户的所有MCP服务器配置"""
+    _, configs = await get_user_server_configs_with_revision(user_id)
+    return configs
     
 async def load_user_mcp_configs():
     """加载用户MCP服务器配置"""
@@ -371,6 +722,22 @@ async def load_user_mcp_configs():
             logger.error(f"加载用户MCP配置失败: {e}")
             
 
+def get_cache_stats() -> dict:
+    """返回会话/配置缓存的命中统计"""
+    return {
+        "session_cache": session_cache.stats(),
+        "user_config_cache": user_config_cache.stats(),
+        "user_message_cache": user_message_cache.stats(),
+    }
+
+def save_model_config(model_id: str, config: dict):
+    """保存模型配置(如max_context_tokens)"""
+    model_configs[model_id] = config
+
+def get_model_config(model_id: str) -> dict:
+    """获取模型配置，未配置时返回空字典"""
+    return model_configs.get(model_id, {})
+
 # 获取global服务器配置
 def get_global_server_configs() -> dict:
     """获取全局所有MCP服务器配置"""
@@ -518,6 +885,116 @@ def remove_cache_checkpoint(messages: list) -> list:
             message["content"] = [item for item in message["content"] if "cachePoint" not in item]
     return messages
 
+class MessagePipeline:
+    """
+    Applies a selection of the message transformations above in one traversal of the messages
+
+    Steps are added with the builder methods and keep the semantics of the
+    corresponding functions, but all of them share a single walk over the
+    messages and their content blocks; redaction and image removal then only
+    touch the blocks collected during that walk. Messages and content lists are
+    mutated in place, content lists are only rewritten when a block is removed.
+
+    Example:
+        pipeline = MessagePipeline().remove_cache_points().keep_recent_images(5, 2).redact_old_text(10)
+        messages = pipeline(messages)
+    """
+
+    def __init__(self):
+        self._filter_tool_use = False
+        self._remove_cache_points = False
+        self._redact = None
+        self._images = None
+
+    def filter_tool_use(self) -> "MessagePipeline":
+        """Same as filter_tool_use_result: drop toolUse/toolResult/reasoningContent blocks and empty messages"""
+        self._filter_tool_use = True
+        return self
+
+    def remove_cache_points(self) -> "MessagePipeline":
+        """Same as remove_cache_checkpoint"""
+        self._remove_cache_points = True
+        return self
+
+    def redact_old_text(self, window_size: int = 10, min_redaction_threshold: int = 1,
+                        text_length_threshold: int = 1000) -> "MessagePipeline":
+        """Same as maybe_redact_old_text_content"""
+        if window_size:
+            self._redact = (window_size, min_redaction_threshold, text_length_threshold)
+        return self
+
+    def keep_recent_images(self, images_to_keep: int, min_removal_threshold: int) -> "MessagePipeline":
+        """Same as maybe_filter_to_n_most_recent_images"""
+        if images_to_keep:
+            self._images = (images_to_keep, min_removal_threshold)
+        return self
+
+    def __call__(self, messages: list) -> list:
+        filter_tool_use = self._filter_tool_use
+        # 需要移除的内容块类型
+        removable = set()
+        if self._remove_cache_points:
+            removable.add("cachePoint")
+        if filter_tool_use:
+            removable.update(("toolResult", "toolUse", "reasoningContent"))
+        collect_tool_results = (self._redact or self._images) and not filter_tool_use
+        text_length_threshold = self._redact[2] if self._redact else 0
+        long_texts = []  # 按从旧到新的顺序收集的长文本tool result内容
+        images = []  # (tool_result content列表, 图片内容)
+        drop_empty = False
+
+        for message in messages:
+            content = message.get("content")
+            if not isinstance(content, list):
+                continue
+            kept = None
+            for index, item in enumerate(content):
+                if isinstance(item, dict):
+                    if removable and not removable.isdisjoint(item):
+                        if kept is None:
+                            kept = content[:index]
+                        continue
+                    if collect_tool_results and "toolResult" in item:
+                        result_content = item["toolResult"].get("content")
+                        if isinstance(result_content, list):
+                            for result_item in result_content:
+                                if not isinstance(result_item, dict):
+                                    continue
+                                if self._redact and "text" in result_item and \
+                                        len(result_item["text"]) > text_length_threshold:
+                                    long_texts.append(result_item)
+                                elif self._images and "image" in result_item:
+                                    images.append((result_content, result_item))
+                if kept is not None:
+                    kept.append(item)
+            if kept is not None:
+                content[:] = kept
+            if filter_tool_use and not content:
+                drop_empty = True
+
+        if drop_empty:
+            messages[:] = [message for message in messages if message.get("content") != []]
+
+        if long_texts:
+            window_size, min_redaction_threshold, _ = self._redact
+            texts_to_redact = max(0, len(long_texts) - window_size)
+            texts_to_redact -= texts_to_redact % min_redaction_threshold
+            for result_item in long_texts[:texts_to_redact]:
+                result_item["text"] = result_item["text"][:text_length_threshold] + " <redacted content>"
+
+        if images:
+            images_to_keep, min_removal_threshold = self._images
+            images_to_remove = len(images) - images_to_keep
+            images_to_remove -= images_to_remove % min_removal_threshold
+            if images_to_remove > 0:
+                removed = {}
+                for result_content, result_item in images[:images_to_remove]:
+                    removed.setdefault(id(result_content), (result_content, set()))[1].add(id(result_item))
+                for result_content, item_ids in removed.values():
+                    result_content[:] = [item for item in result_content if id(item) not in item_ids]
+
+        return messages
+
 def hash_filename(filepath, algorithm='md5'):
     """
     对文件名进行哈希处理，但保留原始扩展名
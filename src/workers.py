@@ -0,0 +1,224 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+Multi-process serving with deterministic user -> worker affinity
+
+`run_workers` forks N worker processes that all accept connections on one shared
+listening socket, so the kernel spreads connections over every core. A user's
+session (agent, MCP server processes, streams) lives in exactly one worker,
+chosen by a stable hash of the user id. Each worker also listens on a private
+loopback port; `WorkerAffinityMiddleware` forwards a request that arrives at the
+wrong worker to the owner's private port and streams the response back.
+"""
+import os
+import time
+import signal
+import socket
+import asyncio
+import hashlib
+import logging
+from typing import Callable, Dict, Optional
+from starlette.datastructures import Headers
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(levelname)s - %(filename)s:%(lineno)d - %(message)s',
+)
+logger = logging.getLogger(__name__)
+
+FORWARDED_HEADER = "x-mcp-worker-forwarded"
+# 不转发的hop-by-hop头
+HOP_BY_HOP_HEADERS = {"connection", "keep-alive", "proxy-authenticate", "proxy-authorization",
+                      "te", "trailers", "transfer-encoding", "upgrade", "host", "content-length"}
+
+# 当前进程的worker信息, 由configure_worker在fork后设置
+worker_index = 0
+worker_count = 1
+worker_base_port = 0
+worker_scheme = "http"
+
+
+def worker_for(key: str, count: int) -> int:
+    """Stable worker index of a user id, identical in every process and across restarts"""
+    digest = hashlib.sha1(key.encode('utf-8')).digest()
+    return int.from_bytes(digest[:8], 'big') % count
+
+
+def affinity_key(headers: Headers) -> Optional[str]:
+    """The user id the server would use for this request: X-User-ID, else the bearer credential"""
+    user_id = headers.get("x-user-id")
+    if user_id:
+        return user_id
+    authorization = headers.get("authorization", "")
+    scheme, _, credentials = authorization.partition(" ")
+    if scheme.lower() == "bearer" and credentials:
+        return credentials
+    return None
+
+
+def configure_worker(index: int, count: int, base_port: int, scheme: str = "http"):
+    global worker_index, worker_count, worker_base_port, worker_scheme
+    worker_index, worker_count, worker_base_port, worker_scheme = index, count, base_port, scheme
+
+
+def bind_socket(host: str, port: int) -> socket.socket:
+    """Bind a listening socket that can be inherited by forked workers"""
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(2048)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_workers(count: int, target: Callable[[int], None]):
+    """
+    Fork `count` workers running `target(index)` and keep them running
+
+    A worker that exits (e.g. after uvicorn's limit_max_requests) is restarted
+    with the same index, so user affinity is preserved. SIGINT/SIGTERM stop all
+    workers.
+    """
+    children: Dict[int, int] = {}
+    stopping = False
+
+    def spawn(index: int):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            code = 0
+            try:
+                target(index)
+            except BaseException as e:
+                logger.error(f"Worker {index} failed: {e}")
+                code = 1
+            finally:
+                os._exit(code)
+        children[pid] = index
+        logger.info(f"Started worker {index} (pid {pid})")
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in list(children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+    for index in range(count):
+        spawn(index)
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        except InterruptedError:
+            continue
+        index = children.pop(pid, None)
+        if index is None:
+            continue
+        logger.info(f"Worker {index} (pid {pid}) exited with status {status}")
+        if not stopping:
+            time.sleep(0.5)
+            spawn(index)
+
+
+class WorkerAffinityMiddleware:
+    """ASGI middleware routing each user's requests to the worker owning the user"""
+
+    def __init__(self, app):
+        self.app = app
+        self._client = None
+
+    def _get_client(self):
+        import aiohttp
+        if self._client is None or self._client.closed:
+            self._client = aiohttp.ClientSession(
+                timeout=aiohttp.ClientTimeout(total=None, sock_connect=10),
+                auto_decompress=False,
+            )
+        return self._client
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or worker_count <= 1:
+            return await self.app(scope, receive, send)
+        headers = Headers(scope=scope)
+        user_id = affinity_key(headers)
+        if headers.get(FORWARDED_HEADER) or user_id is None:
+            return await self.app(scope, receive, send)
+        owner = worker_for(user_id, worker_count)
+        if owner == worker_index:
+            return await self.app(scope, receive, send)
+        await self._forward(scope, receive, send, owner, headers)
+
+    async def _forward(self, scope, receive, send, owner: int, headers: Headers):
+        message = await receive()
+        if message["type"] == "http.disconnect":
+            return
+        # 单块的请求体直接转发, 多块的(如/v1/files上传)边读边转发, 不在内存中缓存整个请求体
+        body_done = asyncio.Event()
+        client_gone = False
+
+        async def body_chunks(message):
+            nonlocal client_gone
+            try:
+                while True:
+                    if message.get("body"):
+                        yield message["body"]
+                    if not message.get("more_body"):
+                        return
+                    message = await receive()
+                    if message["type"] == "http.disconnect":
+                        # 中断转发, 不能让owner worker收到一个截断但完整结束的请求体
+                        client_gone = True
+                        raise ConnectionResetError("client disconnected while sending the request body")
+            finally:
+                body_done.set()
+
+        if message.get("more_body"):
+            body = body_chunks(message)
+        else:
+            body = message.get("body", b"")
+            body_done.set()
+
+        url = f"{worker_scheme}://127.0.0.1:{worker_base_port + owner}{scope['path']}"
+        if scope.get("query_string"):
+            url += "?" + scope["query_string"].decode("latin-1")
+        forward_headers = [(k, v) for k, v in headers.items() if k.lower() not in HOP_BY_HOP_HEADERS]
+        forward_headers.append((FORWARDED_HEADER, str(worker_index)))
+
+        async def proxy():
+            async with self._get_client().request(scope["method"], url, headers=forward_headers, data=body,
+                                                  ssl=False, allow_redirects=False) as response:
+                response_headers = [(k.lower().encode("latin-1"), v.encode("latin-1"))
+                                    for k, v in response.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS]
+                await send({"type": "http.response.start", "status": response.status, "headers": response_headers})
+                async for chunk in response.content.iter_any():
+                    await send({"type": "http.response.body", "body": chunk, "more_body": True})
+                await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+        async def wait_disconnect():
+            # 请求体读完之前receive由body_chunks消费
+            await body_done.wait()
+            while not client_gone and (await receive())["type"] != "http.disconnect":
+                pass
+
+        # 客户端断开时取消转发, 让owner worker也看到断开
+        proxy_task = asyncio.create_task(proxy())
+        disconnect_task = asyncio.create_task(wait_disconnect())
+        try:
+            await asyncio.wait([proxy_task, disconnect_task], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for task in (proxy_task, disconnect_task):
+                task.cancel()
+            await asyncio.gather(proxy_task, disconnect_task, return_exceptions=True)
+        if not client_gone and proxy_task.done() and not proxy_task.cancelled() and proxy_task.exception():
+            logger.error(f"Forwarding to worker {owner} failed: {proxy_task.exception()}")
+            raise proxy_task.exception()
@@ -0,0 +1,77 @@
+"""
+Copyright Amazon.com, Inc. or its affiliates. All Rights Reserved.
+SPDX-License-Identifier: MIT-0
+"""
+"""
+A stage-timed (sampled) chat stream must still end on stream_end and error events
+
+Usage:
+    python -m pytest -q tests/test_stream_stage_timings.py
+"""
+import os
+import sys
+import asyncio
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import stage_timer
+from stream_channel import StreamChannel
+from strands_agent_client_stream import StrandsAgentClientStream
+
+
+def _scripted_client(events):
+    """Client whose agent worker emits `events` instead of calling a model"""
+    client = StrandsAgentClientStream(user_id='stage_timing_test')
+
+    async def load_history():
+        return []
+
+    async def create_agent(**kwargs):
+        return None
+
+    def start_agent(stream_id, prompt):
+        channel = StreamChannel()
+        client.stream_queues[stream_id] = channel
+        for event in events:
+            channel.put(event)
+
+    client.load_history = load_history
+    client._create_agent_with_tools = create_agent
+    client._start_agent_thread = start_agent
+    client._start_agent_task = start_agent
+    return client
+
+
+async def _run(events):
+    timer = stage_timer.start_request("stage_timing_test", "fake", force=True)
+    client = _scripted_client(events)
+    stream = client.process_query_stream(
+        model_id="fake", messages=[{"role": "user", "content": [{"text": "hi"}]}], stream_id="stage_timing_test")
+    received = await asyncio.wait_for(_collect(stream), timeout=5)
+    return timer, received
+
+
+async def _collect(stream):
+    return [event async for event in stream]
+
+
+def test_sampled_stream_ends_on_stream_end():
+    events = [
+        {"type": "message_start", "data": {"role": "assistant"}},
+        {"type": "block_delta", "data": {"delta": {"text": "hello"}}},
+        {"type": "block_stop", "data": {}},
+        # 不以end_turn/max_tokens结束的流, 只能靠stream_end结束
+        {"type": "message_stop", "data": {"stopReason": "stop_sequence"}},
+        {"type": "stream_end"},
+    ]
+    timer, received = asyncio.run(_run(events))
+    types = [event["type"] for event in received]
+    assert "stream_end" not in types
+    assert types[-1] == "message_stop"
+    assert "model_first_byte" in timer.stages
+
+
+def test_sampled_stream_ends_on_error():
+    timer, received = asyncio.run(_run([{"type": "error", "data": {"message": "boom"}}]))
+    assert [event["type"] for event in received] == ["error"]
+    assert "model_first_byte" in timer.stages